@@ -2,9 +2,27 @@ import os
 from celery import Celery
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Weather_reminder.settings')
+# Celery runs Django's system checks when a worker or beat starts, which imports the URLconf with all views and
+# the JWT authentication; deployments run them with `manage.py check` and `migrate` instead
+os.environ.setdefault('CELERY_SKIP_CHECKS', 'true')
 
 app = Celery('Weather_reminder')
 
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 app.autodiscover_tasks()
+
+
+@app.on_after_configure.connect
+def setup_periodic_tasks(sender, **kwargs):
+    """Register the beat schedule once the app is configured, so that only processes using Celery build it."""
+    from celery.schedules import crontab
+
+    sender.add_periodic_task(crontab(minute=0), sender.signature('weather.tasks.update_tables_and_send_emails'),
+                             name='update-tables-and-send-emails')
+    sender.add_periodic_task(crontab(minute=30, hour=3), sender.signature('weather.tasks.remove_unused_cities'),
+                             name='remove-unused-cities')
+    sender.add_periodic_task(crontab(minute=45, hour=3), sender.signature('weather.tasks.prune_expired_tokens'),
+                             name='prune-expired-tokens')
+    sender.add_periodic_task(crontab(minute=50, hour=3), sender.signature('weather.tasks.prune_notifications'),
+                             name='prune-notifications')
@@ -13,10 +13,7 @@ import os
 from datetime import timedelta
 from pathlib import Path
 
-from celery.schedules import crontab
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from decouple import config
+from decouple import Csv, config
 from dotenv import load_dotenv
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -49,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'weather.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -93,6 +91,22 @@ DATABASES = {
     }
 }
 
+# Cache configuration: Redis when REDIS_URL is set, otherwise a per-process memory cache
+REDIS_URL = config('REDIS_URL', default='')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -111,6 +125,16 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Password hashers; the first hashes new passwords, the others still verify existing hashes.
+# Test and benchmark runs can put a cheap one first, e.g. django.contrib.auth.hashers.MD5PasswordHasher
+PASSWORD_HASHERS = config('PASSWORD_HASHERS', cast=Csv(), default=','.join([
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]))
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
 
@@ -136,7 +160,7 @@ AUTH_USER_MODEL = 'weather.CustomUser'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'weather.authentication.CachedJWTAuthentication',
     ],
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
 }
@@ -165,15 +189,12 @@ SPECTACULAR_SETTINGS = {
 }
 load_dotenv()
 
-# Read values of keys from the .env file
+# Read values of keys from the .env file; they are parsed on the first signing or verification
+# (weather.token_backend), not by every process importing the settings
 RSA_PRIVATE_KEY = os.getenv('RSA_PRIVATE_KEY')
 RSA_PUBLIC_KEY = os.getenv('RSA_PUBLIC_KEY')
 
-# Convert key strings into key objects in PEM format
-private_key = serialization.load_pem_private_key(RSA_PRIVATE_KEY.encode(), password=None, backend=default_backend())
-public_key = serialization.load_pem_public_key(RSA_PUBLIC_KEY.encode(), backend=default_backend())
-
-# Use the obtained key objects in Simple JWT settings
+# Use the PEM keys in Simple JWT settings
 SIMPLE_JWT = {
     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=15),
     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),
@@ -182,8 +203,8 @@ SIMPLE_JWT = {
     'UPDATE_LAST_LOGIN': False,
 
     'ALGORITHM': 'RS256',
-    'SIGNING_KEY': private_key,
-    'VERIFYING_KEY': public_key,
+    'SIGNING_KEY': RSA_PRIVATE_KEY,
+    'VERIFYING_KEY': RSA_PUBLIC_KEY,
     'AUDIENCE': None,
     'ISSUER': None,
     'JWK_URL': None,
@@ -195,9 +216,11 @@ SIMPLE_JWT = {
     'USER_ID_CLAIM': 'user_id',
     'USER_AUTHENTICATION_RULE': 'rest_framework_simplejwt.authentication.default_user_authentication_rule',
 
-    'AUTH_TOKEN_CLASSES': ('rest_framework_simplejwt.tokens.AccessToken',),
+    'AUTH_TOKEN_CLASSES': ('weather.authentication.LazyKeyAccessToken',),
     'TOKEN_TYPE_CLAIM': 'token_type',
     'TOKEN_USER_CLASS': 'rest_framework_simplejwt.models.TokenUser',
+    'TOKEN_OBTAIN_SERIALIZER': 'weather.authentication.LazyKeyTokenObtainPairSerializer',
+    'TOKEN_REFRESH_SERIALIZER': 'weather.authentication.CachedBlacklistTokenRefreshSerializer',
 
     'JTI_CLAIM': 'jti',
 
@@ -205,6 +228,16 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
+
+# Number of verified access tokens and of resolved users cached per process, and seconds a user stays cached
+WEATHER_AUTH_TOKEN_CACHE_SIZE = config('WEATHER_AUTH_TOKEN_CACHE_SIZE', default=10000, cast=int)
+WEATHER_AUTH_USER_CACHE_SIZE = config('WEATHER_AUTH_USER_CACHE_SIZE', default=10000, cast=int)
+WEATHER_AUTH_USER_CACHE_TTL = config('WEATHER_AUTH_USER_CACHE_TTL', default=60, cast=int)
+# Django cache remembering blacklisted refresh tokens until they expire, shared by all processes through REDIS_URL,
+# and number of expired tokens deleted per transaction by the daily prune
+WEATHER_TOKEN_BLACKLIST_CACHE_ALIAS = config('WEATHER_TOKEN_BLACKLIST_CACHE_ALIAS', default='default')
+WEATHER_TOKEN_PRUNE_CHUNK_SIZE = config('WEATHER_TOKEN_PRUNE_CHUNK_SIZE', default=1000, cast=int)
+
 # Email configuration
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
@@ -213,13 +246,97 @@ EMAIL_HOST_USER = config('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_HOST_PASSWORD')
 EMAIL_USE_TLS = True
 DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL')
-
-CELERY_BEAT_SCHEDULE = {
-    'update-tables-and-send-emails': {
-        'task': 'weather.tasks.update_tables_and_send_emails',
-        'schedule': crontab(minute=0),
+# Number of weather reports sent per SMTP batch and the pause in seconds between batches
+WEATHER_EMAIL_BATCH_SIZE = config('WEATHER_EMAIL_BATCH_SIZE', default=50, cast=int)
+WEATHER_EMAIL_THROTTLE = config('WEATHER_EMAIL_THROTTLE', default=0, cast=float)
+# Seconds after which a report claimed by a worker that never marked it sent may be claimed again
+WEATHER_NOTIFICATION_CLAIM_TIMEOUT = config('WEATHER_NOTIFICATION_CLAIM_TIMEOUT', default=900, cast=int)
+# Seconds the notification ledger keeps the entry of a slot, and number of entries deleted per transaction
+# by the daily prune
+WEATHER_NOTIFICATION_RETENTION = config('WEATHER_NOTIFICATION_RETENTION', default=7 * 24 * 3600, cast=int)
+WEATHER_NOTIFICATION_PRUNE_CHUNK_SIZE = config('WEATHER_NOTIFICATION_PRUNE_CHUNK_SIZE', default=1000, cast=int)
+# Number of rendered weather report bodies kept per worker process, one per city and weather refresh
+WEATHER_RENDERED_REPORTS_CACHE_SIZE = config('WEATHER_RENDERED_REPORTS_CACHE_SIZE', default=1000, cast=int)
+
+# Weather provider configuration
+OWM_API_URL = config('OWM_API_URL', default='https://api.openweathermap.org/data/2.5')
+# Timeouts in seconds, retries with jittered exponential backoff and circuit breaker of provider calls
+WEATHER_PROVIDER_CONNECT_TIMEOUT = config('WEATHER_PROVIDER_CONNECT_TIMEOUT', default=3.05, cast=float)
+WEATHER_PROVIDER_READ_TIMEOUT = config('WEATHER_PROVIDER_READ_TIMEOUT', default=10, cast=float)
+WEATHER_PROVIDER_RETRIES = config('WEATHER_PROVIDER_RETRIES', default=3, cast=int)
+WEATHER_PROVIDER_BACKOFF = config('WEATHER_PROVIDER_BACKOFF', default=0.5, cast=float)
+WEATHER_PROVIDER_BACKOFF_JITTER = config('WEATHER_PROVIDER_BACKOFF_JITTER', default=0.5, cast=float)
+WEATHER_PROVIDER_BREAKER_THRESHOLD = config('WEATHER_PROVIDER_BREAKER_THRESHOLD', default=5, cast=int)
+WEATHER_PROVIDER_BREAKER_RESET_TIMEOUT = config('WEATHER_PROVIDER_BREAKER_RESET_TIMEOUT', default=30, cast=float)
+# Maximum number of open provider connections of the async client of one ASGI process
+WEATHER_PROVIDER_ASYNC_CONNECTIONS = config('WEATHER_PROVIDER_ASYNC_CONNECTIONS', default=100, cast=int)
+# Number of cities whose weather is fetched in parallel during a refresh
+WEATHER_FETCH_CONCURRENCY = config('WEATHER_FETCH_CONCURRENCY', default=10, cast=int)
+# Provider rate budget: at most WEATHER_FETCH_RATE_LIMIT calls per WEATHER_FETCH_RATE_PERIOD seconds (0 disables it),
+# counted in a cache that has to be shared by all workers (REDIS_URL) for the budget to hold across processes
+WEATHER_FETCH_RATE_LIMIT = config('WEATHER_FETCH_RATE_LIMIT', default=60, cast=int)
+WEATHER_FETCH_RATE_PERIOD = config('WEATHER_FETCH_RATE_PERIOD', default=60, cast=float)
+WEATHER_FETCH_RATE_CACHE_ALIAS = config('WEATHER_FETCH_RATE_CACHE_ALIAS', default='default')
+# Seconds between two refresh runs (the beat schedule in celery.py) and the maximum age in seconds
+# of stored weather; only cities with a subscriber due before the next run or stale weather are fetched
+WEATHER_REFRESH_INTERVAL = config('WEATHER_REFRESH_INTERVAL', default=3600, cast=int)
+WEATHER_MAX_STALENESS = config('WEATHER_MAX_STALENESS', default=6 * 3600, cast=int)
+# Number of cities fetched and written back together
+WEATHER_FETCH_BATCH_SIZE = config('WEATHER_FETCH_BATCH_SIZE', default=100, cast=int)
+# Provider response cache: TTLs in seconds of found and "city not found" responses,
+# the Django cache used as the shared tier and the size and TTL of the in-process tier
+WEATHER_CACHE_TTL = config('WEATHER_CACHE_TTL', default=600, cast=int)
+WEATHER_CACHE_NEGATIVE_TTL = config('WEATHER_CACHE_NEGATIVE_TTL', default=3600, cast=int)
+WEATHER_CACHE_ALIAS = config('WEATHER_CACHE_ALIAS', default='default')
+WEATHER_CACHE_LOCAL_SIZE = config('WEATHER_CACHE_LOCAL_SIZE', default=1024, cast=int)
+WEATHER_CACHE_LOCAL_TTL = config('WEATHER_CACHE_LOCAL_TTL', default=60, cast=int)
+# Number of due subscriptions handed to one email dispatch task
+WEATHER_NOTIFY_BATCH_SIZE = config('WEATHER_NOTIFY_BATCH_SIZE', default=100, cast=int)
+# Number of cities and of due subscriptions per shard task of an hourly run
+WEATHER_CITY_SHARD_SIZE = config('WEATHER_CITY_SHARD_SIZE', default=500, cast=int)
+WEATHER_SUBSCRIPTION_SHARD_SIZE = config('WEATHER_SUBSCRIPTION_SHARD_SIZE', default=1000, cast=int)
+# Maximum number of rows of one subscription import and number of rows read per query of an export
+WEATHER_IMPORT_MAX_ROWS = config('WEATHER_IMPORT_MAX_ROWS', default=1000, cast=int)
+WEATHER_EXPORT_CHUNK_SIZE = config('WEATHER_EXPORT_CHUNK_SIZE', default=500, cast=int)
+# Most cities one import request looks up at the provider, so it never waits long on it; rows of further
+# unknown cities are imported by a background task
+WEATHER_IMPORT_MAX_LOOKUPS = config('WEATHER_IMPORT_MAX_LOOKUPS', default=20, cast=int)
+# Seconds a run keeps its lease without a heartbeat and the cache holding the lease; overlapping runs
+# are skipped. The cache has to be shared by all workers (REDIS_URL) for that to hold across processes
+WEATHER_RUN_LEASE_TTL = config('WEATHER_RUN_LEASE_TTL', default=600, cast=int)
+# Seconds a task of a run may wait in the queue before it expires unrun; the lease lasts this much longer,
+# so it cannot expire while shards wait behind a backlog
+WEATHER_RUN_QUEUE_WAIT = config('WEATHER_RUN_QUEUE_WAIT', default=1800, cast=int)
+WEATHER_LOCK_CACHE_ALIAS = config('WEATHER_LOCK_CACHE_ALIAS', default='default')
+# Request and task metrics, served to Prometheus at /metrics by the web processes and on WEATHER_METRICS_WORKER_PORT
+# (0 disables it) by every Celery worker, and logged as one JSON line per request and task run by the weather.metrics
+# logger; disabled, they cost a setting lookup. Processes sharing a PROMETHEUS_MULTIPROC_DIR report them together
+WEATHER_METRICS_ENABLED = config('WEATHER_METRICS_ENABLED', default=False, cast=bool)
+WEATHER_METRICS_WORKER_PORT = config('WEATHER_METRICS_WORKER_PORT', default=0, cast=int)
+# Bearer token Prometheus sends to scrape /metrics of the web app; while it is empty, /metrics answers 404
+WEATHER_METRICS_TOKEN = config('WEATHER_METRICS_TOKEN', default='')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'weather.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
+CELERY_TASK_ROUTES = {
+    'weather.tasks.send_subscriptions_shard': {'queue': 'emails'},
+}
+
 CELERY_BROKER_URL = 'pyamqp://localhost'
-CELERY_RESULT_BACKEND = 'rpc://localhost'
+# The hourly run is built from chords, which the result backend has to support (rpc:// does not)
+CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default=REDIS_URL or 'redis://localhost:6379/0')
@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 
 from .forms import CustomUserCreationForm, CustomUserChangeForm
-from .models import CustomUser, CityName, CityWeather, UserSubscription
+from .models import CustomUser, CityName, CityWeather, Notification, UserSubscription
 
 
 class CustomUserAdmin(UserAdmin):
@@ -30,3 +30,4 @@ admin.site.register(CustomUser, CustomUserAdmin)
 admin.site.register(CityName)
 admin.site.register(CityWeather)
 admin.site.register(UserSubscription)
+admin.site.register(Notification)
@@ -1,6 +1,35 @@
+import sys
+
 from django.apps import AppConfig
 
 
+def forget_user(sender, instance, **kwargs):
+    """
+    Signal handler dropping a saved or deleted user from the authentication cache.
+
+    The cache lives in `weather.authentication`, which is imported by the first authenticated
+    request; processes that have not imported it have nothing to drop, and do not pay for its imports.
+    """
+    authentication = sys.modules.get('weather.authentication')
+    if authentication is not None:
+        authentication.forget_user(sender, instance, **kwargs)
+
+
 class WeatherConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'weather'
+
+    def ready(self):
+        from celery.signals import task_postrun, task_prerun, worker_ready
+        from django.contrib.auth import get_user_model
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save
+
+        from .metrics import finish_task, install_query_recorder, start_task, start_worker_server
+
+        post_save.connect(forget_user, sender=get_user_model(), dispatch_uid='weather_forget_saved_user')
+        post_delete.connect(forget_user, sender=get_user_model(), dispatch_uid='weather_forget_deleted_user')
+        connection_created.connect(install_query_recorder, dispatch_uid='weather_install_query_recorder')
+        task_prerun.connect(start_task, weak=False, dispatch_uid='weather_start_task_metrics')
+        task_postrun.connect(finish_task, weak=False, dispatch_uid='weather_finish_task_metrics')
+        worker_ready.connect(start_worker_server, weak=False, dispatch_uid='weather_start_worker_metrics_server')
@@ -0,0 +1,170 @@
+import json
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+from .authentication import CachedJWTAuthentication
+from .models import CityName, CityWeather, UserSubscription
+from .serializers import OneSubscriptionSerializer, SubscriptionUpdateSerializer
+from .tasks import clean_weather_data
+from .utils import aget_cached_weather
+from .views import edit_subscription
+
+
+async def authenticate(request):
+    """
+    Authenticate a request by its JWT access token, like `CachedJWTAuthentication` does for the API views.
+
+    :return: The authenticated user, or None if the request carries no token.
+    :raises InvalidToken: If the token is invalid or expired.
+    :raises AuthenticationFailed: If the user of the token does not exist or is inactive.
+    """
+    authentication = CachedJWTAuthentication()
+    header = authentication.get_header(request)
+    if header is None:
+        return None
+    raw_token = authentication.get_raw_token(header)
+    if raw_token is None:
+        return None
+    validated_token = authentication.get_validated_token(raw_token)
+    return await sync_to_async(authentication.get_user)(validated_token)
+
+
+async def aget_known_city(city_data):
+    """Async version of `views.get_known_city`."""
+    city = await CityName.objects.afind(city_data)
+    if city is None:
+        return None, None
+    stale_before = timezone.now() - timedelta(seconds=settings.WEATHER_MAX_STALENESS)
+    return city, await CityWeather.objects.filter(city=city, last_info_update__gt=stale_before).afirst()
+
+
+async def asave_city_weather(city_data, weather_data):
+    """Async version of `views.save_city_weather`."""
+    city, _ = await CityName.objects.aresolve(city_data)
+    if city.remember_provider_location(weather_data):
+        await city.asave(update_fields=['provider_id', 'latitude', 'longitude'])
+    city_weather, _ = await CityWeather.objects.aupdate_or_create(city=city,
+                                                                  defaults=clean_weather_data(weather_data))
+    return city, city_weather
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncSubscriptionView(View):
+    """
+    Base of the async subscription endpoints.
+
+    The endpoints await the weather provider and the database instead of holding a worker
+    thread, so under an ASGI server one process serves many of them concurrently.
+    They accept and answer the same JSON as their `APIView` counterparts.
+    """
+    serializer_class = None
+    error_status = status.HTTP_400_BAD_REQUEST
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await authenticate(request)
+        except (InvalidToken, AuthenticationFailed) as error:
+            body = error.detail if isinstance(error.detail, dict) else {'detail': error.detail}
+            return JsonResponse(body, status=status.HTTP_401_UNAUTHORIZED)
+        if request.user is None:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'},
+                                status=status.HTTP_401_UNAUTHORIZED)
+        return await super().dispatch(request, *args, **kwargs)
+
+    def get_validated_data(self, request):
+        """
+        Parse and validate the request body.
+
+        :return: A `(validated_data, error_response)` tuple, one of which is None.
+        """
+        try:
+            request_body = json.loads(request.body)
+        except ValueError:
+            return None, JsonResponse({'error': 'Request body is not valid JSON'},
+                                      status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.serializer_class(data=request_body)
+        if not serializer.is_valid():
+            return None, JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return serializer.validated_data, None
+
+    async def get_city_weather(self, city_data, city, city_weather):
+        """
+        Complete a local lookup of the requested city, calling the provider if it had no recent weather.
+
+        :return: A `(city, city_weather, error_response)` tuple; the error response is None on success.
+        """
+        if city_weather is not None:
+            return city, city_weather, None
+        weather_data, code = await aget_cached_weather(city_data)
+        if code != 200:
+            return None, None, JsonResponse({'error': weather_data['message'], 'code': code},
+                                            status=self.error_status)
+        return *await asave_city_weather(city_data, weather_data), None
+
+
+class AsyncNewSubscriptionView(AsyncSubscriptionView):
+    """Async version of `NewSubscriptionView`."""
+    serializer_class = OneSubscriptionSerializer
+    error_status = status.HTTP_404_NOT_FOUND
+
+    async def post(self, request):
+        """Handle POST requests for creating new user subscriptions."""
+        subscription_data, error_response = self.get_validated_data(request)
+        if error_response is not None:
+            return error_response
+
+        city_data = subscription_data['city']
+        subscription_city, subscription_weather = await aget_known_city(city_data)
+        if (subscription_city is not None
+                and await subscription_city.subscriptions.filter(user=request.user).aexists()):
+            return JsonResponse({'error': 'You are already subscribed to this city. '
+                                          'Please, edit an existing subscription'},
+                                status=status.HTTP_400_BAD_REQUEST)
+        subscription_city, subscription_weather, error_response = await self.get_city_weather(
+            city_data, subscription_city, subscription_weather)
+        if error_response is not None:
+            return error_response
+
+        await UserSubscription.objects.acreate(user=request.user, city=subscription_city,
+                                               weather_info=subscription_weather,
+                                               notification_frequency=subscription_data['notification_frequency'])
+        return JsonResponse({'res': 'New subscription created successfully'}, status=status.HTTP_201_CREATED)
+
+
+class AsyncSubscriptionActionsView(AsyncSubscriptionView):
+    """Async version of `SubscriptionActionsView.put`."""
+    serializer_class = SubscriptionUpdateSerializer
+
+    async def put(self, request, id):
+        """Handle PUT requests for editing user subscriptions."""
+        does_not_exist = JsonResponse({"res": f"Subscription with id={id} does not exist for this user"},
+                                      status=status.HTTP_400_BAD_REQUEST)
+        # checked without a lock first, so that editing a foreign or missing subscription
+        # neither spends provider budget nor creates a city
+        if not await UserSubscription.objects.filter(id=id, user=request.user).aexists():
+            return does_not_exist
+
+        subscription_data, error_response = self.get_validated_data(request)
+        if error_response is not None:
+            return error_response
+
+        city_data = subscription_data['city']
+        subscription_city, subscription_weather, error_response = await self.get_city_weather(
+            city_data, *await aget_known_city(city_data))
+        if error_response is not None:
+            return error_response
+
+        # the async ORM has no transactions, so the locked save runs in a database thread
+        if not await sync_to_async(edit_subscription)(request.user, id, subscription_city, subscription_weather,
+                                                      subscription_data.get('notification_frequency')):
+            return does_not_exist
+        return JsonResponse({"res": "Subscription edited"}, status=status.HTTP_200_OK)
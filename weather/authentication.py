@@ -0,0 +1,146 @@
+import base64
+import copy
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from rest_framework_simplejwt.utils import datetime_from_epoch
+
+from .cache import LocalTTLCache
+
+# Verified access tokens by jti, each kept until it expires
+_tokens = LocalTTLCache(settings.WEATHER_AUTH_TOKEN_CACHE_SIZE)
+# Users resolved from access tokens by user id, dropped when they are saved or deleted
+_users = LocalTTLCache(settings.WEATHER_AUTH_USER_CACHE_SIZE)
+
+
+def unverified_claims(raw_token):
+    """Read the claims of a JWT without verifying it, or return None if it is malformed."""
+    try:
+        payload = raw_token.split(b'.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + b'=' * (-len(payload) % 4)))
+    except (IndexError, ValueError):
+        return None
+    return claims if isinstance(claims, dict) else None
+
+
+class LazyKeyTokenMixin:
+    """Sign and verify tokens with `weather.token_backend`, which parses the RSA keys on first use."""
+
+    @property
+    def token_backend(self):
+        return import_string('weather.token_backend.token_backend')
+
+
+class LazyKeyAccessToken(LazyKeyTokenMixin, AccessToken):
+    pass
+
+
+class LazyKeyRefreshToken(LazyKeyTokenMixin, RefreshToken):
+    access_token_class = LazyKeyAccessToken
+
+
+class LazyKeyTokenObtainPairSerializer(TokenObtainPairSerializer):
+    """`TokenObtainPairSerializer` issuing tokens signed with `weather.token_backend`."""
+    token_class = LazyKeyRefreshToken
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    `JWTAuthentication` that verifies every access token once per process and caches the users it resolves.
+
+    Verified tokens are kept by their `jti` until they expire, in a bounded LRU of
+    `WEATHER_AUTH_TOKEN_CACHE_SIZE` entries. A cached token is only used for the exact
+    token it was verified from, so a forged token reusing a `jti` is verified as usual.
+    Users are kept for `WEATHER_AUTH_USER_CACHE_TTL` seconds; saving or deleting a user
+    drops them at once in this process, other processes see the change after the TTL.
+    """
+
+    def get_validated_token(self, raw_token):
+        claims = unverified_claims(raw_token)
+        jti = claims.get(api_settings.JTI_CLAIM) if claims else None
+        if jti is None:
+            return super().get_validated_token(raw_token)
+
+        digest = hashlib.sha256(raw_token).digest()
+        cached = _tokens.get(jti)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+
+        validated_token = super().get_validated_token(raw_token)
+        ttl = validated_token['exp'] - time.time()
+        if ttl > 0:
+            _tokens.set(jti, (digest, validated_token), ttl)
+        return validated_token
+
+    def get_user(self, validated_token):
+        user_id = validated_token.get(api_settings.USER_ID_CLAIM)
+        user = _users.get(user_id) if user_id is not None else None
+        if user is None:
+            user = super().get_user(validated_token)
+            _users.set(user_id, user, settings.WEATHER_AUTH_USER_CACHE_TTL)
+        # requests get their own copy, so changes made while handling one do not leak into others
+        return copy.copy(user)
+
+
+def blacklisted_key(jti):
+    return f"blacklisted-token:{jti}"
+
+
+class CachedBlacklistRefreshToken(LazyKeyRefreshToken):
+    """
+    `RefreshToken` that remembers blacklisted tokens in the `WEATHER_TOKEN_BLACKLIST_CACHE_ALIAS` cache.
+
+    A replayed or stolen token that was rotated already is rejected from the cache without a
+    query; tokens the cache does not know are still checked against the database, so losing
+    the cache only costs that query.
+
+    Tokens that are not blacklisted are not cached: with `ROTATE_REFRESH_TOKENS` and
+    `BLACKLIST_AFTER_ROTATION` every refresh blacklists the token it used, so a token passes this
+    check once and would never be read from the cache again. That one check is a lookup of the
+    unique `jti` index, whose cost stays flat as the table grows.
+    """
+
+    def check_blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        if caches[settings.WEATHER_TOKEN_BLACKLIST_CACHE_ALIAS].get(blacklisted_key(jti)):
+            raise TokenError(_("Token is blacklisted"))
+        super().check_blacklist()
+
+    def blacklist(self):
+        jti = self.payload[api_settings.JTI_CLAIM]
+        expires_at = datetime_from_epoch(self.payload['exp'])
+        token = OutstandingToken.objects.get_or_create(jti=jti, defaults={'token': str(self),
+                                                                          'expires_at': expires_at})[0]
+        # one insert instead of get_or_create's lookup and savepoint; the token was checked by `verify` already
+        BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token)], ignore_conflicts=True)
+        ttl = self.payload['exp'] - time.time()
+        if ttl > 0:
+            caches[settings.WEATHER_TOKEN_BLACKLIST_CACHE_ALIAS].set(blacklisted_key(jti), True, ttl)
+        return token
+
+
+class CachedBlacklistTokenRefreshSerializer(TokenRefreshSerializer):
+    """`TokenRefreshSerializer` rotating tokens with `CachedBlacklistRefreshToken`."""
+    token_class = CachedBlacklistRefreshToken
+
+
+def forget_user(sender, instance, **kwargs):
+    """Signal handler dropping a saved or deleted user from the authentication cache."""
+    _users.delete(getattr(instance, api_settings.USER_ID_FIELD))
+
+
+def clear_authentication_cache():
+    """Drop all cached tokens and users of this process."""
+    _tokens.clear()
+    _users.clear()
@@ -0,0 +1,200 @@
+import csv
+import io
+from datetime import timedelta
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from .managers import location_key, normalize_city_data
+from .models import CityName, CityWeather, UserSubscription
+from .serializers import OneSubscriptionSerializer
+from .tasks import import_pending_subscriptions, save_weather_batch
+from .utils import WeatherFetcher
+
+CSV_COLUMNS = ('name', 'state', 'country_code', 'notification_frequency')
+
+
+def parse_csv_rows(text):
+    """
+    Read subscription rows from CSV text with a `CSV_COLUMNS` header.
+
+    :return: A list of subscription data dicts shaped like the JSON accepted by the API.
+    """
+    return [
+        {
+            'city': {'name': row.get('name'), 'state': row.get('state') or '',
+                     'country_code': row.get('country_code')},
+            'notification_frequency': row.get('notification_frequency'),
+        }
+        for row in csv.DictReader(io.StringIO(text))
+    ]
+
+
+def fetch_cities(locations, blocking=False):
+    """
+    Fetch the weather of cities concurrently and store the cities found together with their weather.
+
+    :param locations: A dict mapping location keys to normalized city data dicts.
+    :param blocking: Whether lookups over the shared rate budget wait for it, instead of failing
+        at once with a 429 response.
+    :return: A `(cities, failures)` tuple: a dict mapping the location keys of the cities found to
+        the stored cities, and a dict mapping the others to their `(weather_data, code)` provider response.
+    """
+    keys = list(locations)
+    with WeatherFetcher(blocking=blocking) as fetcher:
+        responses = fetcher.fetch([locations[key] for key in keys])
+    found = {key: weather_data for key, (weather_data, code) in zip(keys, responses) if code == 200}
+    failures = {key: response for key, response in zip(keys, responses) if response[1] != 200}
+
+    # cities are created in one statement; rows inserted meanwhile by another request are kept
+    CityName.objects.bulk_create([CityName(name=locations[key]['name'], state=locations[key]['state'],
+                                           country_code=locations[key]['country_code']) for key in found],
+                                 ignore_conflicts=True)
+    cities = CityName.objects.find_many(locations[key] for key in found)
+    save_weather_batch([(cities[key], weather_data) for key, weather_data in found.items() if key in cities])
+    return cities, failures
+
+
+def import_subscriptions(user, rows, max_lookups=None):
+    """
+    Create subscriptions of a user from a list of rows in a constant number of queries per fetched batch.
+
+    Cities are looked up in one query, and rows of cities the user is already subscribed to are
+    rejected before anything is fetched. Unknown cities and cities with weather older than
+    `WEATHER_MAX_STALENESS` seconds are fetched from the provider concurrently,
+    `WEATHER_FETCH_BATCH_SIZE` at a time, and all new subscriptions are inserted with a single
+    `bulk_create`.
+
+    With `max_lookups`, at most that many cities are fetched, cities without weather first, and
+    none of them waits for the shared rate budget: further cities with stored weather keep it until
+    the next refresh, and rows of further cities without weather are handed to the
+    `import_pending_subscriptions` task and reported as pending. Without it, every city is fetched,
+    waiting for the rate budget as needed.
+
+    :param user: The user subscribing.
+    :param rows: Subscription data dicts, as accepted by `OneSubscriptionSerializer`.
+    :param max_lookups: The most cities to fetch, None for all of them.
+    :return: A list with the result of every row, in the order of `rows`.
+    """
+    results = [None] * len(rows)
+    frequencies = {}
+    locations = {}
+    row_keys = {}
+    for index, row in enumerate(rows):
+        serializer = OneSubscriptionSerializer(data=row)
+        if not serializer.is_valid():
+            results[index] = {'row': index, 'status': 'error', 'error': serializer.errors}
+            continue
+        key = location_key(serializer.validated_data['city'])
+        if key in locations:
+            results[index] = {'row': index, 'status': 'error', 'error': 'Duplicate of an earlier row'}
+            continue
+        name, state, country_code = normalize_city_data(serializer.validated_data['city'])
+        locations[key] = {'name': name, 'state': state, 'country_code': country_code}
+        frequencies[key] = serializer.validated_data['notification_frequency']
+        row_keys[key] = index
+
+    cities = CityName.objects.find_many(locations.values())
+    subscribed_city_ids = set(UserSubscription.objects.filter(user=user, city__in=list(cities.values()))
+                              .values_list('city_id', flat=True))
+    for key in [key for key, city in cities.items() if city.id in subscribed_city_ids]:
+        results[row_keys[key]] = {'row': row_keys[key], 'status': 'error',
+                                  'error': 'You are already subscribed to this city'}
+        del locations[key], row_keys[key], cities[key]
+
+    stale_before = timezone.now() - timedelta(seconds=settings.WEATHER_MAX_STALENESS)
+    updated_at = dict(CityWeather.objects.filter(city__in=list(cities.values()))
+                      .values_list('city_id', 'last_info_update'))
+    without_weather = [key for key in locations if key not in cities or cities[key].id not in updated_at]
+    stale = [key for key in locations if key in cities and cities[key].id in updated_at
+             and updated_at[cities[key].id] <= stale_before]
+    lookups = without_weather + stale
+    deferred = []
+    if max_lookups is not None:
+        lookups, deferred = lookups[:max_lookups], without_weather[max_lookups:]
+    failures = {}
+    for start in range(0, len(lookups), settings.WEATHER_FETCH_BATCH_SIZE):
+        batch = lookups[start:start + settings.WEATHER_FETCH_BATCH_SIZE]
+        fetched_cities, batch_failures = fetch_cities({key: locations[key] for key in batch},
+                                                      blocking=max_lookups is None)
+        cities.update(fetched_cities)
+        failures.update(batch_failures)
+    for key, (weather_data, code) in failures.items():
+        if code == 429 and max_lookups is not None:
+            # lookups refused by the rate budget are made in the background as well
+            deferred.append(key)
+        else:
+            results[row_keys[key]] = {'row': row_keys[key], 'status': 'error', 'error': weather_data['message'],
+                                      'code': code}
+    for key in deferred:
+        results[row_keys[key]] = {'row': row_keys[key], 'status': 'pending'}
+
+    weather_ids = dict(CityWeather.objects.filter(city__in=list(cities.values())).values_list('city_id', 'id'))
+    now = timezone.now()
+    new_subscriptions = []
+    for key, index in row_keys.items():
+        if results[index] is not None:
+            continue
+        city = cities.get(key)
+        if city is None or city.id not in weather_ids:
+            results[index] = {'row': index, 'status': 'error', 'error': 'City weather could not be stored'}
+            continue
+        subscription = UserSubscription(user=user, city=city, weather_info_id=weather_ids[city.id],
+                                        notification_frequency=frequencies[key])
+        # bulk_create does not call save(), so the first notification is scheduled here
+        subscription.schedule_next_notification(now)
+        new_subscriptions.append((index, subscription))
+
+    UserSubscription.objects.bulk_create([subscription for _, subscription in new_subscriptions])
+    for index, subscription in new_subscriptions:
+        results[index] = {'row': index, 'status': 'created', 'id': subscription.id}
+    if deferred:
+        import_pending_subscriptions.delay(user.id, [rows[row_keys[key]] for key in deferred])
+    return results
+
+
+class Echo:
+    """File-like object returning what is written to it, to stream `csv.writer` output."""
+
+    def write(self, value):
+        return value
+
+
+def export_queryset(user):
+    """The exported columns of the subscriptions of a user, in `CSV_COLUMNS` order."""
+    return (UserSubscription.objects.filter(user=user).order_by('id')
+            .values_list('city__name', 'city__state', 'city__country_code', 'notification_frequency'))
+
+
+def export_subscriptions_csv(user):
+    """
+    Yield the subscriptions of a user as CSV lines, in the format accepted by the import.
+
+    Rows are read from a server-side cursor `WEATHER_EXPORT_CHUNK_SIZE` at a time, so memory
+    use does not grow with the number of subscriptions.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    for row in export_queryset(user).iterator(chunk_size=settings.WEATHER_EXPORT_CHUNK_SIZE):
+        yield writer.writerow(row)
+
+
+async def aexport_subscriptions_csv(user):
+    """
+    Async version of `export_subscriptions_csv`, streamed by ASGI servers without buffering.
+
+    Chunks of rows are read in the database thread, as `QuerySet.aiterator` does; on Django 4.2
+    `aiterator` runs the query of a `values_list` on the event loop, which Django refuses.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_COLUMNS)
+    chunk_size = settings.WEATHER_EXPORT_CHUNK_SIZE
+    rows = export_queryset(user).iterator(chunk_size=chunk_size)
+    while True:
+        chunk = await sync_to_async(list)(islice(rows, chunk_size))
+        for row in chunk:
+            yield writer.writerow(row)
+        if len(chunk) < chunk_size:
+            return
@@ -0,0 +1,118 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+NOT_FOUND_CODES = (404, '404')
+
+
+class LocalTTLCache:
+    """Bounded, thread-safe in-process LRU whose entries expire after their own TTL."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value stored under `key`, or None if it is missing or expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class WeatherCache:
+    """
+    Cache of weather provider responses keyed by the normalized city location.
+
+    An in-process LRU tier sits in front of a shared tier (the Django cache named by
+    `WEATHER_CACHE_ALIAS`). Successful responses live for `WEATHER_CACHE_TTL` seconds,
+    "city not found" responses for `WEATHER_CACHE_NEGATIVE_TTL`; other errors are not cached.
+    """
+
+    def __init__(self):
+        self.local = LocalTTLCache(settings.WEATHER_CACHE_LOCAL_SIZE)
+
+    @property
+    def shared(self):
+        return caches[settings.WEATHER_CACHE_ALIAS]
+
+    @staticmethod
+    def make_key(city_data):
+        """Build a cache key from the city name, state and country code, ignoring case and spacing."""
+        location = '|'.join([
+            ' '.join(city_data['name'].split()).casefold(),
+            city_data.get('state', '').strip().upper(),
+            city_data['country_code'].strip().upper(),
+        ])
+        return f"weather:{hashlib.sha1(location.encode()).hexdigest()}"
+
+    def get(self, city_data):
+        """
+        Return the cached `(weather_data, code)` response for a city, or None on a miss.
+        """
+        key = self.make_key(city_data)
+        response = self.local.get(key)
+        if response is None:
+            response = self.shared.get(key)
+            if response is None:
+                return None
+            self.local.set(key, response, settings.WEATHER_CACHE_LOCAL_TTL)
+        weather_data, code = response
+        return dict(weather_data), code
+
+    def set(self, city_data, weather_data, code):
+        """Store a provider response if it is cacheable."""
+        if code == 200:
+            ttl = settings.WEATHER_CACHE_TTL
+        elif code in NOT_FOUND_CODES:
+            ttl = settings.WEATHER_CACHE_NEGATIVE_TTL
+        else:
+            return
+        key = self.make_key(city_data)
+        response = (dict(weather_data), code)
+        self.shared.set(key, response, ttl)
+        self.local.set(key, response, min(ttl, settings.WEATHER_CACHE_LOCAL_TTL))
+
+    def clear(self):
+        """Drop the in-process tier. The shared tier expires on its own."""
+        self.local.clear()
+
+
+_weather_cache = None
+_weather_cache_lock = threading.Lock()
+
+
+def get_weather_cache():
+    """Return the weather cache of this process."""
+    global _weather_cache
+    if _weather_cache is None:
+        with _weather_cache_lock:
+            if _weather_cache is None:
+                _weather_cache = WeatherCache()
+    return _weather_cache
@@ -2,3 +2,4 @@ MAX_NAME_LENGTH = 150
 COUNTRY_CODE_LENGTH = 2
 STATE_LENGTH = 2
 EMAIL_SUBJECT = "Weather report"
+OWM_GROUP_SIZE = 20
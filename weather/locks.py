@@ -0,0 +1,76 @@
+import logging
+import threading
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class Lease:
+    """
+    Expiring lock on a named resource, held in the cache named by `WEATHER_LOCK_CACHE_ALIAS`.
+
+    A lease is acquired with an atomic `cache.add`, so only one holder at a time gets it.
+    The holder keeps it alive with `renew` (or `heartbeat`) and gives it up with `release`;
+    if the holder dies, the lease expires after `ttl` seconds and the resource is free again.
+    The token identifies the holder and can be handed to other processes (e.g. Celery
+    subtasks) so they renew or release the same lease.
+
+    The cache must be shared by all workers (Redis in production) for the lease to
+    be exclusive across processes.
+    """
+
+    def __init__(self, name, ttl, token=None):
+        self.key = f"lease:{name}"
+        self.ttl = ttl
+        self.token = token or uuid.uuid4().hex
+
+    @property
+    def cache(self):
+        return caches[settings.WEATHER_LOCK_CACHE_ALIAS]
+
+    def acquire(self):
+        """Try to take the lease. Return True on success, False if somebody else holds it."""
+        return self.cache.add(self.key, self.token, self.ttl)
+
+    def is_held(self):
+        """Return whether the lease is currently held with this token."""
+        return self.cache.get(self.key) == self.token
+
+    def renew(self):
+        """
+        Extend the lease by another `ttl` seconds if it is still held with this token.
+
+        The check and the extension are two cache calls; a heartbeat interval well
+        below the TTL keeps the lease from expiring in between.
+        """
+        if not self.is_held():
+            return False
+        self.cache.set(self.key, self.token, self.ttl)
+        return True
+
+    def release(self):
+        """Give the lease up if it is still held with this token."""
+        if self.is_held():
+            self.cache.delete(self.key)
+
+    @contextmanager
+    def heartbeat(self, interval=None):
+        """Renew the lease from a background thread every `interval` seconds while the block runs."""
+        stop = threading.Event()
+        interval = interval or self.ttl / 3
+
+        def beat():
+            while not stop.wait(interval):
+                if not self.renew():
+                    logging.warning(f"Lease {self.key} was lost")
+                    return
+
+        thread = threading.Thread(target=beat, name=f"heartbeat-{self.key}", daemon=True)
+        thread.start()
+        try:
+            yield self
+        finally:
+            stop.set()
+            thread.join()
@@ -1,4 +1,7 @@
 from django.contrib.auth.base_user import BaseUserManager
+from django.db import models
+from django.db.models.functions import Upper
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
@@ -9,9 +12,6 @@ class CustomUserManager(BaseUserManager):
 
         email = self.normalize_email(email)
 
-        if self.model.objects.filter(email=email).exists():
-            raise ValueError(_('User with this email already exists'))
-
         user = self.model(email=email, **extra_fields)
         user.set_password(password)
         user.save(using=self._db)
@@ -26,3 +26,78 @@ class CustomUserManager(BaseUserManager):
             raise ValueError(_('Superuser must have is_staff=True.'))
         if not extra_fields.get('is_superuser'):
             raise ValueError(_('Superuser must have is_superuser=True.'))
+
+
+class UserSubscriptionQuerySet(models.QuerySet):
+    def due(self, now=None):
+        """Subscriptions whose next notification time has passed, with the rows needed to notify them."""
+        return (self.filter(next_notify_at__lte=now or timezone.now())
+                .select_related('user', 'city', 'weather_info')
+                .order_by('next_notify_at', 'id'))
+
+
+def normalize_city_data(city_data):
+    """Return the (name, state, country_code) of a city in the form it is stored in."""
+    return (
+        ' '.join(city_data['name'].split()),
+        city_data.get('state', '').strip().upper(),
+        city_data['country_code'].strip().upper(),
+    )
+
+
+def location_key(city_data):
+    """Return the key two city data dicts share if they resolve to the same city."""
+    name, state, country_code = normalize_city_data(city_data)
+    return name.upper(), state, country_code
+
+
+class CityNameManager(models.Manager):
+    def find(self, city_data):
+        """Return the existing city matching `city_data`, or None. Uses the same index as `resolve`."""
+        name, state, country_code = normalize_city_data(city_data)
+        return self.filter(name__iexact=name, state=state, country_code=country_code).first()
+
+    async def afind(self, city_data):
+        """Async version of `find`."""
+        name, state, country_code = normalize_city_data(city_data)
+        return await self.filter(name__iexact=name, state=state, country_code=country_code).afirst()
+
+    def resolve(self, city_data):
+        """
+        Get the city matching `city_data`, creating it if it does not exist yet.
+
+        The lookup is case-insensitive on the name and served by the unique
+        (UPPER(name), state, country_code) index, which also makes concurrent
+        resolutions of the same new city end up with a single row.
+
+        :return: A `(city, created)` tuple.
+        """
+        name, state, country_code = normalize_city_data(city_data)
+        return self.get_or_create(name__iexact=name, state=state, country_code=country_code,
+                                  defaults={'name': name})
+
+    async def aresolve(self, city_data):
+        """Async version of `resolve`."""
+        name, state, country_code = normalize_city_data(city_data)
+        return await self.aget_or_create(name__iexact=name, state=state, country_code=country_code,
+                                         defaults={'name': name})
+
+    def find_many(self, cities_data):
+        """
+        Look several cities up in one query.
+
+        :param cities_data: An iterable of city data dicts.
+        :return: A dict mapping the `location_key` of every city found to the city.
+        """
+        locations = {location_key(city_data) for city_data in cities_data}
+        if not locations:
+            return {}
+        candidates = (self.annotate(upper_name=Upper('name'))
+                      .filter(upper_name__in={name for name, _, _ in locations},
+                              country_code__in={country_code for _, _, country_code in locations}))
+        cities = {}
+        for city in candidates:
+            key = (city.upper_name, city.state, city.country_code)
+            if key in locations:
+                cities[key] = city
+        return cities
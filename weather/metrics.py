@@ -0,0 +1,239 @@
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest,
+                               multiprocess, start_http_server)
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds of the buckets of duration histograms in seconds and of count histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Totals kept per request and per task run
+SCOPE_TOTALS = ('queries', 'query_seconds', 'provider_calls', 'provider_seconds', 'emails', 'email_seconds',
+                'cities', 'subscriptions')
+
+# The scope of the request or task run being handled in the current context
+_scope = ContextVar('weather_metrics_scope', default=None)
+# Scopes of the task runs in progress in this process with their context tokens, by task id
+_task_scopes = {}
+
+
+def enabled():
+    return settings.WEATHER_METRICS_ENABLED
+
+
+REQUEST_DURATION = Histogram('weather_request_duration_seconds', 'Time spent handling requests.',
+                             ('view', 'method', 'status'), buckets=DURATION_BUCKETS)
+REQUEST_QUERIES = Histogram('weather_request_queries', 'Database queries run per request.', ('view', 'method'),
+                            buckets=COUNT_BUCKETS)
+REQUEST_QUERY_DURATION = Histogram('weather_request_query_duration_seconds',
+                                   'Time spent in database queries per request.', ('view', 'method'),
+                                   buckets=DURATION_BUCKETS)
+TASK_DURATION = Histogram('weather_task_duration_seconds', 'Time spent running tasks.', ('task', 'state'),
+                          buckets=DURATION_BUCKETS)
+TASK_QUERIES = Histogram('weather_task_queries', 'Database queries run per task run.', ('task',),
+                         buckets=COUNT_BUCKETS)
+TASK_QUERY_DURATION = Histogram('weather_task_query_duration_seconds', 'Time spent in database queries per task run.',
+                                ('task',), buckets=DURATION_BUCKETS)
+TASK_PROCESSED = Counter('weather_task_processed', 'Cities and subscriptions processed by tasks.', ('task', 'item'))
+PROVIDER_DURATION = Histogram('weather_provider_request_duration_seconds',
+                              'Latency of weather provider calls, retries included.', ('endpoint', 'status'),
+                              buckets=DURATION_BUCKETS)
+EMAIL_DURATION = Histogram('weather_email_send_duration_seconds', 'Time spent sending one weather report.',
+                           ('status',), buckets=DURATION_BUCKETS)
+EMAIL_BATCH_SIZE = Histogram('weather_email_batch_size', 'Weather reports sent per SMTP batch.',
+                             buckets=COUNT_BUCKETS)
+
+
+def collector_registry():
+    """
+    The registry to expose.
+
+    Web and worker processes run in parallel, so with `PROMETHEUS_MULTIPROC_DIR` set each of them
+    writes its metrics there and the registry collects those of all of them; otherwise it holds the
+    metrics of this process only.
+    """
+    if not os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+class Scope:
+    """Totals of one request or task run, shared by the threads and coroutines working on it."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.totals = dict.fromkeys(SCOPE_TOTALS, 0)
+        self.lock = threading.Lock()
+
+    def add(self, **amounts):
+        with self.lock:
+            for key, amount in amounts.items():
+                self.totals[key] += amount
+
+    def finish(self, kind, **labels):
+        """Log the totals of the scope as one JSON line and return its duration in seconds."""
+        duration = time.perf_counter() - self.started
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({'kind': kind, **labels, 'duration': round(duration, 6),
+                                    **{key: round(value, 6) for key, value in self.totals.items()}}))
+        return duration
+
+
+def count(**amounts):
+    """Add processed items, e.g. `count(cities=10)`, to the current request or task run."""
+    scope = _scope.get()
+    if scope is not None:
+        scope.add(**amounts)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper adding the number and duration of queries to the current scope."""
+    scope = _scope.get()
+    if scope is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        scope.add(queries=1, query_seconds=time.perf_counter() - started)
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """Signal handler adding `record_query` to every new database connection."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def record_provider_call(endpoint, status, seconds):
+    """Record a weather provider call, `status` being its HTTP status or 'error' if it got none."""
+    if not enabled():
+        return
+    PROVIDER_DURATION.labels(endpoint=endpoint, status=status).observe(seconds)
+    count(provider_calls=1, provider_seconds=seconds)
+
+
+def record_email(status, seconds):
+    """Record the sending of one weather report, `status` being 'sent' or 'failed'."""
+    if not enabled():
+        return
+    EMAIL_DURATION.labels(status=status).observe(seconds)
+    count(emails=1, email_seconds=seconds)
+
+
+def record_email_batch(size):
+    if enabled():
+        EMAIL_BATCH_SIZE.observe(size)
+
+
+class MetricsMiddleware:
+    """Record the duration and database queries of every request, labelled by its URL name."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not enabled():
+            return self.get_response(request)
+        scope = Scope()
+        token = _scope.set(scope)
+        try:
+            response = self.get_response(request)
+        finally:
+            _scope.reset(token)
+        self.finish(scope, request, response)
+        return response
+
+    async def __acall__(self, request):
+        if not enabled():
+            return await self.get_response(request)
+        scope = Scope()
+        token = _scope.set(scope)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _scope.reset(token)
+        self.finish(scope, request, response)
+        return response
+
+    @staticmethod
+    def finish(scope, request, response):
+        # streamed responses are measured until their first byte
+        view = request.resolver_match.url_name if request.resolver_match else 'unmatched'
+        duration = scope.finish('request', view=view, method=request.method, status=response.status_code)
+        REQUEST_DURATION.labels(view=view, method=request.method, status=response.status_code).observe(duration)
+        REQUEST_QUERIES.labels(view=view, method=request.method).observe(scope.totals['queries'])
+        REQUEST_QUERY_DURATION.labels(view=view, method=request.method).observe(scope.totals['query_seconds'])
+
+
+def start_task(task_id=None, **kwargs):
+    """`task_prerun` handler opening the scope of a task run."""
+    if not enabled():
+        return
+    scope = Scope()
+    _task_scopes[task_id] = (scope, _scope.set(scope))
+
+
+def finish_task(task_id=None, task=None, state=None, **kwargs):
+    """`task_postrun` handler recording the task run."""
+    started = _task_scopes.pop(task_id, None)
+    if started is None:
+        return
+    scope, token = started
+    _scope.reset(token)
+    duration = scope.finish('task', task=task.name, state=state)
+    TASK_DURATION.labels(task=task.name, state=state).observe(duration)
+    TASK_QUERIES.labels(task=task.name).observe(scope.totals['queries'])
+    TASK_QUERY_DURATION.labels(task=task.name).observe(scope.totals['query_seconds'])
+    for item in ('cities', 'subscriptions'):
+        if scope.totals[item]:
+            TASK_PROCESSED.labels(task=task.name, item=item).inc(scope.totals[item])
+
+
+def start_worker_server(sender=None, **kwargs):
+    """
+    `worker_ready` handler serving the metrics of a Celery worker over HTTP on `WEATHER_METRICS_WORKER_PORT`.
+
+    With `PROMETHEUS_MULTIPROC_DIR` set, they include the task runs of all its pool processes.
+    The port is meant to be reachable from the internal network only, it is not authenticated.
+
+    :return: The HTTP server, or None if none was started.
+    """
+    if not enabled() or not settings.WEATHER_METRICS_WORKER_PORT:
+        return None
+    server, _ = start_http_server(settings.WEATHER_METRICS_WORKER_PORT, registry=collector_registry())
+    return server
+
+
+def metrics_view(request):
+    """
+    Serve the metrics of this process, or of all processes sharing `PROMETHEUS_MULTIPROC_DIR`, to Prometheus.
+
+    The web app is public, so the metrics are only served to requests bearing `WEATHER_METRICS_TOKEN`,
+    and not at all while it is empty.
+    """
+    if not enabled() or not settings.WEATHER_METRICS_TOKEN:
+        raise Http404
+    authorization = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {settings.WEATHER_METRICS_TOKEN}".encode()):
+        return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(generate_latest(collector_registry()), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+def remove_duplicate_city_weather(apps, schema_editor):
+    """Keep only the latest weather row of every city, pointing subscriptions at it."""
+    CityWeather = apps.get_model('weather', 'CityWeather')
+    UserSubscription = apps.get_model('weather', 'UserSubscription')
+
+    duplicated_cities = (CityWeather.objects.values('city')
+                         .annotate(count=models.Count('id'))
+                         .filter(count__gt=1)
+                         .values_list('city', flat=True))
+    for city_id in duplicated_cities:
+        rows = list(CityWeather.objects.filter(city_id=city_id).order_by('-id').values_list('id', flat=True))
+        kept, stale = rows[0], rows[1:]
+        UserSubscription.objects.filter(weather_info_id__in=stale).update(weather_info_id=kept)
+        CityWeather.objects.filter(id__in=stale).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0002_cityname_cityweather_usersubscription'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_city_weather, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cityweather',
+            constraint=models.UniqueConstraint(fields=('city',), name='unique_city_weather'),
+        ),
+    ]
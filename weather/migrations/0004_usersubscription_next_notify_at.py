@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def fill_next_notify_at(apps, schema_editor):
+    """Derive the next notification time of existing subscriptions from their last update."""
+    UserSubscription = apps.get_model('weather', 'UserSubscription')
+
+    subscriptions = []
+    for subscription in UserSubscription.objects.only('id', 'last_info_update', 'notification_frequency').iterator():
+        subscription.next_notify_at = (subscription.last_info_update
+                                       + timedelta(hours=subscription.notification_frequency))
+        subscriptions.append(subscription)
+        if len(subscriptions) == 1000:
+            UserSubscription.objects.bulk_update(subscriptions, ['next_notify_at'])
+            subscriptions = []
+    UserSubscription.objects.bulk_update(subscriptions, ['next_notify_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0003_cityweather_unique_city'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='usersubscription',
+            name='last_info_update',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='usersubscription',
+            name='next_notify_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(fill_next_notify_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='usersubscription',
+            name='next_notify_at',
+            field=models.DateTimeField(),
+        ),
+        migrations.AddIndex(
+            model_name='usersubscription',
+            index=models.Index(fields=['next_notify_at', 'id'], name='subscription_next_notify_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+import django.db.models.functions.text
+
+
+def merge_duplicate_cities(apps, schema_editor):
+    """
+    Normalize stored city locations and merge cities that only differ in case or spacing.
+
+    Subscriptions of a merged city move to the kept one; its weather row is dropped unless
+    the kept city has none.
+    """
+    CityName = apps.get_model('weather', 'CityName')
+    CityWeather = apps.get_model('weather', 'CityWeather')
+    UserSubscription = apps.get_model('weather', 'UserSubscription')
+
+    kept_cities = {}
+    for city in CityName.objects.order_by('id').iterator():
+        name = ' '.join(city.name.split())
+        state = city.state.strip().upper()
+        country_code = city.country_code.strip().upper()
+        location = (name.upper(), state, country_code)
+
+        kept = kept_cities.get(location)
+        if kept is None:
+            kept_cities[location] = city
+            if (name, state, country_code) != (city.name, city.state, city.country_code):
+                CityName.objects.filter(id=city.id).update(name=name, state=state, country_code=country_code)
+            continue
+
+        if not CityWeather.objects.filter(city_id=kept.id).exists():
+            CityWeather.objects.filter(city_id=city.id).update(city_id=kept.id)
+        kept_weather = CityWeather.objects.filter(city_id=kept.id).first()
+        UserSubscription.objects.filter(city_id=city.id).update(
+            city_id=kept.id, weather_info_id=kept_weather.id if kept_weather else None)
+        city.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0004_usersubscription_next_notify_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_cities, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cityname',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Upper('name'), 'state', 'country_code',
+                                               name='unique_city_location'),
+        ),
+    ]
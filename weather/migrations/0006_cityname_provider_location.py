@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0005_cityname_unique_city_location'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cityname',
+            name='provider_id',
+            field=models.BigIntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cityname',
+            name='latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='cityname',
+            name='longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('weather', '0006_cityname_provider_location'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slot', models.DateTimeField()),
+                ('status', models.CharField(choices=[('claimed', 'Claimed'), ('delivered', 'Delivered'),
+                                                     ('failed', 'Failed')], default='claimed', max_length=9)),
+                ('claim_token', models.UUIDField(db_index=True)),
+                ('claimed_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('subscription', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                   related_name='notifications', to='weather.usersubscription')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='notification',
+            constraint=models.UniqueConstraint(fields=('subscription', 'slot'), name='unique_notification_slot'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Index the expiry of simplejwt's outstanding tokens, so that `prune_expired_tokens` walks the
+    expired tokens instead of scanning the table. The model belongs to simplejwt, so the index is
+    created with SQL.
+    """
+
+    dependencies = [
+        ('weather', '0007_notification'),
+        ('token_blacklist', '0012_alter_outstandingtoken_user'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX weather_outstandingtoken_expiry ON token_blacklist_outstandingtoken (expires_at, id)',
+            'DROP INDEX weather_outstandingtoken_expiry',
+        ),
+    ]
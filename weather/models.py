@@ -1,10 +1,14 @@
+from datetime import timedelta
+
 from django.db import models
+from django.db.models.functions import Upper
 from django.contrib.auth.models import AbstractUser
 from django.utils.translation import gettext_lazy as _
 from django.conf import settings
+from django.utils import timezone
 
 from .constants import MAX_NAME_LENGTH, COUNTRY_CODE_LENGTH, STATE_LENGTH
-from .managers import CustomUserManager
+from .managers import CityNameManager, CustomUserManager, UserSubscriptionQuerySet
 
 
 class CustomUser(AbstractUser):
@@ -28,10 +32,33 @@ class CityName(models.Model):
     name = models.CharField(max_length=MAX_NAME_LENGTH)
     country_code = models.CharField(max_length=COUNTRY_CODE_LENGTH)
     state = models.CharField(max_length=STATE_LENGTH, blank=True)
+    provider_id = models.BigIntegerField(null=True, blank=True, db_index=True)
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+
+    objects = CityNameManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Upper('name'), 'state', 'country_code', name='unique_city_location'),
+        ]
 
     def __str__(self):
         return f"{self.name}, {self.state}, {self.country_code}"
 
+    def remember_provider_location(self, weather_data):
+        """
+        Keep the provider city id and coordinates from fetched weather data.
+
+        :return: True if the city was missing them and they were set.
+        """
+        if self.provider_id is not None or weather_data.get('provider_id') is None:
+            return False
+        self.provider_id = weather_data['provider_id']
+        self.latitude = weather_data.get('latitude')
+        self.longitude = weather_data.get('longitude')
+        return True
+
 
 class CityWeather(models.Model):
     city = models.ForeignKey(CityName, on_delete=models.CASCADE, related_name="weather")
@@ -47,6 +74,11 @@ class CityWeather(models.Model):
     rain = models.FloatField(blank=True)
     snow = models.FloatField(blank=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['city'], name='unique_city_weather'),
+        ]
+
     def __str__(self):
         return f"city {self.city}, weather: {self.weather_description}, {self.temperature}°C, " \
                f" last update on {self.last_info_update}"
@@ -58,8 +90,63 @@ class UserSubscription(models.Model):
     city = models.ForeignKey(CityName, on_delete=models.CASCADE, related_name="subscriptions")
     weather_info = models.ForeignKey(CityWeather, on_delete=models.CASCADE, related_name="subscriptions", null=True)
     notification_frequency = models.IntegerField()
-    last_info_update = models.DateTimeField(auto_now=True)
+    last_info_update = models.DateTimeField(default=timezone.now, editable=False)
+    next_notify_at = models.DateTimeField()
+
+    objects = UserSubscriptionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_notify_at', 'id'], name='subscription_next_notify_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Any change of a subscription restarts its notification period.
+        self.schedule_next_notification()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'last_info_update', 'next_notify_at'}
+        super().save(*args, **kwargs)
+
+    def schedule_next_notification(self, now=None):
+        """Start a new notification period at `now`."""
+        now = now or timezone.now()
+        self.last_info_update = now
+        self.next_notify_at = now + timedelta(hours=self.notification_frequency)
 
     def __str__(self):
         return f"user {self.user}, city {self.city.name}, notify every {self.notification_frequency}h, " \
                f"last update on {self.last_info_update}"
+
+
+class Notification(models.Model):
+    """
+    Ledger entry of the weather report of a subscription for one scheduled slot.
+
+    A worker claims a slot by inserting its entry before sending, so a slot is sent
+    by one worker only, and marks it delivered or failed afterwards. Claims left by
+    a crashed worker can be taken over once they are older than the claim timeout.
+    """
+    CLAIMED = 'claimed'
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (CLAIMED, 'Claimed'),
+        (DELIVERED, 'Delivered'),
+        (FAILED, 'Failed'),
+    ]
+
+    subscription = models.ForeignKey(UserSubscription, on_delete=models.CASCADE, related_name="notifications")
+    slot = models.DateTimeField()
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default=CLAIMED)
+    claim_token = models.UUIDField(db_index=True)
+    claimed_at = models.DateTimeField(default=timezone.now)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['subscription', 'slot'], name='unique_notification_slot'),
+        ]
+
+    def __str__(self):
+        return f"subscription {self.subscription_id}, slot {self.slot}: {self.status}"
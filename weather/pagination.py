@@ -0,0 +1,9 @@
+from rest_framework.pagination import CursorPagination
+
+
+class SubscriptionCursorPagination(CursorPagination):
+    """Cursor pagination of a user's subscriptions in creation order."""
+    ordering = 'id'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
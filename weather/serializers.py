@@ -1,7 +1,5 @@
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
-from rest_framework.exceptions import ValidationError
-from rest_framework.validators import UniqueValidator
 from django.contrib.auth.password_validation import validate_password
 
 from .models import CustomUser, CityName, CityWeather, UserSubscription
@@ -10,35 +8,25 @@ User = get_user_model()
 
 
 class RegistrationSerializer(serializers.ModelSerializer):
-    email = serializers.EmailField(
-        required=True,
-        validators=[UniqueValidator(queryset=CustomUser.objects.all())]
-    )
+    # uniqueness is left to the unique index on the email column, checked by the insert itself
+    email = serializers.EmailField(required=True)
 
     password = serializers.CharField(write_only=True, required=True, validators=[validate_password])
     password2 = serializers.CharField(write_only=True, required=True)
 
     class Meta:
         model = CustomUser
-        fields = ['email', 'password', 'confirm_password']
+        fields = ['email', 'password', 'password2']
 
     def validate(self, attrs):
-        if attrs['password'] != attrs['confirm_password']:
+        if attrs['password'] != attrs['password2']:
             raise serializers.ValidationError({"password": "Password fields didn't match."})
 
         return attrs
 
     def create(self, validated_data):
-        email = validated_data['email']
-        password = validated_data['password']
-
-        existing_user = User.objects.filter(email=email).first()
-        if existing_user:
-            raise ValidationError("User with this email already exists.")
-
-        user = User.objects.create_user(email=email, password=password)
-
-        return user
+        return User.objects.create_user(email=validated_data['email'], password=validated_data['password'],
+                                        is_active=True)
 
 
 class CityNameSerializer(serializers.ModelSerializer):
@@ -64,6 +52,22 @@ class UserSubscriptionSerializer(serializers.ModelSerializer):
         fields = ['id', 'user', 'city', 'weather_info', 'notification_frequency', 'last_info_update', ]
 
 
+class SubscriptionListSerializer(serializers.ModelSerializer):
+    """Read-only representation of a subscription with its city nested, optionally limited to `fields`."""
+    city = CityNameSerializer(read_only=True)
+
+    class Meta:
+        model = UserSubscription
+        fields = ['id', 'city', 'notification_frequency', ]
+        read_only_fields = fields
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+
 class OneSubscriptionSerializer(serializers.ModelSerializer):
     city = CityNameSerializer()
     notification_frequency = serializers.IntegerField()
@@ -71,3 +75,8 @@ class OneSubscriptionSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserSubscription
         fields = ['city', 'notification_frequency', ]
+
+
+class SubscriptionUpdateSerializer(OneSubscriptionSerializer):
+    """Like `OneSubscriptionSerializer`, but the notification frequency may be left out to keep the current one."""
+    notification_frequency = serializers.IntegerField(required=False)
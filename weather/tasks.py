@@ -1,111 +1,589 @@
-import copy
-from celery import shared_task
+import smtplib
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from datetime import timedelta
+from celery import chord, shared_task
 
-from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.template.loader import render_to_string
-from django.core.mail import send_mail
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.conf import settings
+from rest_framework_simplejwt.token_blacklist.models import OutstandingToken
 import logging
 
+from . import metrics
 from .constants import EMAIL_SUBJECT
-from .models import CityName, CityWeather, UserSubscription
-from .views import get_weather
-from .serializers import CityNameSerializer, CityWeatherSerializer, UserSubscriptionSerializer
+from .locks import Lease
+from .models import CityName, CityWeather, CustomUser, Notification, UserSubscription
+from .utils import WeatherFetcher
 
+# Rendered report bodies keyed by (city id, weather update time), least recently used first
+_rendered_reports = OrderedDict()
+_rendered_reports_lock = threading.Lock()
 
-def update_weather_table():
+
+def cities_to_refresh(now):
     """
-    Update weather data for all cities.
+    Cities whose weather has to be fetched in the refresh run starting at `now`.
 
-    Utilizes serializers to retrieve city and weather data,
-    then calls the weather data update function for each city.
+    These are cities with a subscriber due before the next refresh run, and cities whose
+    stored weather is missing or older than `WEATHER_MAX_STALENESS` seconds. Every city
+    appears once, however many of its subscribers are due.
     """
-    all_cities = CityName.objects.all()
-    paginator = Paginator(all_cities, 100)
-    for page_num in paginator.page_range:
-        cities_page = paginator.page(page_num)
-        for city in cities_page:
-            city_data = CityNameSerializer(city).data
-            weather_data, code = get_weather(city_data)
-            if code != 200:
-                logging.error(f"{weather_data['message']}, 'code': {code}")
-            else:
-                update_city_weather(city, weather_data)
+    horizon = now + timedelta(seconds=settings.WEATHER_REFRESH_INTERVAL)
+    stale_before = now - timedelta(seconds=settings.WEATHER_MAX_STALENESS)
+    due_subscriptions = UserSubscription.objects.filter(city=OuterRef('pk'), next_notify_at__lte=horizon)
+    fresh_weather = CityWeather.objects.filter(city=OuterRef('pk'), last_info_update__gt=stale_before)
+    return CityName.objects.filter(Exists(due_subscriptions) | ~Exists(fresh_weather)).order_by('id')
 
 
-def update_city_weather(city, weather_data):
+def update_weather_table(now=None, id_range=None):
     """
-    Update weather data for a specific city.
+    Update weather data of the cities that need it.
 
-    :param city: The city object.
-    :param weather_data: The weather data to update.
+    Walks the cities returned by `cities_to_refresh` in keyset batches, fetches the weather
+    of every batch concurrently through a `WeatherFetcher` (by provider city id where it is
+    known) and writes the batch back at once.
+    Keyset pagination keeps the walk stable while refreshed cities drop out of the selection.
+
+    :param now: The start time of the run, defaults to the current time.
+    :param id_range: An optional inclusive `(first_id, last_id)` range limiting the cities.
+    :return: The number of cities whose weather was written.
+    """
+    cities = cities_to_refresh(now or timezone.now())
+    if id_range is not None:
+        cities = cities.filter(id__range=id_range)
+    batch_size = settings.WEATHER_FETCH_BATCH_SIZE
+    last_id = 0
+    refreshed = 0
+    with WeatherFetcher() as fetcher:
+        while True:
+            cities_page = list(cities.filter(id__gt=last_id)[:batch_size])
+            if not cities_page:
+                break
+            last_id = cities_page[-1].id
+            metrics.count(cities=len(cities_page))
+            fetched = []
+            for city, (weather_data, code) in zip(cities_page, fetcher.fetch_cities(cities_page)):
+                if code != 200:
+                    logging.error(f"{weather_data['message']}, 'code': {code}")
+                else:
+                    fetched.append((city, weather_data))
+            refreshed += save_weather_batch(fetched)
+    return refreshed
+
+
+WEATHER_FIELDS = ('weather_description', 'temperature', 'feels_like', 'humidity', 'pressure', 'visibility',
+                  'wind_speed', 'clouds', 'rain', 'snow', )
+OPTIONAL_WEATHER_FIELDS = ('clouds', 'rain', 'snow', )
+
+
+def clean_weather_data(weather_data):
     """
-    city_weather = CityWeather.objects.get(city=city)
-    city_weather_serializer = CityWeatherSerializer(instance=city_weather, data=weather_data, partial=True)
-    if city_weather_serializer.is_valid():
-        city_weather_serializer.save()
-    else:
-        logging.error(f"{city_weather_serializer.errors}")
+    Validate a fetched weather payload against the `CityWeather` columns.
 
+    A lightweight replacement for `CityWeatherSerializer` on the refresh path.
 
-def send_email(weather_data, city_data, user):
+    :param weather_data: The weather data returned by `get_weather`.
+    :return: A dict holding only the `CityWeather` fields, with numeric values as floats.
+    :raises ValueError: If a field is missing or has a wrong type.
     """
-    Sends an email with weather report to a user.
+    description = weather_data.get('weather_description')
+    if not isinstance(description, str) or len(description) > 200:
+        raise ValueError(f"invalid weather_description: {description!r}")
+    cleaned = {'weather_description': description}
+    for field in WEATHER_FIELDS[1:]:
+        value = weather_data.get(field, 0 if field in OPTIONAL_WEATHER_FIELDS else None)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"invalid {field}: {value!r}")
+        cleaned[field] = float(value)
+    return cleaned
+
+
+def save_weather_batch(fetched):
+    """
+    Upsert fetched weather data for a batch of cities in a single statement.
+
+    Cities fetched by name for the first time also get their provider id and coordinates stored.
+
+    :param fetched: A list of `(city, weather_data)` pairs.
+    :return: The number of cities written.
+    """
+    rows = []
+    for city, weather_data in fetched:
+        try:
+            rows.append(CityWeather(city=city, **clean_weather_data(weather_data)))
+        except ValueError as error:
+            logging.error(f"Invalid weather data for {city}: {error}")
+    CityWeather.objects.bulk_create(rows, update_conflicts=True, unique_fields=['city'],
+                                    update_fields=WEATHER_FIELDS + ('last_info_update', ))
+
+    located = [city for city, weather_data in fetched if city.remember_provider_location(weather_data)]
+    if located:
+        CityName.objects.bulk_update(located, ['provider_id', 'latitude', 'longitude'])
+    return len(rows)
+
 
-    :param weather_data: The weather data.
-    :param city_data: The city data.
-    :param user: The user object to send the email to.
+def render_weather_report(city, city_weather):
     """
-    weather_data_copy = copy.deepcopy(weather_data)
+    Render the weather report body of a city.
 
-    del weather_data_copy['city']
-    del weather_data_copy['last_info_update']
+    The body depends only on the city and its weather row, so it is rendered once per
+    weather refresh and memoized by city id and `last_info_update` for all subscribers.
 
+    :param city: The city object.
+    :param city_weather: The weather object of the city.
+    :return: The rendered HTML report.
+    """
+    key = (city.id, city_weather.last_info_update if city_weather else None)
+    with _rendered_reports_lock:
+        email_body = _rendered_reports.get(key)
+        if email_body is not None:
+            _rendered_reports.move_to_end(key)
+            return email_body
+
+    weather_data = {field: getattr(city_weather, field) for field in WEATHER_FIELDS} if city_weather else {}
     email_body = render_to_string('weather/weather_report_template.html', {
-        'weather_data': weather_data_copy,  # Sending a copy instead of the original
-        'city_data': city_data,
+        'weather_data': weather_data,
+        'city_data': {'name': city.name, 'state': city.state, 'country_code': city.country_code},
     })
-    send_mail(
+    with _rendered_reports_lock:
+        _rendered_reports[key] = email_body
+        while len(_rendered_reports) > settings.WEATHER_RENDERED_REPORTS_CACHE_SIZE:
+            _rendered_reports.popitem(last=False)
+    return email_body
+
+
+def build_report_email(subscription):
+    """
+    Build the weather report email of a subscription.
+
+    :param subscription: The subscription, with its user, city and weather loaded.
+    :return: An `EmailMultiAlternatives` message with the rendered report.
+    """
+    message = EmailMultiAlternatives(
         subject=EMAIL_SUBJECT,
-        message="weather report",
-        html_message=email_body,
-        from_email=settings.EMAIL_FROM_USER,
-        recipient_list=[user.email],
-        fail_silently=True,
+        body="weather report",
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=[subscription.user.email],
     )
+    message.attach_alternative(render_weather_report(subscription.city, subscription.weather_info), 'text/html')
+    return message
+
 
+def notification_slots(subscriptions):
+    """Build a filter matching the ledger entries of the current slot of each subscription."""
+    slots = Q()
+    for subscription in subscriptions:
+        slots |= Q(subscription_id=subscription.id, slot=subscription.next_notify_at)
+    return slots
 
-def update_subscriptions_table():
+
+def claim_notifications(subscriptions, now):
     """
-    Update subscription information and send emails for overdue subscriptions.
+    Claim the current notification slot of each subscription in the notification ledger.
+
+    A slot is claimed by inserting its ledger entry; the unique (subscription, slot) constraint
+    lets only one worker win it. Slots whose send failed, and slots claimed more than
+    `WEATHER_NOTIFICATION_CLAIM_TIMEOUT` seconds ago by a worker that never finished, are
+    claimed again. Delivered slots are never claimed again.
+
+    :param subscriptions: Due subscriptions.
+    :return: The subscriptions whose slot was claimed by this call.
     """
-    paginator = Paginator(UserSubscription.objects.all(), 100)
+    token = uuid.uuid4()
+    Notification.objects.bulk_create(
+        [Notification(subscription=subscription, slot=subscription.next_notify_at, claim_token=token, claimed_at=now)
+         for subscription in subscriptions],
+        ignore_conflicts=True,
+    )
+    expired_before = now - timedelta(seconds=settings.WEATHER_NOTIFICATION_CLAIM_TIMEOUT)
+    (Notification.objects.filter(notification_slots(subscriptions))
+     .filter(Q(status=Notification.FAILED) | Q(status=Notification.CLAIMED, claimed_at__lt=expired_before))
+     .update(status=Notification.CLAIMED, claim_token=token, claimed_at=now))
 
-    for page_num in range(1, paginator.num_pages + 1):
-        page = paginator.page(page_num)
+    claimed = set(Notification.objects.filter(claim_token=token).values_list('subscription_id', 'slot'))
+    return [subscription for subscription in subscriptions
+            if (subscription.id, subscription.next_notify_at) in claimed]
 
-        for subscription in page.object_list:
-            time_delta = timezone.now() - subscription.last_info_update
-            if time_delta > timedelta(hours=subscription.notification_frequency):
-                weather_data = CityWeatherSerializer(subscription.weather_info).data
-                city_data = CityNameSerializer(subscription.city).data
-                send_email(weather_data=weather_data, city_data=city_data, user=subscription.user)
-                new_data = {
-                    'last_info_update': timezone.now(),
-                }
-                subscription_serializer = UserSubscriptionSerializer(instance=subscription, data=new_data, partial=True)
-                if subscription_serializer.is_valid():
-                    subscription_serializer.save()
-                else:
-                    logging.error(f"Error updating subscription: {subscription_serializer.errors}")
+
+def record_notifications(delivered, failed, now):
+    """
+    Mark the claimed slots of a sent chunk as delivered or failed and schedule the next
+    notification of the delivered subscriptions. Failed subscriptions stay due and are retried.
+    """
+    with transaction.atomic():
+        if delivered:
+            (Notification.objects.filter(notification_slots(delivered))
+             .update(status=Notification.DELIVERED, delivered_at=now))
+            for subscription in delivered:
+                subscription.schedule_next_notification(now)
+            UserSubscription.objects.bulk_update(delivered, ['last_info_update', 'next_notify_at'])
+        if failed:
+            Notification.objects.filter(notification_slots(failed)).update(status=Notification.FAILED)
+
+
+def send_weather_reports(subscription_ids):
+    """
+    Send weather reports for a batch of subscriptions and schedule their next notification.
+
+    Called by `send_subscriptions_shard`, on the `emails` queue. Each report is claimed in the
+    notification ledger before it is sent and marked delivered afterwards, so a retried or duplicated
+    shard does not send a report twice, and a shard restarted after a crash only sends what was not
+    delivered yet. All messages of the batch go through one SMTP connection, `WEATHER_EMAIL_BATCH_SIZE`
+    per `send_messages` call with a `WEATHER_EMAIL_THROTTLE` seconds pause in between; the ledger is
+    updated after every chunk. A report that could not be sent leaves its subscription due for the next run.
+
+    :param subscription_ids: Ids of the subscriptions to notify.
+    :return: The number of reports sent.
+    """
+    subscriptions = list(UserSubscription.objects.due().filter(id__in=subscription_ids))
+    if not subscriptions:
+        return 0
+    subscriptions = claim_notifications(subscriptions, timezone.now())
+    if not subscriptions:
+        return 0
+    metrics.count(subscriptions=len(subscriptions))
+    batch_size = settings.WEATHER_EMAIL_BATCH_SIZE
+    sent = 0
+
+    try:
+        connection = get_connection()
+        connection.open()
+    except (smtplib.SMTPException, OSError) as error:
+        logging.error(f"Could not connect to the mail server: {error}")
+        record_notifications([], subscriptions, timezone.now())
+        return 0
+
+    try:
+        for start in range(0, len(subscriptions), batch_size):
+            if start and settings.WEATHER_EMAIL_THROTTLE:
+                time.sleep(settings.WEATHER_EMAIL_THROTTLE)
+            batch = subscriptions[start:start + batch_size]
+            metrics.record_email_batch(len(batch))
+            delivered, failed = send_report_emails(connection, batch)
+            record_notifications(delivered, failed, timezone.now())
+            sent += len(delivered)
+    finally:
+        connection.close()
+    return sent
+
+
+def hand_over(reports, attempted):
+    """Yield the messages of `(subscription, message)` pairs, noting each subscription and when it was handed over."""
+    for subscription, message in reports:
+        attempted.append((subscription, time.perf_counter()))
+        yield message
+
+
+def send_report_emails(connection, subscriptions):
+    """
+    Send the weather reports of a chunk of subscriptions with one `send_messages` call.
+
+    Mail backends send the messages one after another and stop at the first one that fails,
+    so the messages are handed over lazily to tell which of them the backend got to: those
+    before the failing one were delivered, and the rest are sent by another `send_messages` call.
+
+    :return: The delivered and the failed subscriptions.
+    """
+    delivered, failed = [], []
+    pending = [(subscription, build_report_email(subscription)) for subscription in subscriptions]
+    while pending:
+        attempted = []
+        try:
+            connection.send_messages(hand_over(pending, attempted))
+            error = None
+        except (smtplib.SMTPException, OSError) as send_error:
+            error = send_error
+        finished = time.perf_counter()
+        if not attempted:
+            logging.error(f"Weather reports of {len(pending)} subscriptions were not sent: "
+                          f"{error or 'the mail backend sent nothing'}")
+            failed.extend(subscription for subscription, _ in pending)
+            break
+        # a message was being sent from its hand-over until the next one was asked for
+        for index, (subscription, started) in enumerate(attempted):
+            done = attempted[index + 1][1] if index + 1 < len(attempted) else finished
+            if error is not None and index == len(attempted) - 1:
+                logging.error(f"Weather report of subscription {subscription.id} was not sent: {error}")
+                metrics.record_email('failed', done - started)
+                failed.append(subscription)
+            else:
+                metrics.record_email('sent', done - started)
+                delivered.append(subscription)
+        pending = pending[len(attempted):]
+    return delivered, failed
+
+
+def iter_due_subscription_ids(now, batch_size, id_range=None):
+    """
+    Yield the ids of subscriptions due at `now` in batches.
+
+    Batches are read with keyset pagination over the `(next_notify_at, id)` index,
+    so rescheduling already dispatched subscriptions does not shift the following pages.
+
+    :param id_range: An optional inclusive `(first_id, last_id)` range limiting the subscriptions.
+    """
+    due_subscriptions = (UserSubscription.objects.filter(next_notify_at__lte=now)
+                         .order_by('next_notify_at', 'id')
+                         .values_list('next_notify_at', 'id'))
+    if id_range is not None:
+        due_subscriptions = due_subscriptions.filter(id__range=id_range)
+    last_key = None
+    while True:
+        page = due_subscriptions
+        if last_key is not None:
+            last_notify_at, last_id = last_key
+            page = page.filter(Q(next_notify_at__gt=last_notify_at) | Q(next_notify_at=last_notify_at, id__gt=last_id))
+        keys = list(page[:batch_size])
+        if not keys:
+            return
+        last_key = keys[-1]
+        yield [subscription_id for _, subscription_id in keys]
+
+
+@shared_task()
+def import_pending_subscriptions(user_id, rows):
+    """
+    Import the rows an import left pending because it could not look their cities up right away.
+
+    Every city is fetched, waiting for the shared provider rate budget as needed; rows that still
+    fail are logged.
+
+    :param user_id: The id of the importing user.
+    :param rows: Subscription data dicts, as accepted by `OneSubscriptionSerializer`.
+    :return: The number of subscriptions created.
+    """
+    from .bulk import import_subscriptions  # bulk imports this module
+
+    user = CustomUser.objects.filter(id=user_id).first()
+    if user is None:
+        return 0
+    results = import_subscriptions(user, rows)
+    for row, result in zip(rows, results):
+        if result['status'] == 'error':
+            logging.error(f"Pending import of {row.get('city')} for user {user_id} failed: {result['error']}")
+    return sum(result['status'] == 'created' for result in results)
+
+
+@shared_task()
+def remove_unused_cities():
+    """
+    Periodic sweep deleting cities, with their weather, that nobody is subscribed to.
+    """
+    deleted, _ = CityName.objects.filter(subscriptions__isnull=True).delete()
+    return deleted
+
+
+def delete_in_chunks(queryset, chunk_size, ordering=('id', )):
+    """
+    Delete the rows of `queryset` `chunk_size` at a time, each chunk in its own short transaction.
+
+    :param ordering: The fields chunks are taken in the order of, matching an index of the filtered columns.
+    :return: The number of rows of the queryset's model deleted.
+    """
+    deleted = 0
+    while True:
+        ids = list(queryset.order_by(*ordering).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        with transaction.atomic():
+            queryset.model.objects.filter(id__in=ids).only('id').delete()
+        deleted += len(ids)
+
+
+@shared_task()
+def prune_expired_tokens(now=None):
+    """
+    Periodic sweep deleting expired outstanding refresh tokens together with their blacklist entries.
+
+    Tokens are taken `WEATHER_TOKEN_PRUNE_CHUNK_SIZE` at a time in the order of the `(expires_at, id)`
+    index added by migration 0008, so every chunk is read from the start of the index instead of
+    scanning the table, and every chunk is deleted in its own short transaction.
+
+    :return: The number of outstanding tokens deleted.
+    """
+    now = now or timezone.now()
+    return delete_in_chunks(OutstandingToken.objects.filter(expires_at__lte=now),
+                            settings.WEATHER_TOKEN_PRUNE_CHUNK_SIZE, ordering=('expires_at', 'id'))
+
+
+@shared_task()
+def prune_notifications(now=None):
+    """
+    Periodic sweep deleting notification ledger entries of slots older than `WEATHER_NOTIFICATION_RETENTION` seconds.
+
+    Only the entry of a subscription's current slot guards against sending a report twice, and a
+    subscription is rescheduled as soon as its report is delivered, so old entries are history only.
+    They are deleted `WEATHER_NOTIFICATION_PRUNE_CHUNK_SIZE` at a time in primary key order.
+
+    :return: The number of ledger entries deleted.
+    """
+    now = now or timezone.now()
+    return delete_in_chunks(
+        Notification.objects.filter(slot__lt=now - timedelta(seconds=settings.WEATHER_NOTIFICATION_RETENTION)),
+        settings.WEATHER_NOTIFICATION_PRUNE_CHUNK_SIZE,
+    )
+
+
+def pk_shards(queryset, shard_size):
+    """
+    Partition the rows of `queryset` into ranges of at most `shard_size` consecutive primary keys.
+
+    :return: A list of inclusive `(first_id, last_id)` ranges.
+    """
+    ids = queryset.order_by('id').values_list('id', flat=True)
+    shards = []
+    last_id = 0
+    while True:
+        shard = list(ids.filter(id__gt=last_id)[:shard_size])
+        if not shard:
+            return shards
+        shards.append((shard[0], shard[-1]))
+        last_id = shard[-1]
+
+
+def run_lease(token=None):
+    """
+    The lease making sure only one hourly run is in progress at a time.
+
+    Nobody renews the lease while the tasks of a run wait in the queue, so it lasts
+    `WEATHER_RUN_QUEUE_WAIT` seconds longer than the heartbeat alone would need.
+    """
+    return Lease('weather-run', settings.WEATHER_RUN_LEASE_TTL + settings.WEATHER_RUN_QUEUE_WAIT, token=token)
+
+
+def queued(signature):
+    """
+    Let a task of a run expire unrun once it waited `WEATHER_RUN_QUEUE_WAIT` seconds in the queue.
+
+    By then the lease of its run may have expired and another run may have started.
+    """
+    return signature.set(expires=settings.WEATHER_RUN_QUEUE_WAIT)
+
+
+def picked_up(lease_token, task_name):
+    """
+    Renew the lease of a run when one of its shards starts.
+
+    :return: The lease, or None if the run lost it and the shard has to be skipped.
+    """
+    lease = run_lease(lease_token)
+    if not lease.renew():
+        logging.warning(f"{task_name} skipped: its weather run lost the lease")
+        return None
+    return lease
+
+
+@shared_task()
+def refresh_cities_shard(first_id, last_id, started_at, lease_token):
+    """
+    Fetch and write the weather of the cities with ids in `[first_id, last_id]` that need it.
+
+    :return: The number of cities refreshed.
+    """
+    lease = picked_up(lease_token, 'refresh_cities_shard')
+    if lease is None:
+        return 0
+    with lease.heartbeat():
+        return update_weather_table(now=parse_datetime(started_at), id_range=(first_id, last_id))
+
+
+@shared_task()
+def send_subscriptions_shard(first_id, last_id, started_at, lease_token):
+    """
+    Send the reports of the due subscriptions with ids in `[first_id, last_id]`.
+
+    Runs on the `emails` queue and sends the batches of the shard one after another
+    instead of fanning out into further tasks, so that it can report its total.
+
+    :return: The number of reports sent.
+    """
+    lease = picked_up(lease_token, 'send_subscriptions_shard')
+    if lease is None:
+        return 0
+    sent = 0
+    with lease.heartbeat():
+        for subscription_ids in iter_due_subscription_ids(parse_datetime(started_at),
+                                                          settings.WEATHER_NOTIFY_BATCH_SIZE,
+                                                          id_range=(first_id, last_id)):
+            sent += send_weather_reports(subscription_ids)
+    return sent
+
+
+@shared_task()
+def notify_due_subscriptions(refreshed, started_at, lease_token):
+    """
+    Second stage of a run: partition the due subscriptions into shards and send them in parallel.
+
+    :param refreshed: The results of the refresh shards.
+    """
+    lease = run_lease(lease_token)
+    due_subscriptions = UserSubscription.objects.filter(next_notify_at__lte=parse_datetime(started_at))
+    shards = pk_shards(due_subscriptions, settings.WEATHER_SUBSCRIPTION_SHARD_SIZE)
+    summary = queued(summarize_run.s(refreshed, started_at, lease_token))
+    # renewed right before the shards are queued, so the lease outlasts their wait in the queue
+    lease.renew()
+    if not shards:
+        return summary.delay([])
+    return chord(queued(send_subscriptions_shard.s(first_id, last_id, started_at, lease_token))
+                 for first_id, last_id in shards)(summary)
+
+
+@shared_task()
+def summarize_run(sent, refreshed, started_at, lease_token):
+    """
+    Last stage of a run: log and return what the shards did, and end the run.
+
+    :param sent: The results of the send shards.
+    :param refreshed: The results of the refresh shards.
+    """
+    run_lease(lease_token).release()
+    summary = {
+        'started_at': started_at,
+        'duration': (timezone.now() - parse_datetime(started_at)).total_seconds(),
+        'city_shards': len(refreshed),
+        'cities_refreshed': sum(refreshed),
+        'subscription_shards': len(sent),
+        'reports_sent': sum(sent),
+    }
+    logging.info(f"Weather run finished: {summary}")
+    return summary
 
 
 @shared_task()
 def update_tables_and_send_emails():
     """
-    Task to update tables and send emails asynchronously.
+    Coordinate a run of weather updates and emails across workers.
+
+    The cities to refresh are partitioned into primary-key shards of `WEATHER_CITY_SHARD_SIZE`
+    and refreshed by a group of tasks; once all of them finished, the due subscriptions are
+    partitioned the same way and sent by a second group, followed by a run summary.
+
+    A run holds the `run_lease` from start to summary. It is renewed whenever shards are queued,
+    when each shard starts and while it works; tasks that wait in the queue for longer than
+    `WEATHER_RUN_QUEUE_WAIT` seconds expire unrun, so the lease outlasts every task that does run.
+    A run triggered while another one is in progress is skipped; if a run dies, its lease
+    expires after `WEATHER_RUN_LEASE_TTL` + `WEATHER_RUN_QUEUE_WAIT` seconds.
     """
-    update_weather_table()
-    update_subscriptions_table()
+    lease = run_lease()
+    if not lease.acquire():
+        logging.warning("Weather run skipped: the previous run is still in progress")
+        return None
+    started_at = timezone.now().isoformat()
+    try:
+        shards = pk_shards(cities_to_refresh(parse_datetime(started_at)), settings.WEATHER_CITY_SHARD_SIZE)
+        notify = queued(notify_due_subscriptions.s(started_at, lease.token))
+        lease.renew()
+        if not shards:
+            return notify.delay([])
+        return chord(queued(refresh_cities_shard.s(first_id, last_id, started_at, lease.token))
+                     for first_id, last_id in shards)(notify)
+    except Exception:
+        lease.release()
+        raise
@@ -0,0 +1,143 @@
+import os
+import statistics
+import time
+from datetime import timedelta
+
+import pytest
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from weather.models import CityName, CityWeather, CustomUser, UserSubscription
+
+# Numbers of cities and of subscriptions to seed, e.g. "1000,10000,100000"; benchmarks are skipped without it
+SCALES = [int(scale) for scale in os.environ.get('WEATHER_BENCHMARK_SCALES', '').split(',') if scale.strip()]
+# Seconds the fake provider takes to answer every call
+PROVIDER_LATENCY = float(os.environ.get('WEATHER_BENCHMARK_PROVIDER_LATENCY', 0.02))
+# Requests measured per endpoint
+REPEAT = int(os.environ.get('WEATHER_BENCHMARK_REPEAT', 20))
+# Multiplier of all time budgets, to adjust them to slower or faster machines
+TIME_FACTOR = float(os.environ.get('WEATHER_BENCHMARK_TIME_FACTOR', 1))
+
+OWNER_EMAIL = 'owner@example.com'
+OWNER_PASSWORD = 'example_pwd_1!'
+OWNER_SUBSCRIPTIONS = 100
+
+benchmark_scales = pytest.mark.skipif(not SCALES, reason='set WEATHER_BENCHMARK_SCALES, e.g. 1000,10000,100000')
+
+_results = []
+
+
+class Measurement:
+    """Latencies and query counts of repeated calls of one operation."""
+
+    def __init__(self, name, scale):
+        self.name = name
+        self.scale = scale
+        self.latencies = []
+        self.queries = []
+        self.provider_calls = None
+        # (label, seconds) pairs reported below the summary table, e.g. the slowest imports
+        self.breakdown = []
+
+    def __call__(self, func, *args, **kwargs):
+        """Call `func` once, recording its latency and the number of queries it ran."""
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            self.latencies.append(time.perf_counter() - started)
+        self.queries.append(len(context))
+        return result
+
+    def percentile(self, percent):
+        if len(self.latencies) == 1:
+            return self.latencies[0]
+        return statistics.quantiles(self.latencies, n=100, method='inclusive')[percent - 1]
+
+    @property
+    def p50(self):
+        return self.percentile(50)
+
+    @property
+    def p99(self):
+        return self.percentile(99)
+
+    @property
+    def max_queries(self):
+        return max(self.queries)
+
+    def check(self, max_queries, p99_budget):
+        """
+        Assert the regression thresholds of the operation.
+
+        :param max_queries: The most queries one call may run.
+        :param p99_budget: The p99 latency budget in seconds, scaled by `WEATHER_BENCHMARK_TIME_FACTOR`.
+        """
+        assert self.max_queries <= max_queries, f"{self.name}: {self.max_queries} queries > {max_queries}"
+        assert self.p99 <= p99_budget * TIME_FACTOR, f"{self.name}: p99 {self.p99:.3f}s > {p99_budget * TIME_FACTOR}s"
+
+
+@pytest.fixture
+def measure():
+    """Fixture creating measurements that are reported at the end of the run."""
+    def make_measurement(name, scale):
+        measurement = Measurement(name, scale)
+        _results.append(measurement)
+        return measurement
+    return make_measurement
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not _results:
+        return
+    terminalreporter.section('weather benchmarks')
+    terminalreporter.write_line(f"{'operation':<36}{'scale':>8}{'calls':>7}{'queries':>9}"
+                                f"{'p50 ms':>10}{'p99 ms':>10}{'provider':>10}")
+    for result in _results:
+        if not result.latencies:
+            continue
+        provider_calls = '' if result.provider_calls is None else result.provider_calls
+        terminalreporter.write_line(f"{result.name:<36}{result.scale:>8}{len(result.latencies):>7}"
+                                    f"{result.max_queries:>9}{result.p50 * 1000:>10.1f}{result.p99 * 1000:>10.1f}"
+                                    f"{provider_calls:>10}")
+    for result in _results:
+        if not result.breakdown:
+            continue
+        terminalreporter.write_line(f"{result.name}:")
+        for label, seconds in result.breakdown:
+            terminalreporter.write_line(f"    {label:<60}{seconds * 1000:>10.1f} ms")
+
+
+def seed(scale, provider, overdue=False):
+    """
+    Seed `scale` cities with their weather and `scale` subscriptions, and register the cities at the provider.
+
+    The owner user gets `OWNER_SUBSCRIPTIONS` subscriptions, the rest belong to users with ten each.
+
+    :param overdue: Whether the subscriptions are due already.
+    :return: The owner user.
+    """
+    owner = CustomUser.objects.create_user(email=OWNER_EMAIL, password=OWNER_PASSWORD)
+    password = make_password(OWNER_PASSWORD)
+    users = CustomUser.objects.bulk_create([CustomUser(email=f'user{number}@example.com', password=password)
+                                            for number in range((scale - OWNER_SUBSCRIPTIONS) // 10 + 1)],
+                                           batch_size=1000)
+    cities = CityName.objects.bulk_create([CityName(name=f'City{number}', state='', country_code='PL',
+                                                    provider_id=provider.add_city(f'City{number}', 'PL'))
+                                           for number in range(scale)], batch_size=1000)
+    weather = CityWeather.objects.bulk_create([CityWeather(city=city, weather_description='clear sky', temperature=20,
+                                                           feels_like=20, humidity=50, pressure=1010,
+                                                           visibility=10000, wind_speed=3, clouds=0, rain=0, snow=0)
+                                               for city in cities], batch_size=1000)
+
+    now = timezone.now()
+    next_notify_at = now - timedelta(minutes=1) if overdue else now + timedelta(hours=2)
+    subscriptions = []
+    for number, (city, city_weather) in enumerate(zip(cities, weather)):
+        user = owner if number < OWNER_SUBSCRIPTIONS else users[(number - OWNER_SUBSCRIPTIONS) // 10]
+        subscriptions.append(UserSubscription(user=user, city=city, weather_info=city_weather,
+                                              notification_frequency=2, last_info_update=now,
+                                              next_notify_at=next_notify_at))
+    UserSubscription.objects.bulk_create(subscriptions, batch_size=1000)
+    return owner
@@ -0,0 +1,129 @@
+import json
+
+import pytest
+from django.contrib.auth.hashers import make_password
+from django.urls import reverse
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from weather.models import CustomUser, UserSubscription
+
+from .conftest import OWNER_EMAIL, OWNER_PASSWORD, PROVIDER_LATENCY, REPEAT, SCALES, benchmark_scales, seed
+
+# Most queries per request and p99 latency budget in seconds of every endpoint; neither may grow with the scale
+BUDGETS = {
+    'docs-ui': (0, 0.1),
+    'docs': (0, 2.0),
+    'register': (3, 0.05),
+    'delete_account': (6, 0.05),
+    # the first login of a process parses the RSA private key
+    'login': (2, 0.1),
+    'token_refresh': (3, 0.05),
+    'token_refresh replayed': (0, 0.05),
+    'subscriptions_list': (1, 0.05),
+    'subscription_action PUT': (13, 0.05),
+    'subscription_action DELETE': (11, 0.05),
+    'new_subscription': (16, 0.1),
+    'import_subscriptions': (8, 0.3),
+    'export_subscriptions': (1, 0.05),
+    # the test client runs every async request on a new event loop, with a new provider client
+    'async_new_subscription': (14, 0.3),
+    'async_subscription_action PUT': (7, 0.05),
+}
+# Endpoints whose requests wait on the provider, which adds its latency to their budget
+PROVIDER_BOUND = {'new_subscription', 'import_subscriptions', 'async_new_subscription'}
+
+
+def check(measurement):
+    max_queries, p99_budget = BUDGETS[measurement.name]
+    if measurement.name in PROVIDER_BOUND:
+        p99_budget += PROVIDER_LATENCY
+    measurement.check(max_queries, p99_budget)
+
+
+def request_city(name):
+    return {"city": {"name": name, "state": "", "country_code": "PL"}, "notification_frequency": 3}
+
+
+@benchmark_scales
+@pytest.mark.django_db
+@pytest.mark.parametrize('scale', SCALES)
+def test_api_benchmark(scale, fake_provider, settings, measure):
+    """Measure the queries and latency of every endpoint in `weather/urls.py` over `scale` cities and subscriptions."""
+    settings.WEATHER_FETCH_RATE_LIMIT = 0
+    owner = seed(scale, fake_provider)
+    # unknown cities: REPEAT for new_subscription, 9 * REPEAT for the import, REPEAT for async_new_subscription
+    for number in range(REPEAT * 11):
+        fake_provider.add_city(f'New{number}', 'PL')
+    fake_provider.latency = PROVIDER_LATENCY
+    client = APIClient()
+    client.force_authenticate(user=owner)
+    owner_subscriptions = list(UserSubscription.objects.filter(user=owner).order_by('id')
+                               .values_list('id', flat=True))
+    measurements = []
+
+    def measure_endpoint(name, send, expected_status):
+        measurement = measure(name, scale)
+        for repetition in range(REPEAT):
+            response = measurement(send, repetition)
+            assert response.status_code == expected_status, (name, response.status_code)
+        measurements.append(measurement)
+
+    measure_endpoint('docs-ui', lambda _: client.get(reverse('docs-ui')), 200)
+    measure_endpoint('docs', lambda _: client.get(reverse('docs')), 200)
+    measure_endpoint('subscriptions_list', lambda _: client.get(reverse('subscriptions_list')), 200)
+
+    def export(_):
+        # the export is streamed, so it is only done once its content has been read
+        response = client.get(reverse('export_subscriptions'))
+        b''.join(response.streaming_content)
+        return response
+    measure_endpoint('export_subscriptions', export, 200)
+
+    measure_endpoint('subscription_action PUT', lambda repetition: client.put(
+        reverse('subscription_action', kwargs={'id': owner_subscriptions[repetition]}),
+        request_city(f'City{repetition + 1}') | {"notification_frequency": 5}, format='json'), 200)
+    measure_endpoint('new_subscription', lambda repetition: client.post(
+        reverse('new_subscription'), request_city(f'New{repetition}'), format='json'), 201)
+    measure_endpoint('import_subscriptions', lambda repetition: client.post(
+        reverse('import_subscriptions'),
+        [request_city(f'New{REPEAT + repetition * 9 + number}') for number in range(9)], format='json'), 200)
+    measure_endpoint('subscription_action DELETE', lambda repetition: client.delete(
+        reverse('subscription_action', kwargs={'id': owner_subscriptions[-1 - repetition]})), 200)
+
+    access_token = f"Bearer {AccessToken.for_user(owner)}"
+    new_async = [f'New{number}' for number in range(REPEAT * 10, REPEAT * 11)]
+    measure_endpoint('async_new_subscription', lambda repetition: client.generic(
+        'POST', reverse('async_new_subscription'), content_type='application/json',
+        data=json.dumps(request_city(new_async[repetition])), HTTP_AUTHORIZATION=access_token), 201)
+    measure_endpoint('async_subscription_action PUT', lambda repetition: client.generic(
+        'PUT', reverse('async_subscription_action', kwargs={'id': owner_subscriptions[REPEAT + repetition]}),
+        content_type='application/json', data=json.dumps(request_city(f'City{REPEAT + repetition}')),
+        HTTP_AUTHORIZATION=access_token), 200)
+
+    anonymous = APIClient()
+    measure_endpoint('register', lambda repetition: anonymous.post(reverse('register'), {
+        "email": f"new{repetition}@example.com", "password": OWNER_PASSWORD, "password2": OWNER_PASSWORD,
+    }, format='json'), 201)
+    measure_endpoint('login', lambda _: anonymous.post(reverse('token_obtain_pair'), {
+        "email": OWNER_EMAIL, "password": OWNER_PASSWORD,
+    }, format='json'), 200)
+    refresh_tokens = [str(RefreshToken.for_user(owner)) for _ in range(REPEAT)]
+    measure_endpoint('token_refresh', lambda repetition: anonymous.post(reverse('token_refresh'), {
+        "refresh": refresh_tokens[repetition],
+    }, format='json'), 200)
+    measure_endpoint('token_refresh replayed', lambda repetition: anonymous.post(reverse('token_refresh'), {
+        "refresh": refresh_tokens[repetition],
+    }, format='json'), 401)
+
+    password = make_password(OWNER_PASSWORD)
+    leaving = CustomUser.objects.bulk_create([CustomUser(email=f'leaving{number}@example.com', password=password)
+                                              for number in range(REPEAT)])
+
+    def delete_account(repetition):
+        client.force_authenticate(user=leaving[repetition])
+        return client.delete(reverse('delete_account'))
+    measure_endpoint('delete_account', delete_account, 200)
+
+    for measurement in measurements:
+        check(measurement)
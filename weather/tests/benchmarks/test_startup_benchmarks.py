@@ -0,0 +1,71 @@
+import re
+import subprocess
+import sys
+
+import pytest
+from django.conf import settings
+
+from .conftest import REPEAT, TIME_FACTOR, benchmark_scales
+
+# Code run by a fresh interpreter for every process type, up to the point where it can serve
+ENTRY_POINTS = {
+    'startup manage.py': "import django; django.setup()",
+    'startup web': "import Weather_reminder.asgi; from django.urls import get_resolver; get_resolver().url_patterns",
+    'startup worker': "from Weather_reminder.celery import app; app.loader.init_worker()",
+    'startup beat': ("import django; django.setup(); from Weather_reminder.celery import app; "
+                     "app.loader.import_default_modules(); app.conf.beat_schedule"),
+}
+# Median wall time budget in seconds of every entry point, interpreter start included; single cold starts are noisy
+BUDGETS = {
+    'startup manage.py': 1.2,
+    'startup web': 1.5,
+    'startup worker': 1.5,
+    'startup beat': 1.5,
+}
+# Modules an entry point must not import: the RSA key parser and PyJWT are needed on the first
+# signing or verification, httpx on the first async provider call, the crontab parser by Celery only
+# and the JWT authentication with simplejwt's serializers by the web processes only
+DEFERRED_MODULES = {'cryptography.hazmat.primitives.serialization', 'jwt', 'httpx'}
+WEB_MODULES = {'weather.authentication', 'rest_framework_simplejwt.serializers'}
+DEFERRED = {
+    'startup manage.py': DEFERRED_MODULES | WEB_MODULES | {'celery.schedules'},
+    'startup web': DEFERRED_MODULES | {'celery.schedules'},
+    'startup worker': DEFERRED_MODULES | WEB_MODULES,
+    'startup beat': DEFERRED_MODULES | WEB_MODULES,
+}
+# Interpreter starts measured per entry point, each takes about a second
+STARTUP_REPEAT = min(REPEAT, 5)
+# Slowest top-level imports reported per entry point
+BREAKDOWN_SIZE = 10
+
+IMPORT_TIME = re.compile(r'^import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def import_times(code):
+    """
+    Run `code` in a new interpreter with `-X importtime`.
+
+    :return: A list of `(module, cumulative seconds, top level)` tuples of every module imported.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                            cwd=settings.BASE_DIR, check=False)
+    assert result.returncode == 0, result.stderr
+    return [(match[3], int(match[1]) / 1e6, not match[2])
+            for match in map(IMPORT_TIME.match, result.stderr.splitlines()) if match]
+
+
+@benchmark_scales
+@pytest.mark.django_db
+@pytest.mark.parametrize('name', ENTRY_POINTS)
+def test_startup_benchmark(name, measure):
+    """Measure the cold start of a web, worker and beat process and of management commands."""
+    measurement = measure(name, '-')
+    for _ in range(STARTUP_REPEAT):
+        imports = measurement(import_times, ENTRY_POINTS[name])
+
+    imported = {module for module, _, _ in imports}
+    assert not imported & DEFERRED[name], f"{name} imports {sorted(imported & DEFERRED[name])}"
+    top_level = sorted(((module, seconds) for module, seconds, top in imports if top), key=lambda item: -item[1])
+    measurement.breakdown = top_level[:BREAKDOWN_SIZE]
+    budget = BUDGETS[name] * TIME_FACTOR
+    assert measurement.p50 <= budget, f"{name}: p50 {measurement.p50:.3f}s > {budget}s"
@@ -0,0 +1,65 @@
+import math
+
+import pytest
+from django.core import mail
+from django.utils import timezone
+
+from weather.constants import OWM_GROUP_SIZE
+from weather.models import CityWeather
+from weather.tasks import notify_due_subscriptions, run_lease, update_weather_table
+
+from .conftest import PROVIDER_LATENCY, SCALES, TIME_FACTOR, benchmark_scales, seed
+
+# Most queries per batch of cities refreshed, per batch of subscriptions notified and per subscription shard
+QUERIES_PER_REFRESH_BATCH = 4
+QUERIES_PER_NOTIFY_BATCH = 14
+QUERIES_PER_SUBSCRIPTION_SHARD = 2
+# Wall time budget per city refreshed and per email sent, on top of the provider round trips
+SECONDS_PER_CITY = 0.001
+SECONDS_PER_EMAIL = 0.005
+
+
+@benchmark_scales
+@pytest.mark.django_db
+@pytest.mark.parametrize('scale', SCALES)
+def test_update_weather_table_benchmark(scale, fake_provider, settings, measure):
+    """Measure wall time, provider calls and queries of a refresh of `scale` cities."""
+    settings.WEATHER_FETCH_RATE_LIMIT = 0
+    seed(scale, fake_provider, overdue=True)
+    fake_provider.latency = PROVIDER_LATENCY
+    fake_provider.requests.clear()
+
+    measurement = measure('update_weather_table', scale)
+    refreshed = measurement(update_weather_table)
+    measurement.provider_calls = len(fake_provider.requests)
+
+    assert refreshed == CityWeather.objects.count() == scale
+    batches = math.ceil(scale / settings.WEATHER_FETCH_BATCH_SIZE)
+    group_calls = batches * math.ceil(settings.WEATHER_FETCH_BATCH_SIZE / OWM_GROUP_SIZE)
+    assert measurement.provider_calls <= group_calls
+    assert measurement.max_queries <= (batches + 1) * QUERIES_PER_REFRESH_BATCH
+    provider_time = batches * math.ceil(group_calls / batches / settings.WEATHER_FETCH_CONCURRENCY) * PROVIDER_LATENCY
+    assert measurement.p50 <= (provider_time + scale * SECONDS_PER_CITY) * TIME_FACTOR
+
+
+@benchmark_scales
+@pytest.mark.django_db
+@pytest.mark.parametrize('scale', SCALES)
+def test_notify_due_subscriptions_benchmark(scale, fake_provider, settings, measure):
+    """Measure wall time and queries of the sending stage of a run over `scale` due subscriptions."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    seed(scale, fake_provider, overdue=True)
+    lease = run_lease()
+    assert lease.acquire()
+
+    measurement = measure('notify_due_subscriptions', scale)
+    measurement(notify_due_subscriptions, [], timezone.now().isoformat(), lease.token)
+    measurement.provider_calls = len(fake_provider.requests)
+
+    assert len(mail.outbox) == scale
+    assert measurement.provider_calls == 0
+    batches = math.ceil(scale / settings.WEATHER_NOTIFY_BATCH_SIZE)
+    shards = math.ceil(scale / settings.WEATHER_SUBSCRIPTION_SHARD_SIZE)
+    assert measurement.max_queries <= ((batches + 1) * QUERIES_PER_NOTIFY_BATCH
+                                       + (shards + 1) * QUERIES_PER_SUBSCRIPTION_SHARD)
+    assert measurement.p50 <= scale * SECONDS_PER_EMAIL * TIME_FACTOR
@@ -1,7 +1,44 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
 import pytest
+from django.core.cache import cache
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework.test import APIClient
 
+from Weather_reminder.celery import app as celery_app
+from weather.authentication import clear_authentication_cache
+from weather.cache import get_weather_cache
+from weather.models import CityName, CityWeather, UserSubscription
+from weather.utils import close_weather_client
+
+
+@pytest.fixture(autouse=True)
+def celery_eager():
+    """Fixture running Celery tasks in-process instead of sending them to a broker."""
+    celery_app.conf.update(task_always_eager=True, task_eager_propagates=True)
+    yield
+    celery_app.conf.update(task_always_eager=False, task_eager_propagates=False)
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Fixture isolating tests from each other's cached provider responses and authentication."""
+    yield
+    get_weather_cache().clear()
+    cache.clear()
+    clear_authentication_cache()
+
+
+@pytest.fixture(autouse=True)
+def fast_password_hasher(settings):
+    """Fixture hashing passwords with a cheap hasher, so tests do not spend their time in PBKDF2."""
+    settings.PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
 
 @pytest.fixture
 def api_client():
@@ -9,6 +46,38 @@ def api_client():
     return APIClient()
 
 
+@pytest.fixture
+def create_user(db, django_user_model):
+    """Fixture for creating users in the test database."""
+    def make_user(email, password='example_pwd_1!'):
+        return django_user_model.objects.create_user(email=email, password=password)
+    return make_user
+
+
+@pytest.fixture
+def create_city(db):
+    """Fixture for creating cities together with their stored weather."""
+    def make_city(name, country_code, state='', temperature=0.0):
+        city = CityName.objects.create(name=name, state=state, country_code=country_code)
+        CityWeather.objects.create(city=city, weather_description='unknown', temperature=temperature,
+                                   feels_like=temperature, humidity=0, pressure=0, visibility=0, wind_speed=0,
+                                   clouds=0, rain=0, snow=0)
+        return city
+    return make_city
+
+
+@pytest.fixture
+def create_subscription(db):
+    """Fixture for creating subscriptions, optionally backdated so that they are already due."""
+    def make_subscription(user, city, notification_frequency=1, overdue_by=None):
+        subscription = UserSubscription.objects.create(user=user, city=city, weather_info=city.weather.get(),
+                                                       notification_frequency=notification_frequency)
+        if overdue_by is not None:
+            UserSubscription.objects.filter(id=subscription.id).update(next_notify_at=timezone.now() - overdue_by)
+        return subscription
+    return make_subscription
+
+
 @pytest.fixture
 def api_client_with_authenticated_user(db, api_client, create_user):
     """Fixture for creating an authenticated API client."""
@@ -19,8 +88,9 @@ def api_client_with_authenticated_user(db, api_client, create_user):
 
 
 @pytest.fixture
-def subscription(db, api_client_with_authenticated_user):
+def subscription(db, api_client_with_authenticated_user, fake_provider):
     """Fixture for creating a subscription object in the test database."""
+    fake_provider.add_city('Wroclaw', 'PL')
     url = reverse('new_subscription')
     data = {
         "city": {
@@ -31,3 +101,82 @@ def subscription(db, api_client_with_authenticated_user):
         "notification_frequency": 2
     }
     api_client_with_authenticated_user.post(url, data, format='json')
+
+
+class FakeWeatherProvider:
+    """Local stand-in for the OpenWeatherMap API, served over HTTP on a free port."""
+
+    def __init__(self):
+        self.cities = {}
+        self.cities_by_id = {}
+        self.requests = []
+        self.latency = 0
+        self.failures = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}/data/2.5"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def add_city(self, name, country_code, state='', temperature=20.0):
+        """Register a city the provider knows about and return its provider id."""
+        provider_id = 1000 + len(self.cities)
+        self.cities[f"{name},{state},{country_code}".lower()] = self.cities_by_id[provider_id] = {
+            'cod': 200,
+            'id': provider_id,
+            'name': name,
+            'coord': {'lat': 51.1, 'lon': 17.03},
+            'weather': [{'description': 'clear sky'}],
+            'main': {'temp': temperature, 'feels_like': temperature, 'humidity': 50, 'pressure': 1010},
+            'visibility': 10000,
+            'wind': {'speed': 3.5},
+            'clouds': {'all': 0},
+        }
+        return provider_id
+
+    def _make_handler(self):
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                query = parse_qs(parsed.query)
+                provider.requests.append((parsed.path, query))
+                if provider.latency:
+                    time.sleep(provider.latency)
+                if provider.failures:
+                    provider.failures -= 1
+                    self.send_error(503)
+                    return
+                if parsed.path.endswith('/group'):
+                    provider_ids = [int(provider_id) for provider_id in query['id'][0].split(',')]
+                    cities = [provider.cities_by_id[provider_id] for provider_id in provider_ids
+                              if provider_id in provider.cities_by_id]
+                    body = {'cod': 200, 'cnt': len(cities), 'list': cities}
+                else:
+                    body = provider.cities.get(query.get('q', [''])[0].lower(),
+                                               {'cod': '404', 'message': 'city not found'})
+                payload = json.dumps(body).encode()
+                self.send_response(200 if body['cod'] == 200 else 404)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def fake_provider(settings):
+    """Fixture pointing the weather provider URL at a local fake OpenWeatherMap server."""
+    provider = FakeWeatherProvider()
+    provider.thread.start()
+    settings.OWM_API_URL = provider.url
+    settings.WEATHER_PROVIDER_BACKOFF = 0
+    settings.WEATHER_PROVIDER_BACKOFF_JITTER = 0
+    close_weather_client()
+    yield provider
+    close_weather_client()
+    provider.server.shutdown()
+    provider.server.server_close()
@@ -0,0 +1,123 @@
+import pytest
+from cryptography.hazmat.primitives import serialization
+from django.core.cache import cache
+from django.urls import reverse
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from weather.token_backend import LazyKeyTokenBackend
+
+
+@pytest.fixture
+def verifications(monkeypatch):
+    """Fixture counting the access tokens verified with the public key."""
+    calls = []
+    original_get_validated_token = JWTAuthentication.get_validated_token
+
+    def get_validated_token(self, raw_token):
+        calls.append(raw_token)
+        return original_get_validated_token(self, raw_token)
+
+    monkeypatch.setattr(JWTAuthentication, 'get_validated_token', get_validated_token)
+    return calls
+
+
+@pytest.mark.django_db
+def test_token_verified_and_user_loaded_once(api_client, create_user, verifications, django_assert_num_queries):
+    """Test that repeated requests with one token skip the signature check and the user query."""
+    user = create_user(email='test_user@example.com')
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+
+    assert api_client.get(reverse('subscriptions_list')).status_code == 200
+    with django_assert_num_queries(1):
+        assert api_client.get(reverse('subscriptions_list')).status_code == 200
+
+    assert len(verifications) == 1
+
+
+@pytest.mark.django_db
+def test_forged_token_with_cached_jti_rejected(api_client, create_user, verifications):
+    """Test that a token reusing the jti of a cached token is verified again and rejected."""
+    user = create_user(email='test_user@example.com')
+    token = str(AccessToken.for_user(user))
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+    assert api_client.get(reverse('subscriptions_list')).status_code == 200
+
+    header, payload, signature = token.split('.')
+    forged = '.'.join([header, payload, signature[::-1]])
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {forged}")
+    assert api_client.get(reverse('subscriptions_list')).status_code == 401
+    assert len(verifications) == 2
+
+
+@pytest.mark.django_db
+def test_deactivated_and_deleted_users_rejected_at_once(api_client, create_user, django_user_model):
+    """Test that saving or deleting a user drops it from the authentication cache."""
+    user = create_user(email='test_user@example.com')
+    other_user = create_user(email='other_user@example.com')
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(user)}")
+    assert api_client.get(reverse('subscriptions_list')).status_code == 200
+
+    user.is_active = False
+    user.save()
+    assert api_client.get(reverse('subscriptions_list')).status_code == 401
+
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {AccessToken.for_user(other_user)}")
+    assert api_client.get(reverse('subscriptions_list')).status_code == 200
+    django_user_model.objects.get(id=other_user.id).delete()
+    assert api_client.get(reverse('subscriptions_list')).status_code == 401
+
+
+@pytest.mark.django_db
+def test_rotated_refresh_token_rejected_from_cache(api_client, create_user, django_assert_max_num_queries,
+                                                  django_assert_num_queries):
+    """Test that a refresh blacklists the old token in few queries and that replays are rejected without any."""
+    user = create_user(email='test_user@example.com')
+    refresh = str(RefreshToken.for_user(user))
+    url = reverse('token_refresh')
+
+    with django_assert_max_num_queries(3):
+        response = api_client.post(url, {"refresh": refresh}, format='json')
+    assert response.status_code == 200
+    assert BlacklistedToken.objects.get().token.jti == RefreshToken(refresh, verify=False)['jti']
+
+    with django_assert_num_queries(0):
+        assert api_client.post(url, {"refresh": refresh}, format='json').status_code == 401
+
+    cache.clear()
+    with django_assert_num_queries(1):
+        assert api_client.post(url, {"refresh": refresh}, format='json').status_code == 401
+    assert api_client.post(url, {"refresh": response.data['refresh']}, format='json').status_code == 200
+
+
+def test_token_backend_parses_keys_on_first_use(settings, monkeypatch):
+    """Test that the RSA keys are parsed once, when a token is first signed or verified."""
+    parsed = []
+    load_pem_private_key = serialization.load_pem_private_key
+    load_pem_public_key = serialization.load_pem_public_key
+    monkeypatch.setattr(serialization, 'load_pem_private_key',
+                        lambda *args, **kwargs: parsed.append('private') or load_pem_private_key(*args, **kwargs))
+    monkeypatch.setattr(serialization, 'load_pem_public_key',
+                        lambda *args, **kwargs: parsed.append('public') or load_pem_public_key(*args, **kwargs))
+
+    backend = LazyKeyTokenBackend('RS256', settings.RSA_PRIVATE_KEY, settings.RSA_PUBLIC_KEY)
+    assert parsed == []
+    tokens = [backend.encode({'user_id': number}) for number in range(3)]
+    assert parsed == ['private']
+    assert [backend.decode(token)['user_id'] for token in tokens] == [0, 1, 2]
+    assert parsed == ['private', 'public']
+
+
+@pytest.mark.django_db
+def test_login_tokens_accepted(api_client, create_user):
+    """Test that tokens issued at login are accepted by the API and can be refreshed."""
+    create_user(email='test_user@example.com', password='example_pwd_1!')
+    response = api_client.post(reverse('token_obtain_pair'),
+                               {"email": "test_user@example.com", "password": "example_pwd_1!"}, format='json')
+    assert response.status_code == 200
+
+    api_client.credentials(HTTP_AUTHORIZATION=f"Bearer {response.data['access']}")
+    assert api_client.get(reverse('subscriptions_list')).status_code == 200
+    refreshed = api_client.post(reverse('token_refresh'), {"refresh": response.data['refresh']}, format='json')
+    assert refreshed.status_code == 200
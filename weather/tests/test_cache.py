@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from weather.cache import get_weather_cache
+from weather.models import CityWeather
+from weather.tasks import update_weather_table
+from weather.utils import get_cached_weather
+
+
+def test_cached_weather_hits_provider_once(fake_provider):
+    """Test that repeated lookups of a city, however it is spelled, are answered from the cache."""
+    fake_provider.add_city('Wroclaw', 'PL', temperature=12.5)
+
+    weather_data, code = get_cached_weather({'name': 'Wroclaw', 'state': '', 'country_code': 'PL'})
+    weather_data['city'] = 1
+    cached_data, cached_code = get_cached_weather({'name': ' wroclaw', 'state': '', 'country_code': 'pl'})
+
+    assert code == cached_code == 200
+    assert cached_data['temperature'] == 12.5
+    assert 'city' not in cached_data
+    assert len(fake_provider.requests) == 1
+
+
+def test_city_not_found_is_cached(fake_provider):
+    """Test negative caching of unknown cities."""
+    for _ in range(3):
+        weather_data, code = get_cached_weather({'name': 'wrong-city', 'state': '', 'country_code': 'UA'})
+        assert code == '404'
+        assert weather_data['message'] == 'city not found'
+    assert len(fake_provider.requests) == 1
+
+
+def test_shared_tier_survives_local_tier(fake_provider):
+    """Test that a process with a cold local tier is served by the shared tier."""
+    fake_provider.add_city('Wroclaw', 'PL')
+    city_data = {'name': 'Wroclaw', 'state': '', 'country_code': 'PL'}
+    get_cached_weather(city_data)
+
+    get_weather_cache().clear()
+    _, code = get_cached_weather(city_data)
+
+    assert code == 200
+    assert len(fake_provider.requests) == 1
+
+
+@pytest.mark.django_db
+def test_refresh_populates_cache(fake_provider, create_city):
+    """Test that the refresh task leaves fresh responses in the cache for the views."""
+    fake_provider.add_city('Wroclaw', 'PL', temperature=7.0)
+    create_city('Wroclaw', 'PL')
+    CityWeather.objects.update(last_info_update=timezone.now() - timedelta(days=1))
+    update_weather_table()
+
+    weather_data, code = get_cached_weather({'name': 'Wroclaw', 'state': '', 'country_code': 'PL'})
+    assert weather_data['temperature'] == 7.0
+    assert len(fake_provider.requests) == 1
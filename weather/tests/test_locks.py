@@ -0,0 +1,35 @@
+import time
+
+from weather.locks import Lease
+
+
+def test_lease_is_exclusive():
+    """Test that a lease has a single holder until it is released."""
+    lease = Lease('resource', ttl=60)
+    other = Lease('resource', ttl=60)
+
+    assert lease.acquire()
+    assert not other.acquire()
+    assert not other.renew()
+    other.release()
+    assert lease.is_held()
+
+    lease.release()
+    assert other.acquire()
+
+
+def test_lease_expires_without_heartbeat():
+    """Test that the lease of a crashed holder frees the resource after its TTL."""
+    assert Lease('resource', ttl=1).acquire()
+    time.sleep(1.1)
+    assert Lease('resource', ttl=1).acquire()
+
+
+def test_lease_heartbeat_keeps_it_alive():
+    """Test that the heartbeat renews the lease past its TTL."""
+    lease = Lease('resource', ttl=1)
+    assert lease.acquire()
+    with lease.heartbeat(interval=0.2):
+        time.sleep(1.5)
+        assert not Lease('resource', ttl=1).acquire()
+    assert Lease('resource', ttl=1, token=lease.token).is_held()
@@ -0,0 +1,159 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+from datetime import timedelta
+from urllib.request import urlopen
+
+import pytest
+from django.conf import settings as django_settings
+from django.urls import reverse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY
+
+from weather import metrics
+from weather.tasks import update_tables_and_send_emails
+
+METRICS_TOKEN = 'metrics-token'
+
+
+@pytest.fixture
+def metrics_enabled(settings):
+    """Fixture turning metrics on, served at /metrics to requests bearing `METRICS_TOKEN`."""
+    settings.WEATHER_METRICS_ENABLED = True
+    settings.WEATHER_METRICS_TOKEN = METRICS_TOKEN
+
+
+@pytest.fixture
+def start_worker_server(metrics_enabled, settings):
+    """Fixture starting the metrics server of a Celery worker on a free port, shut down after the test."""
+    servers = []
+
+    def start():
+        with socket.socket() as free:
+            free.bind(('127.0.0.1', 0))
+            settings.WEATHER_METRICS_WORKER_PORT = free.getsockname()[1]
+        servers.append(metrics.start_worker_server())
+        return f'http://127.0.0.1:{settings.WEATHER_METRICS_WORKER_PORT}/metrics'
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def scrape(client):
+    """GET /metrics the way Prometheus does."""
+    return client.get(reverse('metrics'), HTTP_AUTHORIZATION=f'Bearer {METRICS_TOKEN}')
+
+
+def logged_metrics(caplog, kind):
+    """The JSON lines of one kind logged by the metrics logger."""
+    return [json.loads(record.getMessage()) for record in caplog.records
+            if record.name == 'weather.metrics' and json.loads(record.getMessage())['kind'] == kind]
+
+
+def sample(name, **labels):
+    """The current value of a series of this process, 0 if it was never recorded."""
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.mark.django_db
+def test_metrics_disabled(api_client_with_authenticated_user, caplog):
+    """Test that nothing is recorded or served while metrics are disabled."""
+    labels = {'view': 'subscriptions_list', 'method': 'GET', 'status': '200'}
+    before = sample('weather_request_duration_seconds_count', **labels)
+    with caplog.at_level('INFO', logger='weather.metrics'):
+        assert api_client_with_authenticated_user.get(reverse('subscriptions_list')).status_code == 200
+    assert api_client_with_authenticated_user.get(reverse('metrics')).status_code == 404
+    assert sample('weather_request_duration_seconds_count', **labels) == before
+    assert not logged_metrics(caplog, 'request')
+
+
+@pytest.mark.django_db
+def test_request_metrics(api_client_with_authenticated_user, metrics_enabled, caplog):
+    """Test that requests are recorded with their query count and served at /metrics."""
+    before = sample('weather_request_queries_sum', view='subscriptions_list', method='GET')
+    with caplog.at_level('INFO', logger='weather.metrics'):
+        assert api_client_with_authenticated_user.get(reverse('subscriptions_list')).status_code == 200
+
+    [line] = logged_metrics(caplog, 'request')
+    assert line['view'] == 'subscriptions_list'
+    assert line['status'] == 200
+    assert line['queries'] == 1
+
+    response = scrape(api_client_with_authenticated_user)
+    assert response.status_code == 200
+    assert response['Content-Type'] == CONTENT_TYPE_LATEST
+    body = response.content.decode()
+    assert 'weather_request_duration_seconds_count{method="GET",status="200",view="subscriptions_list"}' in body
+    assert sample('weather_request_queries_sum', view='subscriptions_list', method='GET') == before + 1
+
+
+@pytest.mark.django_db
+def test_task_metrics(fake_provider, create_user, create_city, create_subscription, settings, metrics_enabled, caplog):
+    """Test that task runs are recorded with the cities, provider calls and emails they processed."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    series = {
+        ('weather_task_processed_total', ('task', 'weather.tasks.refresh_cities_shard'), ('item', 'cities')): 3,
+        ('weather_email_send_duration_seconds_count', ('status', 'sent')): 3,
+        ('weather_email_batch_size_count',): 1,
+        ('weather_provider_request_duration_seconds_count', ('endpoint', 'weather'), ('status', '200')): 3,
+    }
+    before = {key: sample(key[0], **dict(key[1:])) for key in series}
+    for number in range(3):
+        fake_provider.add_city(f'City{number}', 'PL')
+        create_subscription(create_user(email=f'user{number}@example.com'), create_city(f'City{number}', 'PL'),
+                            overdue_by=timedelta(minutes=1))
+
+    with caplog.at_level('INFO', logger='weather.metrics'):
+        update_tables_and_send_emails()
+
+    tasks = {line['task']: line for line in logged_metrics(caplog, 'task')}
+    assert tasks['weather.tasks.refresh_cities_shard']['cities'] == 3
+    assert tasks['weather.tasks.refresh_cities_shard']['provider_calls'] == len(fake_provider.requests)
+    assert tasks['weather.tasks.refresh_cities_shard']['queries'] > 0
+    assert tasks['weather.tasks.send_subscriptions_shard']['subscriptions'] == 3
+    assert tasks['weather.tasks.send_subscriptions_shard']['emails'] == 3
+
+    assert {key: sample(key[0], **dict(key[1:])) - before[key] for key in series} == series
+
+
+def record_in_process(multiproc_dir):
+    """Record the sending of one weather report in a separate interpreter writing to `multiproc_dir`."""
+    code = ('import django; django.setup(); from weather import metrics; '
+            'metrics.record_email("sent", 0.1)')
+    env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(multiproc_dir), 'WEATHER_METRICS_ENABLED': 'True'}
+    subprocess.run([sys.executable, '-c', code], env=env, cwd=django_settings.BASE_DIR, check=True)
+
+
+@pytest.mark.django_db
+def test_metrics_of_all_processes_served(api_client_with_authenticated_user, metrics_enabled, monkeypatch, tmp_path):
+    """Test that /metrics adds up the metrics of every process sharing PROMETHEUS_MULTIPROC_DIR."""
+    record_in_process(tmp_path)
+    record_in_process(tmp_path)
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+
+    body = scrape(api_client_with_authenticated_user).content.decode()
+    assert 'weather_email_send_duration_seconds_count{status="sent"} 2.0' in body
+
+
+def test_worker_metrics_served(start_worker_server, monkeypatch, tmp_path):
+    """Test that a ready Celery worker serves the metrics of its pool processes on its own port."""
+    record_in_process(tmp_path)
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+
+    with urlopen(start_worker_server()) as response:
+        body = response.read().decode()
+    assert 'weather_email_send_duration_seconds_count{status="sent"} 1.0' in body
+
+
+@pytest.mark.django_db
+def test_metrics_served_with_token_only(api_client, metrics_enabled, settings):
+    """Test that /metrics is only served to requests bearing the metrics token, and not at all without one."""
+    assert scrape(api_client).status_code == 200
+    assert api_client.get(reverse('metrics')).status_code == 401
+    assert api_client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code == 401
+
+    settings.WEATHER_METRICS_TOKEN = ''
+    assert scrape(api_client).status_code == 404
@@ -0,0 +1,441 @@
+import smtplib
+import time
+import uuid
+from datetime import timedelta
+
+import pytest
+from celery.app.backends import by_url
+from django.core import mail
+from django.db import connection
+from django.utils import timezone
+from rest_framework_simplejwt.token_blacklist.models import BlacklistedToken, OutstandingToken
+
+from Weather_reminder.celery import app as celery_app
+from weather import tasks
+from weather.models import CityName, CityWeather, Notification, UserSubscription
+from weather.tasks import (clean_weather_data, notify_due_subscriptions, pk_shards, prune_expired_tokens,
+                           prune_notifications, refresh_cities_shard, remove_unused_cities, run_lease,
+                           save_weather_batch, send_weather_reports, update_tables_and_send_emails,
+                           update_weather_table)
+from weather.utils import RateLimiter, WeatherFetcher
+
+
+@pytest.mark.django_db
+def test_update_weather_table(fake_provider, create_city):
+    """Test refreshing the weather of stale cities against the fake provider."""
+    fake_provider.add_city('Wroclaw', 'PL', temperature=12.5)
+    fake_provider.add_city('Austin', 'US', state='TX', temperature=30.0)
+    wroclaw = create_city('Wroclaw', 'PL')
+    austin = create_city('Austin', 'US', state='TX')
+    unknown = create_city('Atlantis', 'GR', temperature=-1.0)
+    CityWeather.objects.update(last_info_update=timezone.now() - timedelta(days=1))
+
+    update_weather_table()
+
+    assert CityWeather.objects.get(city=wroclaw).temperature == 12.5
+    assert CityWeather.objects.get(city=austin).temperature == 30.0
+    assert CityWeather.objects.get(city=unknown).temperature == -1.0
+    assert len(fake_provider.requests) == 3
+
+
+@pytest.mark.django_db
+def test_update_weather_table_fetches_only_demanded_cities(fake_provider, create_user, create_city,
+                                                           create_subscription):
+    """Test that only cities with subscribers due soon or stale weather are fetched, each once."""
+    for name in ('DueSoon', 'Later', 'Stale', 'Popular'):
+        fake_provider.add_city(name, 'PL')
+    due_soon, later, stale, popular = [create_city(name, 'PL') for name in ('DueSoon', 'Later', 'Stale', 'Popular')]
+    create_city('Unsubscribed', 'PL')
+    user = create_user(email='test_user@example.com')
+    create_subscription(user, due_soon, notification_frequency=1)
+    create_subscription(user, later, notification_frequency=12)
+    create_subscription(user, stale, notification_frequency=12)
+    for number in range(3):
+        create_subscription(create_user(email=f'user{number}@example.com'), popular, overdue_by=timedelta(0))
+    CityWeather.objects.filter(city=stale).update(last_info_update=timezone.now() - timedelta(days=1))
+
+    update_weather_table()
+
+    fetched = sorted(query['q'][0] for _, query in fake_provider.requests)
+    assert fetched == ['DueSoon,,PL', 'Popular,,PL', 'Stale,,PL']
+
+
+@pytest.mark.django_db
+def test_save_weather_batch_upserts_in_one_statement(django_assert_num_queries, create_city):
+    """Test that a batch updates existing rows and creates missing ones with a single query."""
+    weather_data = {'weather_description': 'rain', 'temperature': 5, 'feels_like': 3, 'humidity': 90,
+                    'pressure': 1000, 'visibility': 5000, 'wind_speed': 7.5}
+    existing = create_city('Wroclaw', 'PL')
+    missing = CityName.objects.create(name='Gdansk', state='', country_code='PL')
+
+    with django_assert_num_queries(1):
+        assert save_weather_batch([(existing, weather_data), (missing, weather_data)]) == 2
+
+    assert CityWeather.objects.count() == 2
+    assert CityWeather.objects.get(city=existing).weather_description == 'rain'
+    assert CityWeather.objects.get(city=missing).rain == 0.0
+
+
+def test_clean_weather_data_rejects_invalid_payload():
+    """Test that payloads with missing or malformed fields are rejected."""
+    with pytest.raises(ValueError):
+        clean_weather_data({'weather_description': 'rain', 'temperature': 'hot'})
+    with pytest.raises(ValueError):
+        clean_weather_data({'temperature': 5})
+
+
+def test_weather_fetcher_runs_concurrently(fake_provider):
+    """Test that lookups overlap instead of running one after another."""
+    fake_provider.latency = 0.2
+    cities_data = []
+    for number in range(5):
+        fake_provider.add_city(f'City{number}', 'PL')
+        cities_data.append({'name': f'City{number}', 'state': '', 'country_code': 'PL'})
+
+    started = time.monotonic()
+    with WeatherFetcher(concurrency=5, rate_limit=0) as fetcher:
+        results = fetcher.fetch(cities_data)
+    elapsed = time.monotonic() - started
+
+    assert [code for _, code in results] == [200] * 5
+    assert elapsed < 0.2 * 5 / 2
+
+
+def test_rate_limiter_enforces_budget():
+    """Test that calls beyond the budget wait for the next period, whichever shard's limiter makes them."""
+    shards = [RateLimiter(2, period=0.2), RateLimiter(2, period=0.2)]
+    started = time.monotonic()
+    for number in range(6):
+        shards[number % 2].acquire()
+    # two calls per period: the last two cannot start before a whole period went by
+    assert time.monotonic() - started >= 0.19
+
+
+@pytest.mark.django_db
+def test_subscription_schedule_kept_on_save(create_user, create_city, create_subscription):
+    """Test that creating or editing a subscription schedules its next notification."""
+    user = create_user(email='test_user@example.com')
+    subscription = create_subscription(user, create_city('Wroclaw', 'PL'), notification_frequency=3)
+    assert subscription.next_notify_at == subscription.last_info_update + timedelta(hours=3)
+
+    subscription.notification_frequency = 6
+    subscription.save(update_fields=['notification_frequency'])
+    subscription.refresh_from_db()
+    assert subscription.next_notify_at == subscription.last_info_update + timedelta(hours=6)
+
+
+@pytest.mark.django_db
+def test_notify_due_subscriptions_notifies_only_due(create_user, settings, django_assert_max_num_queries, create_city,
+                                                    create_subscription):
+    """Test that the sending stage of a run notifies only due subscriptions, with a constant number of queries."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    city = create_city('Wroclaw', 'PL')
+    due = [create_subscription(create_user(email=f'due{number}@example.com'), city, overdue_by=timedelta(minutes=1))
+           for number in range(5)]
+    not_due = create_subscription(create_user(email='not_due@example.com'), city, notification_frequency=24)
+    lease = run_lease()
+    assert lease.acquire()
+
+    with django_assert_max_num_queries(12):
+        notify_due_subscriptions([], timezone.now().isoformat(), lease.token)
+
+    assert sorted(message.to[0] for message in mail.outbox) == sorted(sub.user.email for sub in due)
+    for subscription in due:
+        subscription.refresh_from_db()
+        assert subscription.next_notify_at > timezone.now()
+    assert not UserSubscription.objects.due().filter(id=not_due.id).exists()
+    assert run_lease().acquire()
+
+
+@pytest.mark.django_db
+def test_send_weather_reports_reuses_one_connection(create_user, settings, monkeypatch, create_city,
+                                                    create_subscription):
+    """Test that a dispatch batch opens a single connection and sends in throttled chunks, one call per chunk."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    settings.WEATHER_EMAIL_BATCH_SIZE = 2
+    settings.WEATHER_EMAIL_THROTTLE = 0.5
+    connections = []
+    sleeps = []
+    chunks = []
+    original_get_connection = tasks.get_connection
+
+    def get_connection(**kwargs):
+        connection = original_get_connection(**kwargs)
+        original_send_messages = connection.send_messages
+
+        def send_messages(messages):
+            messages = list(messages)
+            chunks.append(len(messages))
+            return original_send_messages(messages)
+
+        connection.send_messages = send_messages
+        connections.append(connection)
+        return connection
+
+    monkeypatch.setattr(tasks, 'get_connection', get_connection)
+    monkeypatch.setattr(tasks.time, 'sleep', sleeps.append)
+    city = create_city('Wroclaw', 'PL')
+    subscriptions = [create_subscription(create_user(email=f'user{number}@example.com'), city,
+                                         overdue_by=timedelta(minutes=1))
+                     for number in range(5)]
+
+    assert send_weather_reports([subscription.id for subscription in subscriptions]) == 5
+    assert send_weather_reports([subscription.id for subscription in subscriptions]) == 0
+    assert len(mail.outbox) == 5
+    assert 'Wroclaw' in mail.outbox[0].alternatives[0][0]
+    assert len(connections) == 1
+    assert chunks == [2, 2, 1]
+    # three chunks of at most two reports, with a pause between each two
+    assert sleeps == [0.5, 0.5]
+
+
+@pytest.mark.django_db
+def test_send_weather_reports_records_delivered_slots(create_user, settings, create_city, create_subscription):
+    """Test that every report sent is recorded in the ledger and a repeated task sends nothing."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    city = create_city('Wroclaw', 'PL')
+    subscription = create_subscription(create_user(email='user@example.com'), city, overdue_by=timedelta(minutes=1))
+    slot = UserSubscription.objects.get(id=subscription.id).next_notify_at
+
+    assert send_weather_reports([subscription.id]) == 1
+    UserSubscription.objects.filter(id=subscription.id).update(next_notify_at=slot)
+    assert send_weather_reports([subscription.id]) == 0
+
+    assert len(mail.outbox) == 1
+    notification = Notification.objects.get()
+    assert (notification.subscription_id, notification.slot) == (subscription.id, slot)
+    assert notification.status == Notification.DELIVERED
+    assert notification.delivered_at is not None
+
+
+@pytest.mark.django_db
+def test_send_weather_reports_skips_slots_claimed_by_another_worker(create_user, settings, create_city,
+                                                                    create_subscription):
+    """Test that a slot claimed by another worker is left to it until the claim expires."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    city = create_city('Wroclaw', 'PL')
+    subscription = create_subscription(create_user(email='user@example.com'), city, overdue_by=timedelta(minutes=1))
+    slot = UserSubscription.objects.get(id=subscription.id).next_notify_at
+    Notification.objects.create(subscription=subscription, slot=slot, claim_token=uuid.uuid4())
+
+    assert send_weather_reports([subscription.id]) == 0
+    assert len(mail.outbox) == 0
+
+    expired_at = timezone.now() - timedelta(seconds=settings.WEATHER_NOTIFICATION_CLAIM_TIMEOUT + 1)
+    Notification.objects.update(claimed_at=expired_at)
+    assert send_weather_reports([subscription.id]) == 1
+    assert len(mail.outbox) == 1
+    assert Notification.objects.get().status == Notification.DELIVERED
+
+
+@pytest.mark.django_db
+def test_send_weather_reports_retries_failed_sends(create_user, settings, monkeypatch, create_city,
+                                                   create_subscription):
+    """Test that a message rejected within a chunk leaves its subscription due, and the rest of the chunk is sent."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    city = create_city('Wroclaw', 'PL')
+    failing = create_subscription(create_user(email='failing@example.com'), city, overdue_by=timedelta(minutes=1))
+    working = create_subscription(create_user(email='working@example.com'), city, overdue_by=timedelta(minutes=1))
+    other = create_subscription(create_user(email='other@example.com'), city, overdue_by=timedelta(minutes=1))
+    original_build_report_email = tasks.build_report_email
+
+    def build_report_email(subscription):
+        message = original_build_report_email(subscription)
+        if subscription.id == failing.id:
+            def refuse():
+                raise smtplib.SMTPRecipientsRefused({subscription.user.email: (550, b'rejected')})
+            message.message = refuse
+        return message
+
+    monkeypatch.setattr(tasks, 'build_report_email', build_report_email)
+    assert send_weather_reports([failing.id, working.id, other.id]) == 2
+    assert sorted(message.to[0] for message in mail.outbox) == ['other@example.com', 'working@example.com']
+    assert UserSubscription.objects.due().filter(id=failing.id).exists()
+    assert Notification.objects.get(subscription=failing).status == Notification.FAILED
+
+    monkeypatch.setattr(tasks, 'build_report_email', original_build_report_email)
+    assert send_weather_reports([failing.id, working.id, other.id]) == 1
+    assert mail.outbox[-1].to == ['failing@example.com']
+    assert not UserSubscription.objects.due().filter(id=failing.id).exists()
+    assert Notification.objects.get(subscription=failing).status == Notification.DELIVERED
+
+
+@pytest.mark.django_db
+def test_weather_report_rendered_once_per_city_refresh(create_user, settings, monkeypatch, create_city,
+                                                       create_subscription):
+    """Test that subscribers of one city share a single rendering until the weather is refreshed."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    monkeypatch.setattr(tasks, '_rendered_reports', type(tasks._rendered_reports)())
+    renders = []
+    original_render_to_string = tasks.render_to_string
+
+    def render_to_string(template_name, context):
+        renders.append(context['city_data']['name'])
+        return original_render_to_string(template_name, context)
+
+    monkeypatch.setattr(tasks, 'render_to_string', render_to_string)
+    city = create_city('Wroclaw', 'PL')
+    subscriptions = [create_subscription(create_user(email=f'user{number}@example.com'), city,
+                                         overdue_by=timedelta(minutes=1))
+                     for number in range(3)]
+
+    send_weather_reports([subscription.id for subscription in subscriptions])
+    assert renders == ['Wroclaw']
+
+    CityWeather.objects.filter(city=city).update(last_info_update=timezone.now() + timedelta(hours=1))
+    UserSubscription.objects.update(next_notify_at=timezone.now() - timedelta(minutes=1))
+    send_weather_reports([subscription.id for subscription in subscriptions])
+    assert renders == ['Wroclaw', 'Wroclaw']
+    assert len(mail.outbox) == 6
+
+
+@pytest.mark.django_db
+def test_remove_unused_cities(create_user, create_city, create_subscription):
+    """Test that the periodic sweep deletes only cities without subscribers."""
+    used = create_city('Wroclaw', 'PL')
+    create_subscription(create_user(email='test_user@example.com'), used)
+    create_city('Gdansk', 'PL')
+    create_city('Austin', 'US', state='TX')
+
+    assert remove_unused_cities() == 4
+
+    assert list(CityName.objects.all()) == [used]
+    assert CityWeather.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_update_weather_table_uses_group_endpoint(fake_provider, create_city):
+    """Test that cities with a provider id are refreshed 20 per call, the others one by one."""
+    for number in range(25):
+        city = create_city(f'City{number}', 'PL')
+        city.provider_id = fake_provider.add_city(f'City{number}', 'PL', temperature=number)
+        city.save()
+    gone = create_city('Gone', 'PL')
+    gone.provider_id = 1
+    gone.save()
+    fake_provider.add_city('NoId', 'PL')
+    no_id = create_city('NoId', 'PL')
+    CityWeather.objects.update(last_info_update=timezone.now() - timedelta(days=1))
+
+    update_weather_table()
+
+    paths = sorted(path.rsplit('/', 1)[1] for path, _ in fake_provider.requests)
+    assert paths == ['group', 'group', 'weather', 'weather']
+    assert CityWeather.objects.get(city__name='City24').temperature == 24
+    no_id.refresh_from_db()
+    assert no_id.provider_id == fake_provider.cities['noid,,pl']['id']
+    assert (no_id.latitude, no_id.longitude) == (51.1, 17.03)
+
+
+@pytest.mark.django_db
+def test_update_tables_and_send_emails_in_shards(fake_provider, create_user, settings, caplog, create_city,
+                                                 create_subscription):
+    """Test a whole sharded run in Celery's eager mode."""
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    settings.WEATHER_CITY_SHARD_SIZE = 2
+    settings.WEATHER_SUBSCRIPTION_SHARD_SIZE = 2
+    for number in range(3):
+        fake_provider.add_city(f'City{number}', 'PL', temperature=number + 10)
+        city = create_city(f'City{number}', 'PL')
+        for user_number in range(2):
+            create_subscription(create_user(email=f'user{number}_{user_number}@example.com'), city,
+                                overdue_by=timedelta(minutes=1))
+
+    with caplog.at_level('INFO'):
+        update_tables_and_send_emails()
+
+    assert sorted(CityWeather.objects.values_list('temperature', flat=True)) == [10, 11, 12]
+    assert len(mail.outbox) == 6
+    assert not UserSubscription.objects.due().exists()
+    assert ("'city_shards': 2, 'cities_refreshed': 3, 'subscription_shards': 3, 'reports_sent': 6"
+            in caplog.text)
+
+
+def test_result_backend_supports_chords():
+    """Test that the configured result backend can run the chords of an hourly run outside eager mode."""
+    backend_class, url = by_url(celery_app.conf.result_backend, celery_app.loader)
+    backend_class(app=celery_app, url=url).ensure_chords_allowed()
+
+
+@pytest.mark.django_db
+def test_prune_expired_tokens_in_chunks(create_user, settings, django_assert_max_num_queries):
+    """Test that expired tokens and their blacklist entries are deleted chunk by chunk, and live ones are kept."""
+    settings.WEATHER_TOKEN_PRUNE_CHUNK_SIZE = 2
+    user = create_user(email='test_user@example.com')
+    now = timezone.now()
+    tokens = OutstandingToken.objects.bulk_create([
+        OutstandingToken(user=user, jti=f'jti-{number}', token='', expires_at=now + timedelta(hours=number - 5))
+        for number in range(8)
+    ])
+    BlacklistedToken.objects.bulk_create([BlacklistedToken(token=token) for token in tokens[::2]])
+
+    # three chunks of a lookup, a savepoint, the collected ids, two deletes and the release, then an empty lookup
+    with django_assert_max_num_queries(3 * 6 + 1):
+        assert prune_expired_tokens(now) == 6
+    assert list(OutstandingToken.objects.order_by('jti').values_list('jti', flat=True)) == ['jti-6', 'jti-7']
+    assert list(BlacklistedToken.objects.values_list('token__jti', flat=True)) == ['jti-6']
+    with connection.cursor() as cursor:
+        indexes = connection.introspection.get_constraints(cursor, OutstandingToken._meta.db_table)
+    assert indexes['weather_outstandingtoken_expiry']['columns'] == ['expires_at', 'id']
+
+
+@pytest.mark.django_db
+def test_prune_notifications(create_user, create_city, create_subscription, settings):
+    """Test that ledger entries are deleted once their slot is older than the retention, whatever their status."""
+    settings.WEATHER_NOTIFICATION_PRUNE_CHUNK_SIZE = 2
+    subscription = create_subscription(create_user(email='test_user@example.com'), create_city('Wroclaw', 'PL'))
+    now = timezone.now()
+    retention = timedelta(seconds=settings.WEATHER_NOTIFICATION_RETENTION)
+    Notification.objects.bulk_create([
+        Notification(subscription=subscription, slot=now - retention - timedelta(hours=hours), status=status,
+                     claim_token=uuid.uuid4())
+        for hours, status in [(1, Notification.DELIVERED), (2, Notification.DELIVERED), (3, Notification.FAILED)]
+    ] + [Notification(subscription=subscription, slot=now - timedelta(hours=1), claim_token=uuid.uuid4())])
+
+    assert prune_notifications(now) == 3
+    assert list(Notification.objects.values_list('slot', flat=True)) == [now - timedelta(hours=1)]
+
+
+@pytest.mark.django_db
+def test_pk_shards(create_city):
+    """Test partitioning rows into primary key ranges."""
+    ids = [create_city(f'City{number}', 'PL').id for number in range(5)]
+    assert pk_shards(CityName.objects.all(), 2) == [(ids[0], ids[1]), (ids[2], ids[3]), (ids[4], ids[4])]
+    assert pk_shards(CityName.objects.none(), 2) == []
+
+
+@pytest.mark.django_db
+def test_overlapping_run_skipped(fake_provider, create_city):
+    """Test that a run started while another one holds the lease does nothing."""
+    fake_provider.add_city('Wroclaw', 'PL')
+    create_city('Wroclaw', 'PL')
+    CityWeather.objects.update(last_info_update=timezone.now() - timedelta(days=1))
+    running = run_lease()
+    assert running.acquire()
+
+    assert update_tables_and_send_emails() is None
+    assert fake_provider.requests == []
+
+    running.release()
+    update_tables_and_send_emails()
+    assert len(fake_provider.requests) == 1
+    assert run_lease().acquire()
+
+
+@pytest.mark.django_db
+def test_shard_of_expired_run_skipped(fake_provider, create_city):
+    """Test that a shard picked up after its run lost the lease does nothing, and that a picked up shard renews it."""
+    fake_provider.add_city('Wroclaw', 'PL')
+    city = create_city('Wroclaw', 'PL')
+    CityWeather.objects.update(last_info_update=timezone.now() - timedelta(days=1))
+    started_at = timezone.now().isoformat()
+
+    assert refresh_cities_shard(city.id, city.id, started_at, run_lease().token) == 0
+    assert fake_provider.requests == []
+
+    lease = run_lease()
+    assert lease.acquire()
+    lease.cache.touch(lease.key, 1)
+    assert refresh_cities_shard(city.id, city.id, started_at, lease.token) == 1
+    time.sleep(1.1)
+    assert lease.is_held()
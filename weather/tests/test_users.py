@@ -2,6 +2,8 @@ import pytest
 import json
 from django.urls import reverse
 
+from weather.models import CustomUser
+
 
 @pytest.mark.django_db
 def test_registration(api_client):
@@ -34,6 +36,24 @@ def test_registration_fail(api_client):
     assert response_json['error'] == {'email': ['Enter a valid email address.']}
 
 
+@pytest.mark.django_db
+def test_registration_duplicate_email(api_client, django_assert_max_num_queries):
+    """Test that a duplicate email is rejected by the unique index, with one insert and its savepoint per attempt."""
+    url = reverse('register')
+    data = {
+        "email": "test_user@example.com",
+        "password": "example_pwd_1!",
+        "password2": "example_pwd_1!"
+    }
+    with django_assert_max_num_queries(4):
+        assert api_client.post(url, data, format='json').status_code == 201
+    with django_assert_max_num_queries(4):
+        response = api_client.post(url, data, format='json')
+    assert response.status_code == 400
+    assert json.loads(response.content)['error'] == {'email': ['User with this email already exists.']}
+    assert CustomUser.objects.get(email=data['email']).is_active
+
+
 @pytest.mark.django_db
 def test_delete_account(api_client_with_authenticated_user):
     """Test account deletion."""
@@ -0,0 +1,67 @@
+from asgiref.sync import async_to_sync
+
+from weather.utils import aget_weather, get_weather
+
+WROCLAW = {'name': 'Wroclaw', 'state': '', 'country_code': 'PL'}
+
+
+def test_get_weather_retries_server_errors(fake_provider):
+    """Test that transient provider errors are retried."""
+    fake_provider.add_city('Wroclaw', 'PL', temperature=12.5)
+    fake_provider.failures = 2
+
+    weather_data, code = get_weather(WROCLAW)
+
+    assert code == 200
+    assert weather_data['temperature'] == 12.5
+    assert len(fake_provider.requests) == 3
+
+
+def test_get_weather_times_out(fake_provider, settings):
+    """Test that a hanging provider connection is abandoned after the read timeout."""
+    settings.WEATHER_PROVIDER_READ_TIMEOUT = 0.1
+    settings.WEATHER_PROVIDER_RETRIES = 0
+    fake_provider.add_city('Wroclaw', 'PL')
+    fake_provider.latency = 0.5
+
+    weather_data, code = get_weather(WROCLAW)
+
+    assert code == 503
+    assert weather_data['message'] == 'weather provider is unavailable'
+
+
+def test_circuit_breaker_fails_fast(fake_provider, settings):
+    """Test that the provider is no longer called once the breaker is open."""
+    settings.WEATHER_PROVIDER_RETRIES = 0
+    settings.WEATHER_PROVIDER_BREAKER_THRESHOLD = 2
+    fake_provider.add_city('Wroclaw', 'PL')
+    fake_provider.failures = 10
+
+    codes = [get_weather(WROCLAW)[1] for _ in range(4)]
+
+    assert codes == [503] * 4
+    assert len(fake_provider.requests) == 2
+
+
+def test_aget_weather_retries_server_errors(fake_provider):
+    """Test that the async provider client retries transient errors like the sync one."""
+    fake_provider.add_city('Wroclaw', 'PL', temperature=12.5)
+    fake_provider.failures = 2
+
+    weather_data, code = async_to_sync(aget_weather)(WROCLAW)
+
+    assert code == 200
+    assert weather_data['temperature'] == 12.5
+    assert len(fake_provider.requests) == 3
+
+
+def test_aget_weather_gives_up(fake_provider, settings):
+    """Test that the async provider client reports an unavailable provider once retries are exhausted."""
+    settings.WEATHER_PROVIDER_RETRIES = 1
+    fake_provider.failures = 10
+
+    weather_data, code = async_to_sync(aget_weather)(WROCLAW)
+
+    assert code == 503
+    assert weather_data['message'] == 'weather provider is unavailable'
+    assert len(fake_provider.requests) == 2
@@ -1,11 +1,23 @@
+import asyncio
+import time
+from datetime import timedelta
+
 import pytest
 import json
+from asgiref.sync import async_to_sync
+from django.db import IntegrityError, connection
 from django.urls import reverse
+from django.utils import timezone
+from rest_framework_simplejwt.tokens import AccessToken
+
+from weather import tasks, utils, views
+from weather.models import CityName, CityWeather, CustomUser, UserSubscription
 
 
 @pytest.mark.django_db(reset_sequences=True)
-def test_new_subscription(api_client_with_authenticated_user):
+def test_new_subscription(api_client_with_authenticated_user, fake_provider):
     """Test creating a new subscription."""
+    fake_provider.add_city('Wroclaw', 'PL')
     url = reverse('new_subscription')
     data = {
         "city": {
@@ -23,7 +35,7 @@ def test_new_subscription(api_client_with_authenticated_user):
 
 
 @pytest.mark.django_db(reset_sequences=True)
-def test_new_subscription_city_not_exist(api_client_with_authenticated_user):
+def test_new_subscription_city_not_exist(api_client_with_authenticated_user, fake_provider):
     """Test creating a new subscription with a city that does not exist."""
     url = reverse('new_subscription')
     data = {
@@ -71,7 +83,44 @@ def test_get_subscriptions_list(api_client_with_authenticated_user, subscription
     response = api_client_with_authenticated_user.get(url_subscriptions_list)
     response_json = json.loads(response.content)
     assert response.status_code == 200
-    assert response_json == subscriptions_list
+    assert response_json['results'] == subscriptions_list
+
+
+@pytest.mark.django_db
+def test_get_subscriptions_list_single_query(api_client_with_authenticated_user, create_city, create_subscription,
+                                             django_assert_num_queries):
+    """Test that listing subscriptions costs one query however many subscriptions there are."""
+    user = CustomUser.objects.get(email='test_user@example.com')
+    for number in range(20):
+        create_subscription(user, create_city(f'City{number}', 'PL'), notification_frequency=2)
+    url = reverse('subscriptions_list')
+
+    with django_assert_num_queries(1):
+        response = api_client_with_authenticated_user.get(url, {'page_size': 15})
+
+    response_json = json.loads(response.content)
+    assert response.status_code == 200
+    assert len(response_json['results']) == 15
+    assert response_json['results'][0]['city'] == {'name': 'City0', 'state': '', 'country_code': 'PL'}
+
+    response_json = json.loads(api_client_with_authenticated_user.get(response_json['next']).content)
+    assert len(response_json['results']) == 5
+    assert response_json['next'] is None
+
+
+@pytest.mark.django_db
+def test_get_subscriptions_list_fields(api_client_with_authenticated_user, create_city, create_subscription):
+    """Test restricting the listed subscription fields."""
+    user = CustomUser.objects.get(email='test_user@example.com')
+    for number in range(2):
+        create_subscription(user, create_city(f'City{number}', 'PL'), notification_frequency=2)
+    url = reverse('subscriptions_list')
+
+    response = api_client_with_authenticated_user.get(url, {'fields': 'id,notification_frequency'})
+
+    response_json = json.loads(response.content)
+    assert response.status_code == 200
+    assert [set(subscription) for subscription in response_json['results']] == [{'id', 'notification_frequency'}] * 2
 
 
 @pytest.mark.django_db(reset_sequences=True)
@@ -99,7 +148,7 @@ def test_edit_subscription(api_client_with_authenticated_user, subscription):
     response = api_client_with_authenticated_user.get(url_subscriptions_list)
     response_json = json.loads(response.content)
     data['id'] = 1
-    assert data in response_json
+    assert data in response_json['results']
 
 
 @pytest.mark.django_db(reset_sequences=True)
@@ -120,3 +169,387 @@ def test_delete_subscription_fail(api_client_with_authenticated_user, subscripti
     response_json = json.loads(response.content)
     assert response.status_code == 404
     assert response_json['res'] == "Subscription with id=2 does not exist for this user"
+
+
+@pytest.mark.django_db
+def test_delete_subscription_removes_only_its_unused_city(api_client_with_authenticated_user, create_user, create_city,
+                                                          create_subscription):
+    """Test that deleting a subscription removes its city when unused, leaving other cities to the sweep."""
+    user = CustomUser.objects.get(email='test_user@example.com')
+    for number in range(2):
+        create_subscription(user, create_city(f'City{number}', 'PL'), notification_frequency=2)
+    other_user = create_user(email='other_user@example.com')
+    shared = UserSubscription.objects.get(city__name='City1')
+    UserSubscription.objects.create(user=other_user, city=shared.city, weather_info=shared.weather_info,
+                                    notification_frequency=5)
+    orphan = CityName.objects.create(name='Orphan', state='', country_code='PL')
+
+    for subscription in UserSubscription.objects.filter(user__email='test_user@example.com'):
+        url = reverse('subscription_action', kwargs={'id': subscription.id})
+        assert api_client_with_authenticated_user.delete(url).status_code == 200
+
+    assert set(CityName.objects.values_list('name', flat=True)) == {'City1', 'Orphan'}
+    assert CityName.objects.filter(id=orphan.id).exists()
+
+
+@pytest.mark.django_db
+def test_resolve_city_is_case_and_space_insensitive(django_assert_num_queries):
+    """Test that differently written locations resolve to one city with a single indexed query."""
+    city, created = CityName.objects.resolve({'name': ' New  York ', 'state': 'ny', 'country_code': 'us'})
+    assert created
+    assert (city.name, city.state, city.country_code) == ('New York', 'NY', 'US')
+
+    with django_assert_num_queries(1):
+        same_city, created = CityName.objects.resolve({'name': 'new york', 'state': 'NY', 'country_code': 'US'})
+    assert not created
+    assert same_city == city
+
+
+@pytest.mark.django_db
+def test_duplicate_city_rejected_by_database():
+    """Test that the unique location index prevents duplicate cities."""
+    CityName.objects.create(name='Wroclaw', state='', country_code='PL')
+    with pytest.raises(IntegrityError):
+        CityName.objects.create(name='WROCLAW', state='', country_code='PL')
+
+
+@pytest.mark.django_db
+def test_new_subscription_reuses_existing_city(api_client_with_authenticated_user, fake_provider):
+    """Test that subscribing to a known city written differently does not create a new one."""
+    fake_provider.add_city('wroclaw', 'PL')
+    CityName.objects.create(name='Wroclaw', state='', country_code='PL')
+    url = reverse('new_subscription')
+    data = {"city": {"name": "wroclaw", "state": "", "country_code": "pl"}, "notification_frequency": 2}
+
+    response = api_client_with_authenticated_user.post(url, data, format='json')
+
+    assert response.status_code == 201
+    assert CityName.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_new_subscription_to_known_city_skips_provider(api_client_with_authenticated_user, create_user,
+                                                      create_city, create_subscription, fake_provider):
+    """Test that subscribing to a city with recent weather, or subscribing twice, does not call the provider."""
+    fake_provider.add_city('Wroclaw', 'PL')
+    create_subscription(create_user(email='other_user@example.com'), create_city('City0', 'PL'),
+                        notification_frequency=2)
+    url = reverse('new_subscription')
+    data = {"city": {"name": "city0", "state": "", "country_code": "pl"}, "notification_frequency": 2}
+
+    response = api_client_with_authenticated_user.post(url, data, format='json')
+    assert response.status_code == 201
+    response = api_client_with_authenticated_user.post(url, data, format='json')
+    assert response.status_code == 400
+
+    assert fake_provider.requests == []
+    assert UserSubscription.objects.filter(user__email='test_user@example.com', city__name='City0').exists()
+
+
+@pytest.mark.django_db
+def test_new_subscription_refreshes_stale_city(api_client_with_authenticated_user, create_user, create_city,
+                                               create_subscription, fake_provider, settings):
+    """Test that a known city whose weather is stale is fetched again and its weather updated."""
+    fake_provider.add_city('City0', 'PL', temperature=25.0)
+    create_subscription(create_user(email='other_user@example.com'), create_city('City0', 'PL'),
+                        notification_frequency=2)
+    stale_at = timezone.now() - timedelta(seconds=settings.WEATHER_MAX_STALENESS + 60)
+    CityWeather.objects.update(last_info_update=stale_at)
+    data = {"city": {"name": "City0", "state": "", "country_code": "PL"}, "notification_frequency": 2}
+
+    response = api_client_with_authenticated_user.post(reverse('new_subscription'), data, format='json')
+
+    assert response.status_code == 201
+    assert len(fake_provider.requests) == 1
+    city_weather = CityWeather.objects.get()
+    assert city_weather.temperature == 25.0
+    assert city_weather.last_info_update > stale_at
+
+
+def bearer(user):
+    """Return the Authorization header value of a fresh access token of `user`."""
+    return f"Bearer {AccessToken.for_user(user)}"
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_new_subscription(create_user, fake_provider, client, monkeypatch):
+    """Test creating and editing a subscription through the async endpoints."""
+    removals = []
+    remove_unused_city = views.remove_unused_city
+
+    def recorded_remove_unused_city(city_id):
+        removals.append(connection.in_atomic_block)
+        remove_unused_city(city_id)
+
+    monkeypatch.setattr(views, 'remove_unused_city', recorded_remove_unused_city)
+    fake_provider.add_city('Wroclaw', 'PL')
+    fake_provider.add_city('Krakow', 'PL')
+    user = create_user(email='test_user@example.com')
+    data = {"city": {"name": "Wroclaw", "state": "", "country_code": "PL"}, "notification_frequency": 2}
+
+    response = client.post(reverse('async_new_subscription'), data, content_type='application/json',
+                           HTTP_AUTHORIZATION=bearer(user))
+    assert response.status_code == 201
+    assert response.json()['res'] == 'New subscription created successfully'
+    subscription = UserSubscription.objects.select_related('city', 'weather_info').get(user=user)
+    assert (subscription.city.name, subscription.city.provider_id) == ('Wroclaw', 1000)
+    assert subscription.weather_info.city_id == subscription.city_id
+
+    response = client.post(reverse('async_new_subscription'), data, content_type='application/json',
+                           HTTP_AUTHORIZATION=bearer(user))
+    assert response.status_code == 400
+
+    data = {"city": {"name": "Krakow", "state": "", "country_code": "PL"}}
+    response = client.put(reverse('async_subscription_action', kwargs={'id': subscription.id}), data,
+                          content_type='application/json', HTTP_AUTHORIZATION=bearer(user))
+    assert response.status_code == 200
+    subscription.refresh_from_db()
+    assert (subscription.city.name, subscription.notification_frequency) == ('Krakow', 2)
+    assert not CityName.objects.filter(name='Wroclaw').exists()
+    # the previous city is removed in the transaction holding the subscription lock
+    assert removals == [True]
+
+
+@pytest.mark.django_db
+def test_async_subscription_errors(create_user, fake_provider, client):
+    """Test that the async endpoints reject anonymous requests, unknown cities and foreign subscriptions."""
+    user = create_user(email='test_user@example.com')
+    other_user = create_user(email='other_user@example.com')
+    city = CityName.objects.create(name='Wroclaw', state='', country_code='PL')
+    foreign = UserSubscription.objects.create(user=other_user, city=city, notification_frequency=1)
+    data = {"city": {"name": "wrong-city", "state": "", "country_code": "UA"}, "notification_frequency": 2}
+
+    response = client.post(reverse('async_new_subscription'), data, content_type='application/json')
+    assert response.status_code == 401
+
+    response = client.post(reverse('async_new_subscription'), data, content_type='application/json',
+                           HTTP_AUTHORIZATION=bearer(user))
+    assert response.status_code == 404
+    assert response.json()['error'] == 'city not found'
+
+    response = client.put(reverse('async_subscription_action', kwargs={'id': foreign.id}), data,
+                          content_type='application/json', HTTP_AUTHORIZATION=bearer(user))
+    assert response.status_code == 400
+    assert response.json()['res'] == f"Subscription with id={foreign.id} does not exist for this user"
+
+
+@pytest.mark.django_db
+def test_async_weather_clients_closed_with_their_loop(create_user, fake_provider, client, monkeypatch):
+    """Test that requests served each on their own event loop do not leave provider clients open."""
+    opened = []
+
+    class RecordedClient(utils.AsyncWeatherClient):
+        def __init__(self):
+            super().__init__()
+            opened.append(self)
+
+    monkeypatch.setattr(utils, 'AsyncWeatherClient', RecordedClient)
+    user = create_user(email='test_user@example.com')
+    for name in ('Wroclaw', 'Krakow', 'Gdansk'):
+        fake_provider.add_city(name, 'PL')
+        data = {"city": {"name": name, "state": "", "country_code": "PL"}, "notification_frequency": 2}
+        response = client.post(reverse('async_new_subscription'), data, content_type='application/json',
+                               HTTP_AUTHORIZATION=bearer(user))
+        assert response.status_code == 201
+
+    assert len(opened) == 3
+    assert [opened_client for opened_client in opened if not opened_client.client.is_closed] == []
+
+
+@pytest.mark.django_db
+def test_async_new_subscriptions_wait_on_provider_concurrently(create_user, fake_provider, async_client):
+    """Test that subscribe requests in flight on one event loop wait on the provider concurrently."""
+    fake_provider.latency = 0.3
+    users = [create_user(email=f'user{number}@example.com') for number in range(10)]
+    for number in range(10):
+        fake_provider.add_city(f'City{number}', 'PL')
+
+    async def subscribe(number):
+        data = {"city": {"name": f"City{number}", "state": "", "country_code": "PL"}, "notification_frequency": 2}
+        return await async_client.post(reverse('async_new_subscription'), data, content_type='application/json',
+                                       headers={'Authorization': bearer(users[number])})
+
+    async def subscribe_all():
+        return await asyncio.gather(*(subscribe(number) for number in range(10)))
+
+    started = time.monotonic()
+    responses = async_to_sync(subscribe_all)()
+    elapsed = time.monotonic() - started
+
+    assert [response.status_code for response in responses] == [201] * 10
+    assert UserSubscription.objects.count() == 10
+    assert elapsed < 10 * fake_provider.latency / 2
+
+
+@pytest.mark.django_db
+def test_import_subscriptions(api_client_with_authenticated_user, create_city, create_subscription, fake_provider,
+                              django_assert_max_num_queries):
+    """Test that a bulk import creates subscriptions in a constant number of queries and reports every row."""
+    create_subscription(CustomUser.objects.get(email='test_user@example.com'), create_city('City0', 'PL'),
+                        notification_frequency=2)
+    CityName.objects.create(name='City1', state='', country_code='PL')
+    for number in range(1, 6):
+        fake_provider.add_city(f'City{number}', 'PL')
+    rows = [{"city": {"name": f"City{number}", "state": "", "country_code": "PL"}, "notification_frequency": 3}
+            for number in range(6)]
+    rows += [
+        {"city": {"name": "city2", "state": "", "country_code": "pl"}, "notification_frequency": 3},
+        {"city": {"name": "wrong-city", "state": "", "country_code": "UA"}, "notification_frequency": 3},
+        {"city": {"name": "City6", "state": "", "country_code": "PL"}},
+    ]
+
+    with django_assert_max_num_queries(12):
+        response = api_client_with_authenticated_user.post(reverse('import_subscriptions'), rows, format='json')
+
+    assert response.status_code == 200
+    response_json = json.loads(response.content)
+    assert response_json['created'] == 5
+    assert [result['status'] for result in response_json['results']] == ['error'] + ['created'] * 5 + ['error'] * 3
+    assert response_json['results'][0]['error'] == 'You are already subscribed to this city'
+    assert response_json['results'][7]['error'] == 'city not found'
+    assert 'notification_frequency' in response_json['results'][8]['error']
+    assert len(fake_provider.requests) == 6
+    assert CityName.objects.filter(name__startswith='City').count() == 6
+    subscriptions = UserSubscription.objects.filter(id__in=[result['id'] for result in response_json['results'][1:6]])
+    assert all(subscription.next_notify_at and subscription.weather_info_id for subscription in subscriptions)
+
+
+@pytest.mark.django_db
+def test_import_subscriptions_bounds_provider_lookups(api_client_with_authenticated_user, fake_provider, create_city,
+                                                      create_subscription, settings, monkeypatch):
+    """Test that an import looks up a bounded number of cities and leaves the others to a background task."""
+    settings.WEATHER_IMPORT_MAX_LOOKUPS = 3
+    settings.WEATHER_FETCH_RATE_LIMIT = 2
+    for number in range(4):
+        fake_provider.add_city(f'New{number}', 'PL')
+    fake_provider.add_city('Stale', 'PL')
+    create_city('Stale', 'PL')
+    CityWeather.objects.update(last_info_update=timezone.now() - timedelta(days=1))
+    user = CustomUser.objects.get(email='test_user@example.com')
+    create_subscription(user, create_city('Subscribed', 'PL'))
+    dispatched = []
+    monkeypatch.setattr(tasks.import_pending_subscriptions, 'delay', lambda *args: dispatched.append(args))
+    rows = [{"city": {"name": name, "state": "", "country_code": "PL"}, "notification_frequency": 3}
+            for name in ('Subscribed', 'Stale', 'New0', 'New1', 'New2', 'New3')]
+
+    started = time.monotonic()
+    response = api_client_with_authenticated_user.post(reverse('import_subscriptions'), rows, format='json')
+
+    assert time.monotonic() - started < settings.WEATHER_FETCH_RATE_PERIOD / 2
+    assert response.status_code == 202
+    results = response.json()['results']
+    assert (response.json()['created'], response.json()['pending']) == (3, 2)
+    # the subscribed city is not looked up, the stale one keeps its weather, one new city is over
+    # the rate budget and the last one over the lookups
+    assert results[0]['error'] == 'You are already subscribed to this city'
+    assert results[1]['status'] == 'created'
+    assert sorted(result['status'] for result in results[2:5]) == ['created', 'created', 'pending']
+    assert results[5]['status'] == 'pending'
+    assert len(fake_provider.requests) == 2
+
+    settings.WEATHER_FETCH_RATE_LIMIT = 100
+    [(user_id, pending_rows)] = dispatched
+    assert tasks.import_pending_subscriptions(user_id, pending_rows) == 2
+    assert UserSubscription.objects.filter(user=user).count() == 6
+
+
+@pytest.mark.django_db
+def test_import_subscriptions_rejects_invalid_json(api_client_with_authenticated_user):
+    """Test that an unreadable JSON body is answered like an unreadable CSV file."""
+    response = api_client_with_authenticated_user.post(reverse('import_subscriptions'), '[{"city": ',
+                                                       content_type='application/json')
+
+    assert response.status_code == 400
+    assert response.json()['error'].startswith('Could not read the JSON body')
+
+
+@pytest.mark.django_db
+def test_export_and_import_subscriptions_csv(api_client_with_authenticated_user, create_user, create_city,
+                                            create_subscription, fake_provider):
+    """Test that an exported CSV file can be imported by another user."""
+    user = CustomUser.objects.get(email='test_user@example.com')
+    for number in range(3):
+        create_subscription(user, create_city(f'City{number}', 'PL'), notification_frequency=2)
+
+    response = api_client_with_authenticated_user.get(reverse('export_subscriptions'))
+    assert response.status_code == 200
+    assert response.streaming and not response.is_async
+    content = b''.join(response.streaming_content).decode()
+    assert content.splitlines() == ['name,state,country_code,notification_frequency',
+                                    'City0,,PL,2', 'City1,,PL,2', 'City2,,PL,2']
+
+    api_client_with_authenticated_user.force_authenticate(user=create_user(email='other_user@example.com'))
+    response = api_client_with_authenticated_user.post(reverse('import_subscriptions'), content,
+                                                       content_type='text/csv')
+    assert response.status_code == 200
+    assert json.loads(response.content)['created'] == 3
+    assert UserSubscription.objects.filter(user__email='other_user@example.com').count() == 3
+    assert fake_provider.requests == []
+
+    invalid = 'name,state,country_code,notification_frequency\nŁódź,,PL,2'.encode('iso-8859-2')
+    response = api_client_with_authenticated_user.post(reverse('import_subscriptions'), invalid,
+                                                       content_type='text/csv')
+    assert response.status_code == 400
+    assert response.json()['error'].startswith('Could not read the CSV file')
+
+
+@pytest.mark.django_db
+def test_export_subscriptions_streamed_over_asgi(create_user, create_city, create_subscription, async_client):
+    """Test that the export is streamed from an async iterator when served over ASGI."""
+    user = create_user(email='test_user@example.com')
+    for number in range(2):
+        create_subscription(user, create_city(f'City{number}', 'PL'), notification_frequency=2)
+
+    async def export():
+        response = await async_client.get(reverse('export_subscriptions'), headers={'Authorization': bearer(user)})
+        return response, [chunk async for chunk in response.streaming_content]
+
+    response, content = async_to_sync(export)()
+    assert response.status_code == 200
+    assert response.is_async
+    assert b''.join(content).decode().splitlines()[1:] == ['City0,,PL,2', 'City1,,PL,2']
+
+
+@pytest.mark.django_db
+def test_edit_and_delete_subscription_queries(api_client_with_authenticated_user, create_user, create_city,
+                                              create_subscription, fake_provider, django_assert_max_num_queries):
+    """Test that editing and deleting look the subscription up by id and owner before anything else."""
+    user = CustomUser.objects.get(email='test_user@example.com')
+    for number in range(2):
+        create_subscription(user, create_city(f'City{number}', 'PL'), notification_frequency=2)
+    create_user(email='other_user@example.com')
+    first, second = UserSubscription.objects.order_by('id')
+    foreign = UserSubscription.objects.create(user=CustomUser.objects.get(email='other_user@example.com'),
+                                              city=second.city, weather_info=second.weather_info,
+                                              notification_frequency=4)
+    data = {"city": {"name": "City1", "state": "", "country_code": "PL"}, "notification_frequency": 5}
+    fake_provider.add_city('Unknown', 'PL')
+
+    for subscription_id in (foreign.id, foreign.id + 1):
+        response = api_client_with_authenticated_user.put(
+            reverse('subscription_action', kwargs={'id': subscription_id}),
+            {"city": {"name": "Unknown", "state": "", "country_code": "PL"}, "notification_frequency": 5},
+            format='json')
+        assert response.status_code == 400
+        assert response.json()['res'] == f"Subscription with id={subscription_id} does not exist for this user"
+    assert fake_provider.requests == []
+    assert not CityName.objects.filter(name='Unknown').exists()
+    response = api_client_with_authenticated_user.delete(reverse('subscription_action', kwargs={'id': foreign.id}))
+    assert response.status_code == 404
+    foreign.refresh_from_db()
+    assert foreign.notification_frequency == 4
+
+    # moving the first subscription to City1 leaves City0 unused
+    with django_assert_max_num_queries(13):
+        response = api_client_with_authenticated_user.put(reverse('subscription_action', kwargs={'id': first.id}),
+                                                          data, format='json')
+    assert response.status_code == 200
+    first.refresh_from_db()
+    assert (first.city_id, first.notification_frequency) == (second.city_id, 5)
+    assert not CityName.objects.filter(name='City0').exists()
+
+    with django_assert_max_num_queries(6):
+        response = api_client_with_authenticated_user.delete(reverse('subscription_action', kwargs={'id': first.id}))
+    assert response.status_code == 200
+    assert not UserSubscription.objects.filter(id=first.id).exists()
+    assert CityName.objects.filter(id=second.city_id).exists()
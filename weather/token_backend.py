@@ -0,0 +1,47 @@
+from cryptography.hazmat.primitives import serialization
+from rest_framework_simplejwt.backends import TokenBackend
+from rest_framework_simplejwt.settings import api_settings
+
+
+class LazyKeyTokenBackend(TokenBackend):
+    """
+    `TokenBackend` taking PEM keys and parsing them on the first signing or verification.
+
+    PyJWT would parse a PEM string again on every call, so the parsed keys are kept. Keys of
+    HMAC algorithms are plain secrets and are used as they are.
+    """
+
+    @property
+    def signing_key(self):
+        if self._signing_key is None and self._signing_pem and not self.algorithm.startswith('HS'):
+            self._signing_key = serialization.load_pem_private_key(self._signing_pem.encode(), password=None)
+        return self._signing_key or self._signing_pem
+
+    @signing_key.setter
+    def signing_key(self, value):
+        self._signing_pem = value
+        self._signing_key = None
+
+    @property
+    def verifying_key(self):
+        if self._verifying_key is None and self._verifying_pem and not self.algorithm.startswith('HS'):
+            self._verifying_key = serialization.load_pem_public_key(self._verifying_pem.encode())
+        return self._verifying_key or self._verifying_pem
+
+    @verifying_key.setter
+    def verifying_key(self, value):
+        self._verifying_pem = value
+        self._verifying_key = None
+
+
+# Built when a token is first signed or verified, like `rest_framework_simplejwt.state.token_backend`
+token_backend = LazyKeyTokenBackend(
+    api_settings.ALGORITHM,
+    api_settings.SIGNING_KEY,
+    api_settings.VERIFYING_KEY,
+    api_settings.AUDIENCE,
+    api_settings.ISSUER,
+    api_settings.JWK_URL,
+    api_settings.LEEWAY,
+    api_settings.JSON_ENCODER,
+)
@@ -2,7 +2,7 @@ from django.urls import path
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 from rest_framework_simplejwt import views as jwt_views
 
-from . import views
+from . import async_views, metrics, views
 
 urlpatterns = [
     path('', SpectacularSwaggerView.as_view(url_name='docs'), name='docs-ui'),
@@ -14,4 +14,10 @@ urlpatterns = [
     path('subscriptions/', views.UserSubscriptionsView.as_view(), name='subscriptions_list'),
     path('subscriptions/<int:id>/', views.SubscriptionActionsView.as_view(), name='subscription_action'),
     path('subscriptions/create/', views.NewSubscriptionView.as_view(), name='new_subscription'),
+    path('subscriptions/import/', views.SubscriptionImportView.as_view(), name='import_subscriptions'),
+    path('subscriptions/export/', views.SubscriptionExportView.as_view(), name='export_subscriptions'),
+    path('async/subscriptions/<int:id>/', async_views.AsyncSubscriptionActionsView.as_view(),
+         name='async_subscription_action'),
+    path('async/subscriptions/create/', async_views.AsyncNewSubscriptionView.as_view(), name='async_new_subscription'),
+    path('metrics', metrics.metrics_view, name='metrics'),
 ]
@@ -1,32 +1,497 @@
+import asyncio
+import contextvars
+import logging
+import math
 import os
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
-from dotenv import load_dotenv
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-load_dotenv()
+from . import metrics
+from .cache import get_weather_cache
+from .constants import OWM_GROUP_SIZE
 
+# Provider response statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-def get_weather(city_data):
+
+class ProviderUnavailable(Exception):
+    """The weather provider could not be reached or answered with an unusable response."""
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the weather provider is degraded.
+
+    The breaker opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds. Then a single trial call is let through: its success closes
+    the breaker again, its failure keeps it open for another period.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """Return whether a call may be made now."""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this call through and hold others off until it reports back.
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class WeatherClient:
+    """
+    HTTP client of the weather provider shared by the views and the refresh tasks.
+
+    Keeps a pool of keep-alive connections, applies connect/read timeouts, retries
+    idempotent requests with jittered exponential backoff and stops calling a
+    degraded provider through a circuit breaker.
+    """
+
+    def __init__(self):
+        retry = Retry(
+            total=settings.WEATHER_PROVIDER_RETRIES,
+            backoff_factor=settings.WEATHER_PROVIDER_BACKOFF,
+            backoff_jitter=settings.WEATHER_PROVIDER_BACKOFF_JITTER,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=settings.WEATHER_FETCH_CONCURRENCY, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.timeout = (settings.WEATHER_PROVIDER_CONNECT_TIMEOUT, settings.WEATHER_PROVIDER_READ_TIMEOUT)
+        self.breaker = CircuitBreaker(settings.WEATHER_PROVIDER_BREAKER_THRESHOLD,
+                                      settings.WEATHER_PROVIDER_BREAKER_RESET_TIMEOUT)
+
+    def get(self, path, params):
+        """
+        Call a provider endpoint and return its decoded JSON body.
+
+        :raises ProviderUnavailable: If the breaker is open, the request failed after all
+            retries, the provider answered with a server error or the body is not JSON.
+        """
+        if not self.breaker.allow():
+            raise ProviderUnavailable('weather provider is unavailable')
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self.session.get(f"{settings.OWM_API_URL}/{path}", params=params, timeout=self.timeout)
+            status = response.status_code
+            if response.status_code == 429 or response.status_code >= 500:
+                raise ProviderUnavailable(f'weather provider responded with {response.status_code}')
+            body = response.json()
+        except (requests.RequestException, ValueError, ProviderUnavailable) as error:
+            self.breaker.record_failure()
+            raise ProviderUnavailable(str(error)) from error
+        finally:
+            metrics.record_provider_call(path, status, time.perf_counter() - started)
+        self.breaker.record_success()
+        return body
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_weather_client():
+    """Return the weather provider client of this process."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = WeatherClient()
+    return _client
+
+
+def close_weather_client():
+    """Close the weather provider client of this process; the next call creates a fresh one."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+class AsyncWeatherClient:
+    """
+    Asyncio counterpart of `WeatherClient`, used by the async views.
+
+    Awaiting a provider call leaves the event loop free to serve other requests, so one
+    ASGI process can keep many subscribe requests waiting on the provider at once. It
+    applies the same timeouts, jittered exponential backoff on `RETRY_STATUSES` and
+    connection errors, and its own circuit breaker.
+    """
+
+    def __init__(self):
+        # httpx is only needed by ASGI processes, so workers and management commands do not import it
+        import httpx
+
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.WEATHER_PROVIDER_READ_TIMEOUT,
+                                  connect=settings.WEATHER_PROVIDER_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=settings.WEATHER_PROVIDER_ASYNC_CONNECTIONS),
+        )
+        self.breaker = CircuitBreaker(settings.WEATHER_PROVIDER_BREAKER_THRESHOLD,
+                                      settings.WEATHER_PROVIDER_BREAKER_RESET_TIMEOUT)
+
+    @staticmethod
+    def backoff(retry):
+        """Seconds to wait before the `retry`-th retry, computed like urllib3's `Retry`."""
+        if retry <= 1:
+            delay = 0
+        else:
+            delay = settings.WEATHER_PROVIDER_BACKOFF * 2 ** (retry - 1)
+        return delay + random.uniform(0, settings.WEATHER_PROVIDER_BACKOFF_JITTER)
+
+    async def get(self, path, params):
+        """
+        Call a provider endpoint and return its decoded JSON body.
+
+        :raises ProviderUnavailable: If the breaker is open, the request failed after all
+            retries, the provider answered with a server error or the body is not JSON.
+        """
+        import httpx
+
+        if not self.breaker.allow():
+            raise ProviderUnavailable('weather provider is unavailable')
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            for retry in range(settings.WEATHER_PROVIDER_RETRIES + 1):
+                if retry:
+                    await asyncio.sleep(self.backoff(retry))
+                try:
+                    response = await self.client.get(f"{settings.OWM_API_URL}/{path}", params=params)
+                except httpx.TransportError as error:
+                    failure = error
+                    status = 'error'
+                    continue
+                status = response.status_code
+                if response.status_code not in RETRY_STATUSES:
+                    break
+                failure = ProviderUnavailable(f'weather provider responded with {response.status_code}')
+            else:
+                raise failure
+            if response.status_code >= 500:
+                raise ProviderUnavailable(f'weather provider responded with {response.status_code}')
+            body = response.json()
+        except (httpx.HTTPError, ValueError, ProviderUnavailable) as error:
+            self.breaker.record_failure()
+            raise ProviderUnavailable(str(error)) from error
+        finally:
+            metrics.record_provider_call(path, status, time.perf_counter() - started)
+        self.breaker.record_success()
+        return body
+
+    async def close(self):
+        await self.client.aclose()
+
+
+# Async clients by event loop, with the generators closing them: a client's connections belong to the loop
+# that opened them
+_async_clients = weakref.WeakKeyDictionary()
+
+
+async def close_on_shutdown(client):
+    """
+    Async generator closing `client` once its event loop shuts its async generators down.
+
+    `asyncio.run`, which runs the loops of ASGI servers and of `async_to_sync`, does that before
+    closing the loop, so the clients of short-lived loops do not leak their connection pools.
+    """
+    try:
+        yield
+    finally:
+        await client.close()
+
+
+async def aget_weather_client():
+    """Return the async weather provider client of the running event loop, closed when the loop ends."""
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        client = AsyncWeatherClient()
+        closer = close_on_shutdown(client)
+        # a started generator is tracked by the loop until it is finalized
+        await closer.__anext__()
+        _async_clients[loop] = (client, closer)
+    return _async_clients[loop][0]
+
+
+def parse_weather(weather_resp):
+    """Extract the weather data and the provider location of a city from a provider response."""
+    return {
+        'weather_description': weather_resp['weather'][0]['description'],
+        'temperature': weather_resp['main']['temp'],
+        'feels_like': weather_resp['main']['feels_like'],
+        'humidity': weather_resp['main']['humidity'],
+        'pressure': weather_resp['main']['pressure'],
+        'visibility': weather_resp['visibility'],
+        'wind_speed': weather_resp['wind']['speed'],
+        'clouds': weather_resp.get('clouds', {}).get('all', 0),
+        'rain': weather_resp.get('rain', {}).get('1h', 0),
+        'snow': weather_resp.get('snow', {}).get('1h', 0),
+        'provider_id': weather_resp.get('id'),
+        'latitude': weather_resp.get('coord', {}).get('lat'),
+        'longitude': weather_resp.get('coord', {}).get('lon'),
+    }
+
+
+def weather_params(city_data):
+    """Build the provider query parameters of a weather lookup by city name."""
     OWM_TOKEN = os.environ.get('OWM_TOKEN')
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={city_data['name']},{city_data['state']}," \
-          f"{city_data['country_code']}&appid={OWM_TOKEN}&units=metric"
-    weather_resp = requests.get(url).json()
+    return {
+        'q': f"{city_data['name']},{city_data['state']},{city_data['country_code']}",
+        'appid': OWM_TOKEN,
+        'units': 'metric',
+    }
+
 
+def weather_result(weather_resp):
+    """Turn a provider response of a weather lookup into a `(weather_data, code)` pair."""
     if weather_resp['cod'] != 200:
         res = {'message': weather_resp['message']}
         code = weather_resp['cod']
     else:
-        res = {
-            'weather_description': weather_resp['weather'][0]['description'],
-            'temperature': weather_resp['main']['temp'],
-            'feels_like': weather_resp['main']['feels_like'],
-            'humidity': weather_resp['main']['humidity'],
-            'pressure': weather_resp['main']['pressure'],
-            'visibility': weather_resp['visibility'],
-            'wind_speed': weather_resp['wind']['speed'],
-            'clouds': weather_resp.get('clouds', {}).get('all', 0),
-            'rain': weather_resp.get('rain', {}).get('1h', 0),
-            'snow': weather_resp.get('snow', {}).get('1h', 0),
-        }
+        res = parse_weather(weather_resp)
         code = 200
 
     return res, code
+
+
+def get_weather(city_data):
+    try:
+        weather_resp = get_weather_client().get('weather', weather_params(city_data))
+    except ProviderUnavailable as error:
+        logging.error(f"Weather provider call failed: {error}")
+        return {'message': 'weather provider is unavailable'}, 503
+    return weather_result(weather_resp)
+
+
+async def aget_weather(city_data):
+    """Async version of `get_weather`."""
+    client = await aget_weather_client()
+    try:
+        weather_resp = await client.get('weather', weather_params(city_data))
+    except ProviderUnavailable as error:
+        logging.error(f"Weather provider call failed: {error}")
+        return {'message': 'weather provider is unavailable'}, 503
+    return weather_result(weather_resp)
+
+
+def get_weather_group(provider_ids):
+    """
+    Get the weather of up to `OWM_GROUP_SIZE` cities in one call of the provider's group endpoint.
+
+    :param provider_ids: Provider city ids.
+    :return: A dict mapping provider city ids to weather data. Cities the provider did not
+        return, or all of them if the call failed, are missing from it.
+    """
+    params = {
+        'id': ','.join(str(provider_id) for provider_id in provider_ids),
+        'appid': os.environ.get('OWM_TOKEN'),
+        'units': 'metric',
+    }
+    try:
+        group_resp = get_weather_client().get('group', params)
+        return {city_resp['id']: parse_weather(city_resp) for city_resp in group_resp['list']}
+    except (ProviderUnavailable, KeyError, IndexError, TypeError) as error:
+        logging.error(f"Weather provider group call failed: {error}")
+        return {}
+
+
+def city_location(city):
+    """Return the city data dict of a `CityName` object, as accepted by `get_weather`."""
+    return {'name': city.name, 'state': city.state, 'country_code': city.country_code}
+
+
+def get_cached_weather(city_data):
+    """
+    Like `get_weather`, but answered from the weather cache when the city was looked up recently.
+    """
+    weather_cache = get_weather_cache()
+    cached = weather_cache.get(city_data)
+    if cached is not None:
+        return cached
+    weather_data, code = get_weather(city_data)
+    weather_cache.set(city_data, weather_data, code)
+    return weather_data, code
+
+
+async def aget_cached_weather(city_data):
+    """
+    Async version of `get_cached_weather`.
+
+    The cache is read and written in a worker thread, since the shared tier may be a network call.
+    """
+    weather_cache = get_weather_cache()
+    cached = await sync_to_async(weather_cache.get, thread_sensitive=False)(city_data)
+    if cached is not None:
+        return cached
+    weather_data, code = await aget_weather(city_data)
+    await sync_to_async(weather_cache.set, thread_sensitive=False)(city_data, weather_data, code)
+    return weather_data, code
+
+
+class RateLimiter:
+    """
+    Provider rate budget of at most `calls` requests per `period` seconds, shared by all processes.
+
+    Calls are counted per window of `period` seconds with an atomic `incr` in the cache named by
+    `WEATHER_FETCH_RATE_CACHE_ALIAS`, so the shards of a run, the workers running them and the imports
+    of the views all draw from one budget. A caller over the budget sleeps until the next window.
+    The cache must be shared by all workers (Redis in production) for the budget to hold across processes.
+    """
+
+    def __init__(self, calls, period=60.0, name='weather-provider'):
+        self.calls = calls
+        self.period = period
+        self.name = name
+
+    @property
+    def cache(self):
+        return caches[settings.WEATHER_FETCH_RATE_CACHE_ALIAS]
+
+    def acquire(self, blocking=True):
+        """
+        Wait until a request may be sent. A non-positive budget disables limiting.
+
+        :param blocking: Whether to wait for the next window when the budget is used up.
+        :return: True, or False if `blocking` is false and the budget is used up.
+        """
+        if self.calls <= 0:
+            return True
+        while True:
+            now = time.time()
+            window = int(now // self.period)
+            key = f"rate:{self.name}:{window}"
+            self.cache.add(key, 0, math.ceil(self.period * 2))
+            try:
+                used = self.cache.incr(key)
+            except ValueError:
+                # the window's counter expired between `add` and `incr`
+                continue
+            if used <= self.calls:
+                return True
+            if not blocking:
+                return False
+            time.sleep((window + 1) * self.period - now)
+
+
+class WeatherFetcher:
+    """
+    Fan weather lookups out over a bounded thread pool.
+
+    All workers share the pooled `WeatherClient` and the provider rate budget of
+    `RateLimiter`, so a run takes roughly N / concurrency provider round trips instead of N.
+    """
+
+    def __init__(self, concurrency=None, rate_limit=None, rate_period=None, blocking=True):
+        self.concurrency = concurrency or settings.WEATHER_FETCH_CONCURRENCY
+        # without blocking, lookups over the rate budget fail with a 429 instead of waiting for the next window
+        self.blocking = blocking
+        self.rate_limiter = RateLimiter(
+            settings.WEATHER_FETCH_RATE_LIMIT if rate_limit is None else rate_limit,
+            settings.WEATHER_FETCH_RATE_PERIOD if rate_period is None else rate_period,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='weather-fetch')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _fetch_one(self, city_data):
+        if not self.rate_limiter.acquire(self.blocking):
+            return {'message': 'weather provider rate limit reached, try again later'}, 429
+        weather_data, code = get_weather(city_data)
+        get_weather_cache().set(city_data, weather_data, code)
+        return weather_data, code
+
+    def _fetch_group(self, provider_ids):
+        if not self.rate_limiter.acquire(self.blocking):
+            return {}
+        return get_weather_group(provider_ids)
+
+    def _map(self, func, items):
+        """`executor.map` running every call in a copy of the caller's context, so metrics reach its scope."""
+        items = list(items)
+        contexts = [contextvars.copy_context() for _ in items]
+        return self.executor.map(lambda context, item: context.run(func, item), contexts, items)
+
+    def fetch(self, cities_data):
+        """
+        Fetch weather for several cities concurrently, one provider call per city.
+
+        :param cities_data: An iterable of city data dicts accepted by `get_weather`.
+        :return: A list of `(weather_data, code)` pairs in the order of `cities_data`.
+        """
+        return list(self._map(self._fetch_one, cities_data))
+
+    def fetch_cities(self, cities):
+        """
+        Fetch weather for several city objects concurrently.
+
+        Cities with a known provider id are fetched through the group endpoint,
+        `OWM_GROUP_SIZE` per call; the others, and any city a group call did not
+        return, fall back to one call per city by name.
+
+        :param cities: A list of `CityName` objects.
+        :return: A list of `(weather_data, code)` pairs in the order of `cities`.
+        """
+        results = [None] * len(cities)
+        indexes_by_provider_id = {}
+        for index, city in enumerate(cities):
+            if city.provider_id is not None:
+                indexes_by_provider_id.setdefault(city.provider_id, []).append(index)
+
+        provider_ids = list(indexes_by_provider_id)
+        groups = [provider_ids[start:start + OWM_GROUP_SIZE] for start in range(0, len(provider_ids), OWM_GROUP_SIZE)]
+        weather_cache = get_weather_cache()
+        for group_weather in self._map(self._fetch_group, groups):
+            for provider_id, weather_data in group_weather.items():
+                for index in indexes_by_provider_id.get(provider_id, ()):
+                    results[index] = (weather_data, 200)
+                    weather_cache.set(city_location(cities[index]), weather_data, 200)
+
+        missing = [index for index, result in enumerate(results) if result is None]
+        fetched = self._map(self._fetch_one, [city_location(cities[index]) for index in missing])
+        for index, result in zip(missing, fetched):
+            results[index] = result
+        return results
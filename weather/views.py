@@ -1,16 +1,24 @@
+import csv
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import StreamingHttpResponse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.utils import json
 from rest_framework.views import APIView
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 
+from .bulk import aexport_subscriptions_csv, export_subscriptions_csv, import_subscriptions, parse_csv_rows
 from .models import CityName, CityWeather, CustomUser, UserSubscription
-from .serializers import (CityNameSerializer, CityWeatherSerializer,
-                          OneSubscriptionSerializer, RegistrationSerializer,
-                          UserSubscriptionSerializer)
-
-from .utils import get_weather
+from .pagination import SubscriptionCursorPagination
+from .serializers import (OneSubscriptionSerializer, RegistrationSerializer, SubscriptionListSerializer,
+                          SubscriptionUpdateSerializer, UserSubscriptionSerializer)
+from .tasks import clean_weather_data
+from .utils import get_cached_weather
 
 
 class RegistrationView(APIView):
@@ -26,16 +34,19 @@ class RegistrationView(APIView):
         """Handle POST requests for user registration."""
         request_body = json.loads(request.body)
         serializer = RegistrationSerializer(data=request_body)
-        if serializer.is_valid():
-            account = serializer.save()
-            account.is_active = True
-            account.save()
-            return Response({"result": "Registered successfully",
-                             "user_info": serializer.data},
-                            status=status.HTTP_201_CREATED)
-        else:
+        if not serializer.is_valid():
             return Response({'error': serializer.errors},
                             status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # the savepoint keeps a duplicate email from breaking a surrounding transaction
+            with transaction.atomic():
+                serializer.save()
+        except IntegrityError:
+            return Response({'error': {'email': ['User with this email already exists.']}},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response({"res": "Registered successfully",
+                         "user info": serializer.data},
+                        status=status.HTTP_201_CREATED)
 
 
 class DeleteAccount(APIView):
@@ -52,47 +63,103 @@ class DeleteAccount(APIView):
         return Response({"result": "user deleted"}, status=status.HTTP_200_OK)
 
 
-def validate_serializer(serializer, error_message):
-    """Helper function to validate serializer data."""
-    if serializer.is_valid():
-        serializer.save()
-    else:
-        return Response({'errors': serializer.errors,
-                         'message': error_message},
-                        status=status.HTTP_400_BAD_REQUEST)
+def get_known_city(city_data):
+    """
+    Helper function to look a city up in the database, without calling the weather provider.
+
+    :return: A `(city, city_weather)` tuple. The city is None if it is not known yet, its weather
+        is None if it is missing or older than `WEATHER_MAX_STALENESS` seconds.
+    """
+    city = CityName.objects.find(city_data)
+    if city is None:
+        return None, None
+    stale_before = timezone.now() - timedelta(seconds=settings.WEATHER_MAX_STALENESS)
+    return city, CityWeather.objects.filter(city=city, last_info_update__gt=stale_before).first()
+
+
+def served_over_asgi(request):
+    """
+    Helper function telling whether a request came in through an ASGI server.
+
+    WSGI servers put `wsgi.version` into the environ of every request (PEP 3333), which Django
+    exposes as `request.META`; requests of ASGI servers do not have it.
+    """
+    return 'wsgi.version' not in request.META
+
+
+def save_city_weather(city_data, weather_data):
+    """
+    Helper function to store the city of `city_data` and its weather fetched from the provider.
+
+    :return: A `(city, city_weather)` tuple.
+    """
+    city, _ = CityName.objects.resolve(city_data)
+    if city.remember_provider_location(weather_data):
+        city.save(update_fields=['provider_id', 'latitude', 'longitude'])
+    city_weather, _ = CityWeather.objects.update_or_create(city=city, defaults=clean_weather_data(weather_data))
+    return city, city_weather
 
 
-def remove_unused_entries():
-    """Helper function to remove unused city entries."""
-    cities = CityName.objects.all()
-    for city in cities:
-        city_subscriptions = city.subscriptions.all()
-        if not city_subscriptions:
-            city.delete()
+def remove_unused_city(city_id):
+    """Helper function to remove a city entry once nobody is subscribed to it."""
+    CityName.objects.filter(id=city_id, subscriptions__isnull=True).delete()
+
+
+def edit_subscription(user, id, city, city_weather, notification_frequency=None):
+    """
+    Helper function to move a subscription of `user` to another city and remove its previous city if it became unused.
+
+    The subscription is locked while it is saved and the city removed, in one transaction, so
+    concurrent edits cannot remove a city another of them has just moved a subscription to.
+
+    :param notification_frequency: The new frequency in hours, None to keep the current one.
+    :return: False if the subscription does not exist for this user, True otherwise.
+    """
+    with transaction.atomic():
+        subscription = UserSubscription.objects.select_for_update().filter(id=id, user=user).first()
+        if subscription is None:
+            return False
+        previous_city_id = subscription.city_id
+        subscription.city = city
+        subscription.weather_info = city_weather
+        if notification_frequency is not None:
+            subscription.notification_frequency = notification_frequency
+        subscription.save(update_fields=['city', 'weather_info', 'notification_frequency'])
+        if previous_city_id != city.pk:
+            remove_unused_city(previous_city_id)  # remove the city if nobody is subscribed for it
+    return True
 
 
 class UserSubscriptionsView(APIView):
     """API endpoint for managing user subscriptions."""
     permission_classes = (IsAuthenticated,)
-
-    @extend_schema(description='### Get the list of all your subscriptions',
+    pagination_class = SubscriptionCursorPagination
+
+    @extend_schema(description='### Get the list of all your subscriptions</br></br>'
+                               'The list is paginated: follow the "next" and "previous" links to move between '
+                               'pages.</br>'
+                               '"fields": comma-separated subset of id, city, notification_frequency to return.',
+                   parameters=[OpenApiParameter('fields', str, description='Fields to include, e.g. "id,city"'),
+                               OpenApiParameter('page_size', int, description='Number of subscriptions per page')],
+                   responses=SubscriptionListSerializer(many=True),
                    tags=['subscriptions'], )
     def get(self, request):
         """Handle GET requests for retrieving user subscriptions."""
-        user = request.user
-        subscriptions = user.subscriptions
-        serializer = UserSubscriptionSerializer(subscriptions, many=True)
-        for subscriprion in serializer.data:
-            subscriprion.pop('user')
-            subscriprion.pop('weather_info')
-            subscriprion.pop('last_info_update')
-
-            city_id = subscriprion['city']
-            city = CityName.objects.get(id=city_id)
-            city_info = CityNameSerializer(city)
-            subscriprion['city'] = city_info.data
+        fields = None
+        if request.query_params.get('fields'):
+            fields = [field.strip() for field in request.query_params['fields'].split(',')]
+
+        subscriptions = UserSubscription.objects.filter(user=request.user)
+        if fields is None or 'city' in fields:
+            subscriptions = subscriptions.select_related('city').only(
+                'id', 'notification_frequency', 'city__name', 'city__state', 'city__country_code')
+        else:
+            subscriptions = subscriptions.only('id', 'notification_frequency')
 
-        return Response(serializer.data)
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(subscriptions, request, view=self)
+        serializer = SubscriptionListSerializer(page, many=True, fields=fields)
+        return paginator.get_paginated_response(serializer.data)
 
 
 class NewSubscriptionView(APIView):
@@ -113,48 +180,94 @@ class NewSubscriptionView(APIView):
 
         city_data = request_body['city']
 
-        weather_data, code = get_weather(city_data)
-        if code != 200:
-            return Response({'error': weather_data['message'],
-                             'code': code},
-                            status=status.HTTP_404_NOT_FOUND)
+        # the provider is only called for cities without recent weather in the database
+        subscription_city, subscription_weather = get_known_city(city_data)
+        if subscription_city is not None and subscription_city.subscriptions.filter(user=request.user).exists():
+            return Response({'error': 'You are already subscribed to this city. '
+                                      'Please, edit an existing subscription'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        if subscription_weather is None:
+            weather_data, code = get_cached_weather(city_data)
+            if code != 200:
+                return Response({'error': weather_data['message'],
+                                 'code': code},
+                                status=status.HTTP_404_NOT_FOUND)
+            subscription_city, subscription_weather = save_city_weather(city_data, weather_data)
+
+        subscription_data = {
+            'user': request.user.pk,
+            'city': subscription_city.pk,
+            'weather_info': subscription_weather.pk,
+            'notification_frequency': request_body['notification_frequency'],
+        }
+
+        subscription_serializer = UserSubscriptionSerializer(data=subscription_data)
+        if subscription_serializer.is_valid():
+            subscription_serializer.save()
+            return Response({'res': 'New subscription created successfully'}, status=status.HTTP_201_CREATED)
+        else:
+            return Response(subscription_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
 
+class SubscriptionImportView(APIView):
+    """API endpoint for creating many user subscriptions at once."""
+    permission_classes = (IsAuthenticated,)
+
+    @extend_schema(description='### Subscribe to many cities at once.</br></br>'
+                               'Send a JSON list of subscriptions in the format of "subscriptions/create/", or a '
+                               'CSV file (Content-Type: text/csv) with the columns name, state, country_code, '
+                               'notification_frequency, e.g. one downloaded from "subscriptions/export/".</br>'
+                               'The result of every row is reported: "created" with the id of the new '
+                               'subscription, "pending" if its city is looked up in the background and the '
+                               'subscription created afterwards (the response status is then 202), or "error" '
+                               'with the reason.',
+                   tags=['subscriptions'], )
+    def post(self, request):
+        """Handle POST requests for importing user subscriptions."""
+        if request.content_type.startswith('text/csv'):
+            try:
+                rows = parse_csv_rows(request.body.decode('utf-8-sig'))
+            except (UnicodeDecodeError, csv.Error) as error:
+                return Response({'error': f'Could not read the CSV file: {error}'}, status=status.HTTP_400_BAD_REQUEST)
         else:
-            if not CityName.objects.filter(name=city_data['name'],
-                                           state=city_data['state'],
-                                           country_code=city_data['country_code']).exists():
-                city_serializer = CityNameSerializer(data=city_data)
-                validate_serializer(city_serializer, error_message="city_serializer errors:")
-
-            subscription_city = CityName.objects.get(name=city_data['name'],
-                                                     state=city_data['state'],
-                                                     country_code=city_data['country_code'])
-
-            if subscription_city.subscriptions.filter(user=request.user).exists():
-                return Response({'error': 'You are already subscribed to this city. '
-                                          'Please, edit an existing subscription'},
+            try:
+                rows = json.loads(request.body)
+            except ValueError as error:
+                return Response({'error': f'Could not read the JSON body: {error}'},
                                 status=status.HTTP_400_BAD_REQUEST)
+            if not isinstance(rows, list):
+                return Response({'error': 'Expected a list of subscriptions'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(rows) > settings.WEATHER_IMPORT_MAX_ROWS:
+            return Response({'error': f'At most {settings.WEATHER_IMPORT_MAX_ROWS} subscriptions can be imported '
+                                      f'at once'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-            if not CityWeather.objects.filter(city=subscription_city).exists():
-                weather_data['city'] = subscription_city.pk
-                city_weather_serializer = CityWeatherSerializer(data=weather_data)
-                validate_serializer(city_weather_serializer, error_message="city_weather_serializer errors:")
+        results = import_subscriptions(request.user, rows, max_lookups=settings.WEATHER_IMPORT_MAX_LOOKUPS)
+        created = sum(result['status'] == 'created' for result in results)
+        pending = sum(result['status'] == 'pending' for result in results)
+        return Response({'created': created, 'pending': pending, 'results': results},
+                        status=status.HTTP_202_ACCEPTED if pending else status.HTTP_200_OK)
 
-            subscription_weather = CityWeather.objects.get(city=subscription_city.pk)
 
-            subscription_data = {
-                'user': request.user.pk,
-                'city': subscription_city.pk,
-                'weather_info': subscription_weather.pk,
-                'notification_frequency': request_body['notification_frequency'],
-            }
+class SubscriptionExportView(APIView):
+    """API endpoint for downloading all user subscriptions."""
+    permission_classes = (IsAuthenticated,)
 
-            subscription_serializer = UserSubscriptionSerializer(data=subscription_data)
-            if subscription_serializer.is_valid():
-                subscription_serializer.save()
-                return Response({'res': 'New subscription created successfully'}, status=status.HTTP_201_CREATED)
-            else:
-                return Response(subscription_serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    @extend_schema(description='### Download all your subscriptions as CSV, in the format accepted by '
+                               '"subscriptions/import/"',
+                   responses={(200, 'text/csv'): str},
+                   tags=['subscriptions'], )
+    def get(self, request):
+        """Handle GET requests for exporting user subscriptions."""
+        # ASGI servers stream async iterators only; a sync one would be read into memory first
+        if served_over_asgi(request):
+            content = aexport_subscriptions_csv(request.user)
+        else:
+            content = export_subscriptions_csv(request.user)
+        response = StreamingHttpResponse(content, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="subscriptions.csv"'
+        return response
 
 
 class SubscriptionActionsView(APIView):
@@ -163,14 +276,7 @@ class SubscriptionActionsView(APIView):
 
     def get_serializer_class(self):
         if self.request.method == 'PUT':
-            return OneSubscriptionSerializer
-
-    def get_usersubscription_object(self, subscription_id):
-        """Helper function to get user subscription object by ID."""
-        try:
-            return UserSubscription.objects.get(id=subscription_id)
-        except UserSubscription.DoesNotExist:
-            return None
+            return SubscriptionUpdateSerializer
 
     @extend_schema(description='### Write new updated information about your subscription.</br></br>'
                                '"city": name of the city you subscribe to.</br>'
@@ -181,74 +287,51 @@ class SubscriptionActionsView(APIView):
                    tags=['subscriptions'], )
     def put(self, request, id):
         """Handle PUT requests for editing user subscriptions."""
-        user = request.user
-        user_subscriptions = user.subscriptions.all()
-        subscription = self.get_usersubscription_object(subscription_id=id)
-        if not subscription or subscription not in user_subscriptions:
+        subscription_serializer = SubscriptionUpdateSerializer(data=json.loads(request.body))
+        if not subscription_serializer.is_valid():
+            return Response({"res": subscription_serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+        subscription_data = subscription_serializer.validated_data
+        city_data = subscription_data['city']
+
+        # checked without a lock first, so that editing a foreign or missing subscription
+        # neither spends provider budget nor creates a city
+        if not UserSubscription.objects.filter(id=id, user=request.user).exists():
             return Response({"res": f"Subscription with id={id} does not exist for this user"},
                             status=status.HTTP_400_BAD_REQUEST,
                             )
-        else:
-            request_body = json.loads(request.body)
-            city_data = request_body['city']
 
-            weather_data, code = get_weather(city_data)
+        # the city is created if any field about it has changed;
+        # the provider is only called for cities without recent weather in the database,
+        # and before the subscription is locked, so no lock is held while waiting for it
+        subscription_city, subscription_weather = get_known_city(city_data)
+        if subscription_weather is None:
+            weather_data, code = get_cached_weather(city_data)
             if code != 200:
                 return Response({'error': weather_data['message'],
                                  'code': code},
                                 status=status.HTTP_400_BAD_REQUEST)
-            else:
-                # if any field about city has changed
-                if not CityName.objects.filter(name=city_data['name'],
-                                               state=city_data['state'],
-                                               country_code=city_data['country_code']).exists():
-                    city_serializer = CityNameSerializer(data=city_data)
-                    validate_serializer(city_serializer, error_message="city_serializer errors:")
-
-                subscription_city = CityName.objects.get(name=city_data['name'],
-                                                         state=city_data['state'],
-                                                         country_code=city_data['country_code'])
-
-                if not CityWeather.objects.filter(city=subscription_city).exists():
-                    weather_data['city'] = subscription_city.pk
-                    city_weather_serializer = CityWeatherSerializer(data=weather_data)
-                    validate_serializer(city_weather_serializer, error_message="city_weather_serializer errors:")
-
-                subscription_weather = CityWeather.objects.get(city=subscription_city.pk)
-
-                new_subscription_data = {
-                    'user': request.user.pk,
-                    'city': subscription_city.pk,
-                    'weather_info': subscription_weather.pk,
-                    'notification_frequency': request_body.get('notification_frequency',
-                                                               subscription.notification_frequency),
-                }
-
-                subscription_serializer = UserSubscriptionSerializer(instance=subscription, data=new_subscription_data,
-                                                                     partial=True)
-                if subscription_serializer.is_valid():
-                    subscription_serializer.save()
-                    remove_unused_entries()  # remove cities that nobody is subscribed for
-                    return Response({"res": "Subscription edited"}, status=status.HTTP_200_OK)
-                else:
-                    return Response({"res": subscription_serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+            subscription_city, subscription_weather = save_city_weather(city_data, weather_data)
+
+        if not edit_subscription(request.user, id, subscription_city, subscription_weather,
+                                 subscription_data.get('notification_frequency')):
+            return Response({"res": f"Subscription with id={id} does not exist for this user"},
+                            status=status.HTTP_400_BAD_REQUEST,
+                            )
+        return Response({"res": "Subscription edited"}, status=status.HTTP_200_OK)
 
     @extend_schema(description='### Specify the id of the subscription you want to delete',
                    tags=['subscriptions'], )
     def delete(self, request, id):
         """Handle DELETE requests for deleting user subscriptions."""
-        user = request.user
-        user_subscriptions = user.subscriptions.all()
-        subscription = self.get_usersubscription_object(subscription_id=id)
-        if not subscription or subscription not in user_subscriptions:
-            return Response({"res": f"Subscription with id={id} does not exist for this user"},
-                            status=status.HTTP_404_NOT_FOUND,
-                            )
-        else:
-            user.subscriptions.remove(subscription)
+        with transaction.atomic():
+            subscription = UserSubscription.objects.filter(id=id, user=request.user).only('id', 'city_id').first()
+            if subscription is None:
+                return Response({"res": f"Subscription with id={id} does not exist for this user"},
+                                status=status.HTTP_404_NOT_FOUND,
+                                )
             subscription.delete()
-            remove_unused_entries()  # remove cities that nobody is subscribed for
-            return Response(
-                {"res": "Subscription deleted"},
-                status=status.HTTP_200_OK
-            )
+            remove_unused_city(subscription.city_id)  # remove the city if nobody is subscribed for it
+        return Response(
+            {"res": "Subscription deleted"},
+            status=status.HTTP_200_OK
+        )